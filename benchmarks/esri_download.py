@@ -0,0 +1,63 @@
+''' Measure ESRI download throughput for each pagination strategy and format.
+
+Runs EsriRestDownloadTask against a local FakeEsriServer and reports
+features per second. Run from the repository root:
+
+    python benchmarks/esri_download.py [feature count] [seconds latency per query]
+'''
+from __future__ import absolute_import, division, print_function
+
+import sys, time, shutil, tempfile, logging
+from os.path import dirname, join
+
+sys.path.insert(0, join(dirname(__file__), '..'))
+
+from openaddr.cache import EsriRestDownloadTask
+from openaddr.tests.esri_server import FakeEsriServer
+
+strategies = [
+    ('resultOffset', dict(supports_pagination=True)),
+    ('OID where clause', dict(supports_statistics=True)),
+    ('OID enumeration', dict()),
+    ]
+
+formats = [
+    ('json', dict(supports_pbf=False)),
+    ('pbf', dict(supports_pbf=True)),
+    ]
+
+def run(name, feature_count, latency, **kwargs):
+    workdir = tempfile.mkdtemp(prefix='esri-benchmark-')
+
+    try:
+        with FakeEsriServer(feature_count=feature_count, latency=latency, **kwargs) as server:
+            task = EsriRestDownloadTask('us-xx-fake')
+            start = time.time()
+            task.download([server.url], workdir)
+            elapsed = time.time() - start
+
+        (sizer, ) = task.page_sizers
+        print('{:<32} {:>8.0f} features/sec, {:>4} pages, sizes {}'.format(
+              name, feature_count / elapsed, len(sizer.history),
+              sorted(set(size for (size, _, _) in sizer.history))))
+    finally:
+        shutil.rmtree(workdir)
+
+def main():
+    logging.basicConfig(level=logging.WARNING)
+    feature_count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else .05
+
+    print('{} features, {:.3f} seconds latency per query'.format(feature_count, latency))
+
+    for (format, format_kwargs) in formats:
+        for (name, kwargs) in strategies:
+            run('{} {}'.format(name, format), feature_count, latency,
+                max_record_count=1000, **dict(kwargs, **format_kwargs))
+
+        for (name, kwargs) in strategies:
+            run('{} {} (limit 250)'.format(name, format), feature_count, latency,
+                max_record_count=1000, record_limit=250, **dict(kwargs, **format_kwargs))
+
+if __name__ == '__main__':
+    exit(main())
@@ -0,0 +1,51 @@
+''' Compare per-feature cost of OGR and fast-path ESRI point geometry handling.
+
+Run from the repository root:
+
+    python benchmarks/esri_points.py [feature count]
+'''
+from __future__ import absolute_import, division, print_function
+
+import sys, random, timeit
+from os.path import dirname, join
+
+sys.path.insert(0, join(dirname(__file__), '..'))
+
+from openaddr.cache import EsriRestDownloadTask, point_geometry_values
+
+def make_features(count):
+    ''' Make fake ESRI point features with coordinates at 7-digit precision.
+    '''
+    rand = random.Random(0)
+    return [{'attributes': {'OBJECTID': i}, 'geometry': {
+            'x': round(rand.uniform(-125, -65), 7),
+            'y': round(rand.uniform(25, 50), 7),
+            }} for i in range(count)]
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    features = make_features(count)
+    task = EsriRestDownloadTask(None)
+
+    def use_ogr():
+        for feature in features:
+            task.ogr_geometry_values('esriGeometryPoint', feature)
+
+    def use_fast_path():
+        for feature in features:
+            point_geometry_values('esriGeometryPoint', feature)
+
+    mismatches = sum([1 for feature in features
+                      if task.ogr_geometry_values('esriGeometryPoint', feature)
+                      != point_geometry_values('esriGeometryPoint', feature)])
+
+    ogr_time = min(timeit.repeat(use_ogr, number=1, repeat=3))
+    fast_time = min(timeit.repeat(use_fast_path, number=1, repeat=3))
+
+    print('{} features, {} mismatches'.format(count, mismatches))
+    print('OGR:       {:.2f} usec per feature'.format(ogr_time / count * 1e6))
+    print('Fast path: {:.2f} usec per feature'.format(fast_time / count * 1e6))
+    print('Speedup:   {:.1f}x'.format(ogr_time / fast_time))
+
+if __name__ == '__main__':
+    exit(main())
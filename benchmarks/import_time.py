@@ -0,0 +1,85 @@
+''' Check import time of each console script entry point against a budget.
+
+Imports each module named in setup.py console_scripts in a fresh
+interpreter with `python -X importtime` (Python 3.7+), and compares its
+cumulative import time to import_budget.json. Run from the repository root:
+
+    python benchmarks/import_time.py [--update]
+
+Exits with an error if any entry point is over budget. Use --update to
+write new budgets with some headroom over the current measurements.
+'''
+from __future__ import absolute_import, division, print_function
+
+import re, sys, json, subprocess
+from os.path import dirname, join
+
+root = join(dirname(__file__), '..')
+budget_path = join(dirname(__file__), 'import_budget.json')
+
+# Heavy dependencies that should only load in commands that use them.
+HEAVY_MODULES = 'osgeo', 'boto', 'boto3', 'flask', 'psycopg2', 'pq', 'cairo', 'cairocffi'
+
+# Headroom over measured times used by --update.
+HEADROOM = 1.5
+
+# Runs per module, the fastest is used.
+REPEAT = 3
+
+def entry_points():
+    ''' Return a list of (script name, module name) from setup.py.
+    '''
+    with open(join(root, 'setup.py')) as file:
+        pattern = re.compile(r"'([\w-]+) = ([\w.]+):\w+'")
+        return pattern.findall(file.read())
+
+def measure(module_name):
+    ''' Return cumulative import time in milliseconds and top-level modules loaded.
+    '''
+    cmd = sys.executable, '-X', 'importtime', '-c', 'import {}'.format(module_name)
+    stderr = subprocess.check_output(cmd, cwd=root, stderr=subprocess.STDOUT)
+
+    cumulative, loaded = None, set()
+
+    for line in stderr.decode('utf8').splitlines():
+        match = re.match(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$', line)
+        if not match:
+            continue
+        loaded.add(match.group(4).split('.')[0])
+        if match.group(4) == module_name:
+            cumulative = int(match.group(2)) / 1000
+
+    return cumulative, loaded
+
+def main():
+    update = '--update' in sys.argv[1:]
+
+    with open(budget_path) as file:
+        budgets = json.load(file)
+
+    over_budget = False
+
+    for (script, module_name) in entry_points():
+        results = [measure(module_name) for _ in range(REPEAT)]
+        msec = min(msec for (msec, _) in results)
+        heavy = sorted(set(HEAVY_MODULES) & results[0][1])
+
+        if update:
+            budgets[script] = int(msec * HEADROOM) + 1
+
+        budget = budgets.get(script)
+        status = 'ok' if budget is not None and msec <= budget else 'OVER'
+        over_budget |= (status == 'OVER')
+
+        print('{:<28} {:>7.1f} msec of {:>5} budget {:<4} {}'.format(
+              script, msec, budget, status, ', '.join(heavy)))
+
+    if update:
+        with open(budget_path, 'w') as file:
+            json.dump(budgets, file, indent=2, sort_keys=True)
+            file.write('\n')
+
+    return 1 if over_budget else 0
+
+if __name__ == '__main__':
+    exit(main())
@@ -0,0 +1,79 @@
+''' Measure enqueue-to-start latency for polled and LISTEN/NOTIFY queue consumers.
+
+Needs a database prepared with openaddr-ci-recreate-db. Uses its own
+queue name and leaves other queues alone. Run from the repository root:
+
+    python benchmarks/queue_latency.py <database url> [task count]
+'''
+from __future__ import absolute_import, division, print_function
+
+import sys, time, random, threading
+from os.path import dirname, join
+
+sys.path.insert(0, join(dirname(__file__), '..'))
+
+from openaddr.ci import (
+    db_connect, db_queue, listen_to_queues, wait_for_notifies, QUEUE_POLL_INTERVAL
+    )
+
+QUEUE_NAME = 'benchmark-latency'
+
+def consume_polling(database_url, count, latencies):
+    ''' Consume like the old worker loop, with a new connection and blocking get() each time.
+    '''
+    while len(latencies) < count:
+        with db_connect(database_url) as conn:
+            queue = db_queue(conn, QUEUE_NAME)
+            with queue:
+                task = queue.get()
+            if task is not None:
+                latencies.append(time.time() - task.data['put'])
+
+def consume_notified(database_url, count, latencies):
+    ''' Consume like the current worker loop, waiting for NOTIFY between tasks.
+    '''
+    with db_connect(database_url) as conn:
+        queue = db_queue(conn, QUEUE_NAME)
+        listen_to_queues(conn, QUEUE_NAME)
+
+        while len(latencies) < count:
+            with queue:
+                task = queue.get(block=False)
+            if task is None:
+                wait_for_notifies(conn, QUEUE_POLL_INTERVAL.seconds)
+            else:
+                latencies.append(time.time() - task.data['put'])
+
+def run(name, consumer, database_url, count):
+    latencies, rand = [], random.Random(0)
+    thread = threading.Thread(target=consumer, args=(database_url, count, latencies))
+    thread.start()
+
+    with db_connect(database_url) as conn:
+        queue = db_queue(conn, QUEUE_NAME)
+        for _ in range(count):
+            time.sleep(rand.uniform(0, .5))
+            queue.put(dict(put=time.time()))
+
+    thread.join()
+    latencies.sort()
+
+    print('{:<10} mean {:>6.1f} msec, median {:>6.1f} msec, max {:>6.1f} msec'.format(
+          name, 1000 * sum(latencies) / len(latencies),
+          1000 * latencies[len(latencies) // 2], 1000 * latencies[-1]))
+
+def main():
+    database_url = sys.argv[1]
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    print('{} tasks put at random intervals up to 500 msec'.format(count))
+
+    try:
+        run('polling', consume_polling, database_url, count)
+        run('notify', consume_notified, database_url, count)
+    finally:
+        with db_connect(database_url) as conn:
+            db_queue(conn, QUEUE_NAME).clear()
+
+if __name__ == '__main__':
+    exit(main())
@@ -5,22 +5,22 @@ from .compat import standard_library
 
 from tempfile import mkdtemp, mkstemp
 from os.path import realpath, join, basename, splitext, exists, dirname, abspath, relpath
-from shutil import copy, move, rmtree
+from shutil import move, rmtree
 from os import mkdir, environ, close, utime, remove
 from urllib.parse import urlparse
 from datetime import datetime, date
 from calendar import timegm
-import json, io, zipfile
+import json, io, zipfile, threading
 
-from osgeo import ogr
-from requests import get
-from boto.s3.connection import S3Connection
-from dateutil.parser import parse
+from .lazy import LazyModule
 from .sample import sample_geojson
 
+requests = LazyModule('requests')
+
 from .cache import (
     CacheResult,
     compare_cache_details,
+    link_or_copy,
     DownloadTask,
     URLDownloadTask,
 )
@@ -43,23 +43,25 @@ with open(join(dirname(__file__), 'VERSION')) as file:
 SOURCES_DIR = '/var/opt/openaddresses'
 
 class S3:
-    _bucket = None
-
+    ''' S3 bucket access, with a separate boto connection for each thread.
+    '''
     def __init__(self, key, secret, bucketname):
         self._key, self._secret = key, secret
         self.bucketname = bucketname
+        self._local = threading.local()
     
     def _make_bucket(self):
-        if not self._bucket:
+        if not getattr(self._local, 'bucket', None):
             # see https://github.com/boto/boto/issues/2836#issuecomment-67896932
+            from boto.s3.connection import S3Connection
             kwargs = dict(calling_format='boto.s3.connection.OrdinaryCallingFormat')
             connection = S3Connection(self._key, self._secret, **kwargs)
-            self._bucket = connection.get_bucket(self.bucketname)
+            self._local.bucket = connection.get_bucket(self.bucketname)
     
     @property
     def bucket(self):
         self._make_bucket()
-        return self._bucket
+        return self._local.bucket
     
     def get_key(self, name):
         return self.bucket.get_key(name)
@@ -155,7 +157,7 @@ def conform(srcjson, destdir, extras):
     #
     scheme, _, cache_path, _, _, _ = urlparse(extras.get('cache', ''))
     if scheme == 'file':
-        copy(cache_path, workdir)
+        link_or_copy(cache_path, workdir)
 
     source_urls = data.get('cache')
     if not isinstance(source_urls, list):
@@ -276,11 +278,13 @@ def download_processed_file(url):
     
         Local file will have an appropriate timestamp and extension.
     '''
+    from dateutil.parser import parse
+
     _, ext = splitext(urlparse(url).path)
     handle, filename = mkstemp(prefix='processed-', suffix=ext)
     close(handle)
     
-    response = get(url, stream=True, timeout=5)
+    response = requests.get(url, stream=True, timeout=5)
     
     with open(filename, 'wb') as file:
         for chunk in response.iter_content(chunk_size=8192):
@@ -3,16 +3,17 @@ import logging; _L = logging.getLogger('openaddr.cache')
 
 from .compat import standard_library, PY2
 
-import ogr
 import os
 import errno
 import socket
 import mimetypes
 import shutil
 import re
-import simplejson as json
+import math
+import time
 
 from os import mkdir
+from decimal import Decimal
 from hashlib import md5
 from os.path import join, basename, exists, abspath, splitext
 from urllib.parse import urlparse
@@ -21,15 +22,19 @@ from tempfile import mkstemp
 from hashlib import sha1
 from shutil import move
 
-import requests
-import requests_ftp
-requests_ftp.monkeypatch_session()
+from .lazy import LazyModule
+
+json = LazyModule('simplejson')
+ijson = LazyModule('ijson')
+requests_ftp = LazyModule('requests_ftp')
+requests = LazyModule('requests', lambda _: requests_ftp.monkeypatch_session())
 
 # HTTP timeout in seconds, used in various calls to requests.get() and requests.post()
 _http_timeout = 180
 
 from .compat import csvopen, csvDictWriter
-from .conform import X_FIELDNAME, Y_FIELDNAME, GEOM_FIELDNAME, attrib_types
+from . import esripbf
+from .conform import X_FIELDNAME, Y_FIELDNAME, GEOM_FIELDNAME, attrib_types, ogr
 
 def mkdirsp(path):
     try:
@@ -40,6 +45,26 @@ def mkdirsp(path):
         else:
             raise
 
+def link_or_copy(src, dst):
+    ''' Hard-link src to dst if possible, or copy it if not. Return new path.
+
+        Like shutil.copy(), dst may be a directory. Linked files share
+        their bytes, so neither name should be modified in place.
+    '''
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, basename(src))
+
+    try:
+        if exists(dst):
+            os.remove(dst)
+        os.link(src, dst)
+    except (OSError, AttributeError) as e:
+        # Different filesystems, no hard link support, or no os.link() at all.
+        _L.debug('Copying {} to {} instead of linking: {}'.format(src, dst, e))
+        shutil.copy(src, dst)
+
+    return dst
+
 def request(method, url, **kwargs):
     try:
         _L.debug("Requesting %s with args %s", url, kwargs.get('params') or kwargs.get('data'))
@@ -243,12 +268,12 @@ class URLDownloadTask(DownloadTask):
         for source_url in source_urls:
             file_path = self.get_file_path(source_url, download_path)
 
-            # FIXME: For URLs with file:// scheme, simply copy the file
+            # FIXME: For URLs with file:// scheme, simply link the file
             # to the expected location so that os.path.exists() returns True.
             # Instead, implement a FileDownloadTask class?
             scheme, _, path, _, _, _ = urlparse(source_url)
             if scheme == 'file':
-                shutil.copy(path, file_path)
+                link_or_copy(path, file_path)
 
             if os.path.exists(file_path):
                 output_files.append(file_path)
@@ -264,10 +289,16 @@ class URLDownloadTask(DownloadTask):
                 raise DownloadError('{} response from {}'.format(resp.status_code, source_url))
             
             size = 0
-            with open(file_path, 'wb') as fp:
-                for chunk in resp.iter_content(self.CHUNK):
-                    size += len(chunk)
-                    fp.write(chunk)
+            try:
+                with open(file_path, 'wb') as fp:
+                    for chunk in resp.iter_content(self.CHUNK):
+                        size += len(chunk)
+                        fp.write(chunk)
+            except (socket.timeout, requests.exceptions.RequestException,
+                    requests.packages.urllib3.exceptions.HTTPError) as e:
+                # Don't leave a partial file to be mistaken for a finished one.
+                os.remove(file_path)
+                raise DownloadError("Could not download URL", e)
 
             output_files.append(file_path)
 
@@ -276,7 +307,321 @@ class URLDownloadTask(DownloadTask):
         return output_files
 
 
+def format_wkt_double(value):
+    ''' Format a non-integer coordinate the way OGR does in WKT output.
+
+        Follows OGRFormatDouble(): 15 decimal places, with trailing zeros
+        and likely round-off digits trimmed.
+    '''
+    precision = 15
+
+    while precision > 0:
+        text = '%.*f' % (precision, value)
+        dot = text.find('.')
+        before_dot = len(text[:dot].lstrip('-'))
+
+        # Trim trailing 00000x's as they are likely roundoff error.
+        if len(text) > 10 and dot >= 0:
+            if text[-6:-1] == '00000':
+                text = text[:-1]
+            elif len(text) - 8 > dot and text[-9:-7] == '00' \
+            and all(before_dot >= 4 + n or text[-3 - n] == '0' for n in range(5)):
+                text = text[:-8]
+
+        # Trim trailing zeros.
+        while len(text) > 2 and text[-1] == '0' and text[-2] != '.':
+            text = text[:-1]
+
+        # Detect trailing 99999X's as they are likely roundoff error.
+        if len(text) > 10 and dot >= 0 and precision + before_dot >= 15:
+            if text[-6:-1] == '99999':
+                precision -= 1
+                continue
+
+        return text
+
+    return '%.0f' % value
+
+def format_wkt_coordinate(x, y):
+    ''' Format a 2.5D WKT coordinate with zero Z, like OGR's AddPoint(x, y).
+    '''
+    if x == int(x) and y == int(y) and max(abs(x), abs(y)) < 2**31:
+        return '{:d} {:d} 0'.format(int(x), int(y))
+
+    return '{} {} 0'.format(format_wkt_double(x), format_wkt_double(y))
+
+# Largest coordinate magnitude that format_wkt_coordinate() is trusted with.
+FAST_POINT_MAXIMUM = 1000
+
+# Most decimal places in a coordinate that format_wkt_double() is trusted with,
+# matching the geometryPrecision requested from ESRI servers.
+FAST_POINT_PRECISION = 7
+
+def _is_plain_coordinate(value):
+    ''' Return True for coordinates known to format the same as in OGR.
+
+        Covers small integers and short decimal degrees. Anything else, like
+        negative zero, exponents, or 15+ significant digits, goes to OGR.
+    '''
+    if not isinstance(value, (int, float)) or isinstance(value, bool):
+        return False
+
+    if value != value or abs(value) == float('inf'):
+        return False
+
+    if value == 0:
+        return math.copysign(1, value) > 0
+
+    return abs(value) < FAST_POINT_MAXIMUM and abs(value) >= 10**-FAST_POINT_PRECISION \
+        and round(value, FAST_POINT_PRECISION) == value
+
+def point_geometry_values(geom_type, esri_feature):
+    ''' Return WKT, x and y for simple ESRI point features without using OGR.
+
+        Returns None for anything unusual, so the caller can use OGR instead.
+    '''
+    geometry = esri_feature.get('geometry')
+    if not geometry:
+        return None
+
+    if geom_type == 'esriGeometryPoint':
+        x, y = geometry.get('x'), geometry.get('y')
+        if not (_is_plain_coordinate(x) and _is_plain_coordinate(y)):
+            return None
+
+        wkt = 'POINT ({})'.format(format_wkt_coordinate(x, y))
+        return wkt, round(x, 7), round(y, 7)
+
+    if geom_type == 'esriGeometryMultipoint':
+        points = geometry.get('points')
+        if not points:
+            return None
+
+        for point in points:
+            if len(point) < 2 or not (_is_plain_coordinate(point[0]) and _is_plain_coordinate(point[1])):
+                return None
+
+        wkt = 'MULTIPOINT ({})'.format(','.join([format_wkt_coordinate(x, y) for (x, y) in
+                                                 [point[:2] for point in points]]))
+        x = sum([point[0] for point in points]) / len(points)
+        y = sum([point[1] for point in points]) / len(points)
+        return wkt, round(x, 7), round(y, 7)
+
+    return None
+
+def is_timeout_error(error):
+    ''' Return True if an HTTP error means the server took too long.
+
+        Read timeouts in the middle of a streamed body come out of
+        iter_content() as urllib3 errors, or requests ConnectionErrors
+        wrapping them in newer versions of requests.
+    '''
+    urllib3_timeout = requests.packages.urllib3.exceptions.TimeoutError
+
+    if isinstance(error, (socket.timeout, requests.exceptions.Timeout, urllib3_timeout)):
+        return True
+
+    return isinstance(error, requests.exceptions.ConnectionError) \
+        and any([isinstance(arg, (socket.timeout, urllib3_timeout)) for arg in error.args])
+
+class _ResponseFile(object):
+    ''' Minimal readable file wrapped around a streamed HTTP response.
+
+        ijson wants something with a read() method, and iter_content() handles
+        chunked and compressed transfer encodings for us where response.raw
+        does not.
+    '''
+    def __init__(self, response, chunk_size):
+        self.chunks = response.iter_content(chunk_size)
+        self.buffer = b''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            try:
+                self.buffer += next(self.chunks)
+            except StopIteration:
+                break
+
+        if size < 0:
+            data, self.buffer = self.buffer, b''
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+
+        return data
+
+class CSVFeatureSink(object):
+    ''' Write downloaded ESRI feature rows to a CSV file.
+
+        Rows from a page can be rolled back if the page needs to be retried.
+    '''
+    def __init__(self, file_path, field_names):
+        self.file_path, self.field_names = file_path, field_names
+        self.count = self.page_start = 0
+
+    def __enter__(self):
+        self.file = csvopen(self.file_path, 'w', encoding='utf-8')
+        self.writer = csvDictWriter(self.file, fieldnames=self.field_names, encoding='utf-8')
+        self.writer.writeheader()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.file.close()
+
+    def begin_page(self):
+        self.file.flush()
+        self.position, self.page_start = self.file.tell(), self.count
+
+    def write(self, row):
+        self.writer.writerow({fn: row.get(fn) for fn in self.field_names})
+        self.count += 1
+
+    def abort_page(self):
+        self.file.seek(self.position)
+        self.file.truncate()
+        self.count = self.page_start
+
+    def end_page(self):
+        pass
+
+class EsriPageSizer(object):
+    ''' Choose ESRI query page sizes based on how the server responds.
+
+        Starts at the server's maxRecordCount, shrinks after timeouts and
+        truncated pages, and grows again while time per feature improves.
+        Keeps a history of (page size, feature count, seconds) for each page.
+    '''
+    def __init__(self, maximum, minimum=1):
+        self.size = self.maximum = max(int(maximum), minimum)
+        self.minimum = minimum
+        self.last_latency = None
+        self.history = []
+
+    def shrink(self, count=None):
+        ''' Reduce page size, return False if it can't get any smaller.
+
+            With a count of features returned from a truncated page,
+            treat that count as the server's real limit.
+        '''
+        if count:
+            self.maximum = max(count, self.minimum)
+            self.size = min(self.size, self.maximum)
+            return True
+
+        if self.size <= self.minimum:
+            return False
+
+        self.size = max(self.size // 2, self.minimum)
+        self.last_latency = None
+        return True
+
+    def record(self, size, count, seconds):
+        ''' Note the results of one page and grow the page size if it helped.
+        '''
+        self.history.append((size, count, seconds))
+
+        if count < size:
+            # Short pages say nothing useful about latency.
+            return
+
+        latency = seconds / count
+        if self.last_latency is None or latency < self.last_latency:
+            self.size = min(self.maximum, self.size + max(self.size // 2, 1))
+        self.last_latency = latency
+
+    def summary(self):
+        sizes = sorted(set(size for (size, _, _) in self.history))
+        seconds = sum(secs for (_, _, secs) in self.history)
+        return 'page sizes {} in {:.1f} seconds'.format(sizes, seconds)
+
+class OffsetPages(object):
+    ''' ESRI query pages using resultOffset and resultRecordCount.
+
+        Pages advance by the number of features actually returned,
+        so truncated pages don't need to be retried.
+    '''
+    must_retry_truncated = False
+
+    def __init__(self, base_args, row_count):
+        self.base_args, self.row_count, self.offset = base_args, row_count, 0
+
+    def done(self):
+        return self.offset >= self.row_count
+
+    def next_args(self, page_size):
+        query_args = dict(self.base_args)
+        query_args.update({'resultOffset': self.offset, 'resultRecordCount': page_size})
+        return query_args
+
+    def advance(self, page_size, count):
+        if count == 0:
+            # An empty page means we've run out of features.
+            self.offset = self.row_count
+        else:
+            self.offset += min(count, page_size)
+
+class WherePages(object):
+    ''' ESRI query pages using ranges of object IDs in a where clause.
+
+        Truncated pages must be retried with a smaller range.
+    '''
+    must_retry_truncated = True
+
+    def __init__(self, base_args, oid_field_name, oid_min, oid_max):
+        self.base_args, self.oid_field_name = base_args, oid_field_name
+        self.page_min, self.oid_max = oid_min - 1, oid_max
+
+    def done(self):
+        return self.page_min >= self.oid_max
+
+    def next_args(self, page_size):
+        page_max = min(self.page_min + page_size, self.oid_max)
+        query_args = dict(self.base_args)
+        query_args.update({
+            'where': '{} > {} AND {} <= {}'.format(
+                self.oid_field_name,
+                self.page_min,
+                self.oid_field_name,
+                page_max,
+            ),
+        })
+        return query_args
+
+    def advance(self, page_size, count):
+        self.page_min = min(self.page_min + page_size, self.oid_max)
+
+class ObjectIdPages(object):
+    ''' ESRI query pages using chunks of enumerated object IDs.
+
+        Truncated pages must be retried with a smaller chunk.
+    '''
+    must_retry_truncated = True
+
+    def __init__(self, base_args, oids):
+        self.base_args, self.oids, self.index = base_args, oids, 0
+
+    def done(self):
+        return self.index >= len(self.oids)
+
+    def next_args(self, page_size):
+        oid_chunk = self.oids[self.index:self.index + page_size]
+        query_args = dict(self.base_args)
+        query_args.update({'objectIds': ','.join(map(str, oid_chunk))})
+        return query_args
+
+    def advance(self, page_size, count):
+        self.index += page_size
+
 class EsriRestDownloadTask(DownloadTask):
+    CHUNK = 16 * 1024
+
+    # Number of point features per layer to check against OGR before
+    # trusting point_geometry_values() for the rest.
+    FAST_POINT_CHECKS = 100
+
+    def __init__(self, *args, **kwargs):
+        DownloadTask.__init__(self, *args, **kwargs)
+        self.page_sizers = []
+
     def handle_esri_errors(self, response, error_message):
         if response.status_code != 200:
             raise DownloadError('{}: HTTP {} {}'.format(
@@ -304,6 +649,83 @@ class EsriRestDownloadTask(DownloadTask):
 
         return data
 
+    def stream_esri_features(self, response, error_message, geometry_type=None, page_info=None):
+        ''' Generate (geometry type, feature) pairs from a streamed query response.
+
+            Features are built one at a time from ijson events, so a page is
+            never held in memory all at once. The response's own geometryType
+            takes precedence over the geometry_type argument once it's seen.
+            Optional page_info dictionary receives exceededTransferLimit.
+        '''
+        if response.status_code != 200:
+            raise DownloadError('{}: HTTP {} {}'.format(
+                error_message,
+                response.status_code,
+                response.text,
+            ))
+
+        builder, building = None, None
+
+        for prefix, event, value in ijson.parse(_ResponseFile(response, self.CHUNK)):
+            if event == 'number' and isinstance(value, Decimal):
+                # Match the floats that response.json() would have returned.
+                value = float(value)
+
+            if building is not None:
+                if prefix == building and event in ('end_map', 'end_array'):
+                    if building == 'error':
+                        raise DownloadError("{}. Server said: {}".format(error_message, builder.value.get('message')))
+                    yield geometry_type, builder.value
+                    builder, building = None, None
+                else:
+                    builder.event(event, value)
+            elif (prefix, event) == ('geometryType', 'string'):
+                geometry_type = value
+            elif (prefix, event) == ('exceededTransferLimit', 'boolean'):
+                if page_info is not None:
+                    page_info['exceededTransferLimit'] = value
+            elif (prefix, event) in (('features.item', 'start_map'), ('error', 'start_map')):
+                builder, building = ijson.common.ObjectBuilder(), prefix
+                builder.event(event, value)
+
+    def supports_pbf(self, metadata):
+        ''' Return True if layer metadata advertises f=pbf query responses.
+        '''
+        formats = metadata.get('supportedQueryFormats') or ''
+        return 'pbf' in [f.strip().lower() for f in formats.split(',')]
+
+    def query_pbf_features(self, query_url, query_args, error_message, page_info=None):
+        ''' Return a list of (geometry type, feature) pairs from an f=pbf query.
+
+            Raises esripbf.DecodeError for anything that isn't a usable
+            protocol buffer, so the caller can fall back to JSON.
+            Optional page_info dictionary receives exceededTransferLimit.
+        '''
+        pbf_args = dict(query_args)
+        pbf_args.update({'f': 'pbf'})
+
+        try:
+            response = request('POST', query_url, headers=self.headers, data=pbf_args)
+        except Exception as e:
+            if is_timeout_error(e):
+                raise
+            raise DownloadError("Could not connect to URL", e)
+
+        if response.status_code != 200:
+            raise esripbf.DecodeError('{}: HTTP {}'.format(error_message, response.status_code))
+
+        if 'json' in response.headers.get('content-type', ''):
+            # Errors and unsupported formats come back as JSON.
+            raise esripbf.DecodeError('{}: expected protocol buffer, got {}'.format(
+                error_message, response.text[:256]))
+
+        data = esripbf.decode_feature_collection(response.content)
+
+        if page_info is not None:
+            page_info['exceededTransferLimit'] = data['exceededTransferLimit']
+
+        return [(data['geometryType'], feature) for feature in data['features']]
+
     def build_ogr_geometry(self, geom_type, esri_feature):
         if 'geometry' not in esri_feature:
             raise TypeError("No geometry for feature")
@@ -336,6 +758,24 @@ class EsriRestDownloadTask(DownloadTask):
 
         return geom
 
+    def ogr_geometry_values(self, geom_type, esri_feature):
+        ''' Return WKT, x and y for an ESRI feature using OGR.
+
+            Raises TypeError for features without geometry.
+        '''
+        ogr_geom = self.build_ogr_geometry(geom_type, esri_feature)
+        wkt = ogr_geom.ExportToWkt()
+
+        try:
+            centroid = ogr_geom.Centroid()
+        except RuntimeError as e:
+            if 'Invalid number of points in LinearRing found' not in str(e):
+                raise
+            xmin, xmax, ymin, ymax = ogr_geom.GetEnvelope()
+            return wkt, round(xmin/2 + xmax/2, 7), round(ymin/2 + ymax/2, 7)
+        else:
+            return wkt, round(centroid.GetX(), 7), round(centroid.GetY(), 7)
+
     def get_file_path(self, url, dir_path):
         ''' Return a local file path in a directory for a URL.
         '''
@@ -466,7 +906,6 @@ class EsriRestDownloadTask(DownloadTask):
         query_fields = self.field_names_to_request(conform)
 
         for source_url in source_urls:
-            size = 0
             file_path = self.get_file_path(source_url, download_path)
 
             if os.path.exists(file_path):
@@ -474,167 +913,201 @@ class EsriRestDownloadTask(DownloadTask):
                 _L.debug("File exists %s", file_path)
                 continue
 
-            metadata = self.get_layer_metadata(source_url)
-            
-            if query_fields is None:
-                field_names = [f['name'] for f in metadata['fields']]
-            else:
-                field_names = query_fields[:]
-
-            if X_FIELDNAME not in field_names:
-                field_names.append(X_FIELDNAME)
-            if Y_FIELDNAME not in field_names:
-                field_names.append(Y_FIELDNAME)
-            if GEOM_FIELDNAME not in field_names:
-                field_names.append(GEOM_FIELDNAME)
-
-            query_url = source_url + '/query'
-
-            # Get the count of rows in the layer
-            count_json = self.get_layer_feature_count(query_url)
-
-            row_count = count_json.get('count')
-            page_size = metadata.get('maxRecordCount', 500)
-            if page_size > 1000:
-                page_size = 1000
-
-            _L.info("Source has {} rows".format(row_count))
-
-            page_args = []
-
-            if metadata.get('supportsPagination') or \
-               (metadata.get('advancedQueryCapabilities') and metadata['advancedQueryCapabilities']['supportsPagination']):
-                # If the layer supports pagination, we can use resultOffset/resultRecordCount to paginate
-
-                # There's a bug where some servers won't handle these queries in combination with a list of
-                # fields specified. We'll make a single, 1 row query here to check if the server supports this
-                # and switch to querying for all fields if specifying the fields fails.
-                if query_fields and not self.can_handle_pagination(query_url, query_fields):
-                    _L.info("Source does not support pagination with fields specified, so querying for all fields.")
-                    query_fields = None
-
-                for offset in range(0, row_count, page_size):
-                    query_args = dict(**self.query_params)
-                    query_args.update({
-                        'resultOffset': offset,
-                        'resultRecordCount': page_size,
-                        'where': '1=1',
-                        'geometryPrecision': 7,
-                        'returnGeometry': 'true',
-                        'outSR': 4326,
-                        'outFields': ','.join(query_fields or ['*']),
-                        'f': 'json',
-                    })
-                    page_args.append(query_args)
-                _L.info("Built {} requests using resultOffset method".format(len(page_args)))
-            else:
-                # If not, we can still use the `where` argument to paginate
-
-                use_oids = True
-                if metadata.get('supportsStatistics'):
-                    # If the layer supports statistics, we can request maximum and minimum object ID
-                    # to help build the pages
-
-                    oid_field_name = self.find_oid_field_name(metadata)
-
-                    try:
-                        (oid_min, oid_max) = self.get_layer_min_max(query_url, oid_field_name)
-
-                        for page_min in range(oid_min - 1, oid_max, page_size):
-                            page_max = min(page_min + page_size, oid_max)
-                            query_args = dict(**self.query_params)
-                            query_args.update({
-                                'where': '{} > {} AND {} <= {}'.format(
-                                    oid_field_name,
-                                    page_min,
-                                    oid_field_name,
-                                    page_max,
-                                ),
-                                'geometryPrecision': 7,
-                                'returnGeometry': 'true',
-                                'outSR': 4326,
-                                'outFields': ','.join(query_fields or ['*']),
-                                'f': 'json',
-                            })
-                            page_args.append(query_args)
-                        _L.info("Built {} requests using OID where clause method".format(len(page_args)))
-
-                        # If we reach this point we don't need to fall through to enumerating all object IDs
-                        # because the statistics method worked
-                        use_oids = False
-                    except DownloadError:
-                        _L.exception("Finding max/min from statistics failed. Trying OID enumeration.")
-
-                if use_oids:
-                    # If the layer does not support statistics, we can request
-                    # all the individual IDs and page through them one chunk at
-                    # a time.
-
-                    oid_data = self.get_layer_oids(query_url)
-                    oids = oid_data['objectIds']
-
-                    for i in range(0, len(oids), 100):
-                        oid_chunk = map(long if PY2 else int, oids[i:i+100])
-                        query_args = dict(**self.query_params)
-                        query_args.update({
-                            'objectIds': ','.join(map(str, oid_chunk)),
-                            'geometryPrecision': 7,
-                            'returnGeometry': 'true',
-                            'outSR': 4326,
-                            'outFields': ','.join(query_fields or ['*']),
-                            'f': 'json',
-                        })
-                        page_args.append(query_args)
-                    _L.info("Built {} requests using OID enumeration method".format(len(page_args)))
-
-            with csvopen(file_path, 'w', encoding='utf-8') as f:
-                writer = csvDictWriter(f, fieldnames=field_names, encoding='utf-8')
-                writer.writeheader()
-
-                for query_args in page_args:
-                    try:
-                        response = request('POST', query_url, headers=self.headers, data=query_args)
-
-                        data = self.handle_esri_errors(response, "Could not retrieve this chunk of objects from ESRI source")
-                    except socket.timeout as e:
-                        raise DownloadError("Timeout when connecting to URL", e)
-                    except ValueError as e:
-                        raise DownloadError("Could not parse JSON", e)
-                    except Exception as e:
-                        raise DownloadError("Could not connect to URL", e)
-                    finally:
-                        # Wipe out whatever we had written out so far
-                        f.truncate()
+            def open_sink(metadata, field_names):
+                return CSVFeatureSink(file_path, field_names)
+
+            size = self.download_source(source_url, query_fields, open_sink)
+
+            _L.info("Downloaded %s ESRI features for file %s", size, file_path)
+            output_files.append(file_path)
+        return output_files
+
+    def download_source(self, source_url, query_fields, open_sink):
+        ''' Download all features from one ESRI layer into a feature sink.
+
+            open_sink is called with layer metadata and a list of field names,
+            and must return a context manager with the methods of CSVFeatureSink.
+            Returns the number of features written.
+        '''
+        metadata = self.get_layer_metadata(source_url)
 
-                    error = data.get('error')
-                    if error:
-                        raise DownloadError("Problem querying ESRI dataset with args {}. Server said: {}".format(query_args, error['message']))
+        if query_fields is None:
+            field_names = [f['name'] for f in metadata['fields']]
+        else:
+            field_names = query_fields[:]
+
+        if X_FIELDNAME not in field_names:
+            field_names.append(X_FIELDNAME)
+        if Y_FIELDNAME not in field_names:
+            field_names.append(Y_FIELDNAME)
+        if GEOM_FIELDNAME not in field_names:
+            field_names.append(GEOM_FIELDNAME)
+
+        query_url = source_url + '/query'
+
+        # Get the count of rows in the layer
+        count_json = self.get_layer_feature_count(query_url)
+
+        row_count = count_json.get('count')
+        sizer = EsriPageSizer(metadata.get('maxRecordCount') or 500)
+        self.page_sizers.append(sizer)
+
+        _L.info("Source has {} rows".format(row_count))
+
+        base_args = dict(**self.query_params)
+        base_args.update({
+            'geometryPrecision': 7,
+            'returnGeometry': 'true',
+            'outSR': 4326,
+            'f': 'json',
+        })
+
+        if metadata.get('supportsPagination') or \
+           (metadata.get('advancedQueryCapabilities') and metadata['advancedQueryCapabilities']['supportsPagination']):
+            # If the layer supports pagination, we can use resultOffset/resultRecordCount to paginate
+
+            # There's a bug where some servers won't handle these queries in combination with a list of
+            # fields specified. We'll make a single, 1 row query here to check if the server supports this
+            # and switch to querying for all fields if specifying the fields fails.
+            if query_fields and not self.can_handle_pagination(query_url, query_fields):
+                _L.info("Source does not support pagination with fields specified, so querying for all fields.")
+                query_fields = None
+
+            base_args.update({'where': '1=1', 'outFields': ','.join(query_fields or ['*'])})
+            pages = OffsetPages(base_args, row_count)
+            _L.info("Requesting pages using resultOffset method")
+        else:
+            # If not, we can still use the `where` argument to paginate
+
+            base_args.update({'outFields': ','.join(query_fields or ['*'])})
+            pages = None
+
+            if metadata.get('supportsStatistics'):
+                # If the layer supports statistics, we can request maximum and minimum object ID
+                # to help build the pages
+
+                oid_field_name = self.find_oid_field_name(metadata)
+
+                try:
+                    (oid_min, oid_max) = self.get_layer_min_max(query_url, oid_field_name)
+                    pages = WherePages(base_args, oid_field_name, oid_min, oid_max)
+                    _L.info("Requesting pages using OID where clause method")
+
+                    # If we reach this point we don't need to fall through to enumerating all object IDs
+                    # because the statistics method worked
+                except DownloadError:
+                    _L.exception("Finding max/min from statistics failed. Trying OID enumeration.")
+
+            if pages is None:
+                # If the layer does not support statistics, we can request
+                # all the individual IDs and page through them one chunk at
+                # a time.
+
+                oid_data = self.get_layer_oids(query_url)
+                oids = list(map(long if PY2 else int, oid_data['objectIds']))
+                pages = ObjectIdPages(base_args, oids)
+                _L.info("Requesting pages using OID enumeration method")
+
+        use_pbf = self.supports_pbf(metadata)
+        if use_pbf:
+            _L.info("Source supports protocol buffer responses")
+
+        fast_points, fast_point_checks = True, self.FAST_POINT_CHECKS
+
+        with open_sink(metadata, field_names) as sink:
+            while not pages.done():
+                page_size = sizer.size
+                query_args = pages.next_args(page_size)
+                error_message = "Problem querying ESRI dataset with args {}".format(query_args)
+                page_info, features, response = dict(), None, None
+
+                # Remember where this page started, in case it needs to be retried.
+                sink.begin_page()
+                start_time = time.time()
 
-                    geometry_type = data.get('geometryType')
-                    features = data.get('features')
+                try:
+                    if use_pbf:
+                        try:
+                            features = self.query_pbf_features(query_url, query_args, error_message, page_info)
+                        except esripbf.DecodeError as e:
+                            _L.warning("Falling back to JSON after protocol buffer failure: {}".format(e))
+                            use_pbf = False
+
+                    if features is None:
+                        response = request('POST', query_url, headers=self.headers, data=query_args, stream=True)
+
+                        features = self.stream_esri_features(response, error_message,
+                            metadata.get('geometryType'), page_info)
 
-                    for feature in features:
+                    count = 0
+                    for geometry_type, feature in features:
+                        count += 1
                         try:
-                            ogr_geom = self.build_ogr_geometry(geometry_type, feature)
+                            values = None
+                            if fast_points:
+                                values = point_geometry_values(geometry_type, feature)
+
+                            if values is None or fast_point_checks > 0:
+                                ogr_values = self.ogr_geometry_values(geometry_type, feature)
+
+                                if values is not None:
+                                    # Make sure the fast path agrees with OGR before relying on it.
+                                    fast_point_checks -= 1
+                                    if values != ogr_values:
+                                        _L.warning("Fast point geometry {} disagreed with OGR {}, using OGR".format(values, ogr_values))
+                                        fast_points = False
+
+                                values = ogr_values
+
                             row = feature.get('attributes', {})
-                            row[GEOM_FIELDNAME] = ogr_geom.ExportToWkt()
-                            try:
-                                centroid = ogr_geom.Centroid()
-                            except RuntimeError as e:
-                                if 'Invalid number of points in LinearRing found' not in str(e):
-                                    raise
-                                xmin, xmax, ymin, ymax = ogr_geom.GetEnvelope()
-                                row[X_FIELDNAME] = round(xmin/2 + xmax/2, 7)
-                                row[Y_FIELDNAME] = round(ymin/2 + ymax/2, 7)
-                            else:
-                                row[X_FIELDNAME] = round(centroid.GetX(), 7)
-                                row[Y_FIELDNAME] = round(centroid.GetY(), 7)
-
-                            writer.writerow({fn: row.get(fn) for fn in field_names})
-                            size += 1
+                            row[GEOM_FIELDNAME], row[X_FIELDNAME], row[Y_FIELDNAME] = values
+                            sink.write(row)
                         except TypeError:
                             _L.debug("Skipping a geometry", exc_info=True)
 
-            _L.info("Downloaded %s ESRI features for file %s", size, file_path)
-            output_files.append(file_path)
-        return output_files
+                except (socket.timeout, requests.exceptions.RequestException,
+                        requests.packages.urllib3.exceptions.HTTPError) as e:
+                    # Wipe out whatever we had written out from this page
+                    sink.abort_page()
+
+                    if not is_timeout_error(e):
+                        # Connection failures can happen anywhere in a streamed page.
+                        raise DownloadError("Could not connect to URL", e)
+
+                    if not sizer.shrink():
+                        raise DownloadError("Timeout when connecting to URL", e)
+
+                    _L.warning("Timeout with {} features per page, retrying with {}".format(page_size, sizer.size))
+                    continue
+
+                except ijson.common.JSONError as e:
+                    raise DownloadError("Could not parse JSON", e)
+
+                finally:
+                    # Give a streamed connection back to the pool, even when abandoning it.
+                    if response is not None:
+                        response.close()
+
+                truncated = bool(page_info.get('exceededTransferLimit')) and count < page_size
+                elapsed = time.time() - start_time
+                sizer.record(page_size, count, elapsed)
+
+                _L.debug("Got {} features in {:.3f} seconds for a page of {}".format(count, elapsed, page_size))
+
+                if truncated:
+                    if not sizer.shrink(count):
+                        raise DownloadError("Server returned no features for a page of {}".format(page_size))
+
+                    _L.info("Server returned {} of {} requested features, using {} per page".format(count, page_size, sizer.size))
+
+                    if pages.must_retry_truncated or count == 0:
+                        # Wipe out whatever we had written out from this page,
+                        # and try the same offset again with the smaller size.
+                        sink.abort_page()
+                        continue
+
+                sink.end_page()
+                pages.advance(page_size, count)
+
+        _L.info("Requested {} ESRI pages, {}".format(len(sizer.history), sizer.summary()))
+        return sink.count
@@ -5,7 +5,7 @@ from .. import jobs, render
 
 from .objects import (
     add_job, write_job, read_job, complete_set, update_set_renders,
-    add_run, set_run, copy_run, read_completed_set_runs, RunState,
+    add_run, set_run, set_runs, copy_run, read_completed_set_runs, RunState,
     get_completed_file_run, get_completed_run, new_read_completed_set_runs
     )
 
@@ -13,27 +13,34 @@ from . import objects
 
 from os.path import relpath, splitext, join, basename
 from datetime import timedelta
+from collections import OrderedDict
 from uuid import uuid4, getnode
-from base64 import b64decode
+from base64 import b64decode, b64encode
+from hashlib import sha1
+from io import BytesIO
 from tempfile import mkdtemp
 from functools import wraps
 from shutil import rmtree
 from time import time, sleep
-import threading, sys
+from select import select
+import threading, tarfile, heapq, math, sys
 import json, os
 
-from flask import Flask, request, Response, current_app, jsonify, render_template
-from requests import get, post, ConnectionError
-from dateutil.tz import tzutc
-from psycopg2 import connect
-from boto import connect_sns
-from pq import PQ
+from ..lazy import LazyModule
 
-# Ask Python 2 to get real unicode from the database.
-# http://initd.org/psycopg/docs/usage.html#unicode-handling
-import psycopg2.extensions
-psycopg2.extensions.register_type(psycopg2.extensions.UNICODEARRAY)
-psycopg2.extensions.register_type(psycopg2.extensions.UNICODE)
+def _register_unicode(module):
+    ''' Ask Python 2 to get real unicode from the database.
+    
+        http://initd.org/psycopg/docs/usage.html#unicode-handling
+    '''
+    import psycopg2.extensions
+    psycopg2.extensions.register_type(psycopg2.extensions.UNICODEARRAY)
+    psycopg2.extensions.register_type(psycopg2.extensions.UNICODE)
+
+flask = LazyModule('flask')
+requests = LazyModule('requests')
+psycopg2 = LazyModule('psycopg2', _register_unicode)
+pq = LazyModule('pq')
 
 def load_config():
     def truthy(value):
@@ -51,21 +58,79 @@ def load_config():
 MAGIC_OK_MESSAGE = 'Everything is fine'
 TASK_QUEUE, DONE_QUEUE, DUE_QUEUE, HEARTBEAT_QUEUE = 'tasks', 'finished', 'due', 'heartbeat'
 
-# Additional delay after JOB_TIMEOUT for due tasks.
+# Separate lane for batch set tasks, so CI tasks in TASK_QUEUE don't wait behind them.
+BATCH_TASK_QUEUE = 'batch-tasks'
+
+# Most CI tasks a worker takes in a row while batch tasks are waiting.
+BATCH_FAIRNESS = 5
+
+# Recent successful runs considered for each source timeout, see get_source_timeout().
+SOURCE_TIMEOUT_HISTORY = 10
+
+# Percentile of recent run times, and multiple of it allowed for each source.
+SOURCE_TIMEOUT_PERCENTILE, SOURCE_TIMEOUT_FACTOR = 90, 3
+
+# Shortest timeout for any source; the longest is jobs.JOB_TIMEOUT.
+SOURCE_TIMEOUT_MIN = timedelta(minutes=30)
+
+# Multiple of a timed-out run's timeout given to the next run of its source.
+SOURCE_TIMEOUT_RETRY_FACTOR = 2
+
+# Multiple of expected run time before a batch run gets a speculative duplicate.
+SPECULATIVE_RUN_FACTOR = 1.5
+
+# Time between checks whether another attempt at a batch run has finished it.
+SPECULATIVE_CHECK_INTERVAL = timedelta(minutes=1)
+
+# Additional delay after a task timeout for due tasks.
 DUETASK_DELAY = timedelta(minutes=5)
 
 # Amount of time to reuse run results.
 RUN_REUSE_TIMEOUT = timedelta(days=5)
 
+# Source keys that must match to reuse cached data from a previous run.
+CACHE_REUSE_KEYS = 'data', 'type', 'compression'
+
 # Time to chill out in pop_task_from_taskqueue() after sending Done task.
 WORKER_COOLDOWN = timedelta(seconds=5)
 
+# Most done tasks to handle together in one pop_tasks_from_donequeue() transaction.
+DONE_BATCH_SIZE = 100
+
+# Time to wait for newer statuses to the same URL before posting one, see StatusDispatcher.
+STATUS_DEBOUNCE = timedelta(seconds=10)
+
+# Failed status posts are retried with exponential backoff, up to this long between tries.
+STATUS_MAX_BACKOFF = timedelta(minutes=5)
+STATUS_RETRIES = 8
+
+# Time to remember merge status of a commit before checking Github again.
+MERGE_STATUS_TTL = timedelta(minutes=5)
+
+# Most responses and merge statuses to remember from Github.
+GITHUB_CACHE_SIZE = 1000
+
+# Batch tasks to keep waiting in the queue for each active worker, see enqueue_sources().
+BATCH_QUEUE_DEPTH = 1
+
 # Time to chill out in find_batch_sources() after failing a request.
 GITHUB_RETRY_DELAY = timedelta(seconds=5)
 
+# Longest time to block waiting for a queue NOTIFY before checking anyway.
+QUEUE_POLL_INTERVAL = timedelta(seconds=15)
+
+# Channel for notifications that a run has been saved from the done queue.
+RUNS_CHANNEL = 'runs'
+
 # Time to wait between heartbeat pings from workers.
 HEARTBEAT_INTERVAL = timedelta(minutes=5)
 
+# Time without heartbeats before a worker is considered dead, see reap_dead_worker_tasks().
+DEAD_WORKER_TIMEOUT = HEARTBEAT_INTERVAL * 3
+
+# Times to retry a task whose worker died before giving up on it.
+DEAD_WORKER_RETRIES = 2
+
 # Valid worker kinds for heartbeats table.
 PERMANENT_KIND, TEMPORARY_KIND = 'permanent', 'temporary'
 
@@ -92,7 +157,7 @@ def get_touched_payload_files(payload):
             if filename in touched:
                 touched.remove(filename)
         
-    current_app.logger.debug(u'Touched files {}'.format(', '.join(touched)))
+    flask.current_app.logger.debug(u'Touched files {}'.format(', '.join(touched)))
     
     return touched
 
@@ -103,9 +168,9 @@ def get_touched_branch_files(payload, github_auth):
 
     compare1_url = payload['repository']['compare_url']
     compare1_url = expand_uri(compare1_url, dict(base='master', head=branch_sha))
-    current_app.logger.debug('Compare URL 1 {}'.format(compare1_url))
+    flask.current_app.logger.debug('Compare URL 1 {}'.format(compare1_url))
     
-    compare1 = get(compare1_url, auth=github_auth).json()
+    compare1 = requests.get(compare1_url, auth=github_auth).json()
     merge_base_sha = compare1['merge_base_commit']['sha']
     
     # That's no branch.
@@ -114,11 +179,11 @@ def get_touched_branch_files(payload, github_auth):
 
     compare2_url = payload['repository']['compare_url']
     compare2_url = expand_uri(compare2_url, dict(base=merge_base_sha, head=branch_sha))
-    current_app.logger.debug('Compare URL 2 {}'.format(compare2_url))
+    flask.current_app.logger.debug('Compare URL 2 {}'.format(compare2_url))
     
-    compare2 = get(compare2_url, auth=github_auth).json()
+    compare2 = requests.get(compare2_url, auth=github_auth).json()
     touched = set([file['filename'] for file in compare2['files']])
-    current_app.logger.debug(u'Touched files {}'.format(', '.join(touched)))
+    flask.current_app.logger.debug(u'Touched files {}'.format(', '.join(touched)))
     
     return touched
 
@@ -133,11 +198,11 @@ def get_touched_pullrequest_files(payload, github_auth):
 
     compare_url = payload['pull_request']['head']['repo']['compare_url']
     compare_url = expand_uri(compare_url, dict(head=head_sha, base=base_sha))
-    current_app.logger.debug('Compare URL {}'.format(compare_url))
+    flask.current_app.logger.debug('Compare URL {}'.format(compare_url))
     
-    compare = get(compare_url, auth=github_auth).json()
+    compare = requests.get(compare_url, auth=github_auth).json()
     touched = set([file['filename'] for file in compare['files']])
-    current_app.logger.debug(u'Touched files {}'.format(', '.join(touched)))
+    flask.current_app.logger.debug(u'Touched files {}'.format(', '.join(touched)))
     
     return touched
 
@@ -185,19 +250,19 @@ def process_pullrequest_payload_files(payload, github_auth):
 
         contents_url = payload['pull_request']['head']['repo']['contents_url'] + '{?ref}'
         contents_url = expand_uri(contents_url, dict(path=filename, ref=commit_sha))
-        current_app.logger.debug('Contents URL {}'.format(contents_url))
+        flask.current_app.logger.debug('Contents URL {}'.format(contents_url))
         
-        got = get(contents_url, auth=github_auth)
+        got = requests.get(contents_url, auth=github_auth)
         contents = got.json()
         
         if got.status_code not in range(200, 299):
-            current_app.logger.warning('Skipping {} - {}'.format(filename, got.status_code))
+            flask.current_app.logger.warning('Skipping {} - {}'.format(filename, got.status_code))
             continue
         
         if contents['encoding'] != 'base64':
             raise ValueError('Unrecognized encoding "{encoding}"'.format(**contents))
         
-        current_app.logger.debug('Contents SHA {sha}'.format(**contents))
+        flask.current_app.logger.debug('Contents SHA {sha}'.format(**contents))
         files[filename] = contents['content'], contents['sha']
     
     return files
@@ -224,19 +289,19 @@ def process_pushevent_payload_files(payload, github_auth):
         
         contents_url = payload['repository']['contents_url'] + '{?ref}'
         contents_url = expand_uri(contents_url, dict(path=filename, ref=commit_sha))
-        current_app.logger.debug('Contents URL {}'.format(contents_url))
+        flask.current_app.logger.debug('Contents URL {}'.format(contents_url))
         
-        got = get(contents_url, auth=github_auth)
+        got = requests.get(contents_url, auth=github_auth)
         contents = got.json()
         
         if got.status_code not in range(200, 299):
-            current_app.logger.warning('Skipping {} - {}'.format(filename, got.status_code))
+            flask.current_app.logger.warning('Skipping {} - {}'.format(filename, got.status_code))
             continue
         
         if contents['encoding'] != 'base64':
             raise ValueError('Unrecognized encoding "{encoding}"'.format(**contents))
         
-        current_app.logger.debug('Contents SHA {sha}'.format(**contents))
+        flask.current_app.logger.debug('Contents SHA {sha}'.format(**contents))
         files[filename] = contents['content'], contents['sha']
     
     return files
@@ -267,8 +332,21 @@ def get_commit_info(app, payload):
     
     return owner, repository, commit_sha, status_url
 
+def get_payload_ref(payload):
+    ''' Return a name for the pull request or branch of a webhook payload.
+    
+        Later commits to the same ref supersede earlier ones.
+    '''
+    if 'pull_request' in payload:
+        return u'pull/{}'.format(payload['pull_request']['number'])
+    
+    return payload.get('ref')
+
 def post_github_status(status_url, status_json, github_auth):
     ''' POST status JSON to Github status API.
+    
+        Hands off to the status dispatcher instead if there is one,
+        see set_status_dispatcher().
     '''
     if status_url is None:
         return
@@ -276,15 +354,149 @@ def post_github_status(status_url, status_json, github_auth):
     # Github only wants 140 chars of description.
     status_json['description'] = status_json['description'][:140]
     
-    posted = post(status_url, data=json.dumps(status_json), auth=github_auth,
-                  headers={'Content-Type': 'application/json'})
+    if _status_dispatcher['dispatcher'] is not None:
+        return _status_dispatcher['dispatcher'].put(status_url, status_json, github_auth)
     
+    posted = _send_github_status(status_url, status_json, github_auth)
+    _check_github_status(posted, status_url, status_json)
+
+def _send_github_status(status_url, status_json, github_auth):
+    return requests.post(status_url, data=json.dumps(status_json), auth=github_auth,
+                         headers={'Content-Type': 'application/json'})
+
+def _check_github_status(posted, status_url, status_json):
     if posted.status_code not in range(200, 299):
         raise ValueError('Failed status post to {}'.format(status_url))
     
     if posted.json()['state'] != status_json['state']:
         raise ValueError('Mismatched status post to {}'.format(status_url))
 
+# Optional StatusDispatcher used by post_github_status(), see set_status_dispatcher().
+_status_dispatcher = {'dispatcher': None}
+
+def set_status_dispatcher(dispatcher):
+    ''' Send Github statuses in this process through dispatcher, or directly if None.
+    '''
+    _status_dispatcher['dispatcher'] = dispatcher
+
+class StatusDispatcher:
+    ''' Posts Github statuses from a background thread.
+    
+        Statuses to the same URL within STATUS_DEBOUNCE of the first are
+        coalesced, and only the latest one is posted. Failed posts are
+        retried with exponential backoff, and posting waits for the reset
+        when Github's X-RateLimit-Remaining header runs out.
+    '''
+    def __init__(self):
+        # Status URL -> [post time, status JSON, Github auth, attempts]
+        self.pending = OrderedDict()
+        self.condition = threading.Condition()
+        self.rate_limit_reset = 0
+        self.flushing = False
+        self.busy = False
+        
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def put(self, status_url, status_json, github_auth):
+        ''' Queue a status to be posted, replacing any not yet posted for status_url.
+        '''
+        with self.condition:
+            if status_url in self.pending:
+                self.pending[status_url][1:3] = status_json, github_auth
+            else:
+                debounce = STATUS_DEBOUNCE.seconds + STATUS_DEBOUNCE.days * 86400
+                self.pending[status_url] = [time() + debounce, status_json, github_auth, 0]
+        
+            self.condition.notify()
+    
+    def flush(self, timeout=None):
+        ''' Post all queued statuses without waiting out the debounce.
+        
+            Return True if everything was posted before timeout.
+        '''
+        deadline = None if timeout is None else time() + timeout
+        
+        with self.condition:
+            self.flushing = True
+            self.condition.notify()
+            
+            try:
+                while self.pending or self.busy:
+                    if deadline is None:
+                        self.condition.wait(1)
+                    elif time() < deadline:
+                        self.condition.wait(deadline - time())
+                    else:
+                        return False
+            finally:
+                self.flushing = False
+        
+        return True
+    
+    def _next_status(self):
+        ''' Wait for the next status due to be posted, return it with its URL.
+        '''
+        with self.condition:
+            while True:
+                if self.pending:
+                    status_url, (post_time, status_json, github_auth, attempts) \
+                        = min(self.pending.items(), key=lambda item: item[1][0])
+                    
+                    post_time = max(self.rate_limit_reset, time() if self.flushing else post_time)
+                    
+                    if post_time <= time():
+                        del self.pending[status_url]
+                        self.busy = True
+                        return status_url, status_json, github_auth, attempts
+                    
+                    self.condition.wait(post_time - time())
+                else:
+                    self.condition.wait()
+    
+    def _run(self):
+        while True:
+            status_url, status_json, github_auth, attempts = self._next_status()
+            
+            try:
+                posted = _send_github_status(status_url, status_json, github_auth)
+                self._note_rate_limit(posted)
+                _check_github_status(posted, status_url, status_json)
+            except Exception as e:
+                self._retry(status_url, status_json, github_auth, attempts + 1, e)
+            finally:
+                with self.condition:
+                    self.busy = False
+                    self.condition.notify_all()
+    
+    def _note_rate_limit(self, posted):
+        ''' Pause posting until the reset time if no requests remain.
+        '''
+        remaining = posted.headers.get('X-RateLimit-Remaining')
+        reset = posted.headers.get('X-RateLimit-Reset')
+        
+        if remaining is not None and reset is not None and int(remaining) <= 0:
+            _L.warning('Out of Github requests until {}'.format(reset))
+            
+            with self.condition:
+                self.rate_limit_reset = int(reset)
+    
+    def _retry(self, status_url, status_json, github_auth, attempts, error):
+        ''' Queue a failed status again after a backoff, unless a newer one is waiting.
+        '''
+        if attempts >= STATUS_RETRIES:
+            _L.error('Giving up on status post to {} after {} tries: {}'.format(status_url, attempts, error))
+            return
+        
+        max_backoff = STATUS_MAX_BACKOFF.seconds + STATUS_MAX_BACKOFF.days * 86400
+        backoff = min(2 ** attempts, max_backoff)
+        _L.warning('Retrying status post to {} in {}s: {}'.format(status_url, backoff, error))
+        
+        with self.condition:
+            if status_url not in self.pending:
+                self.pending[status_url] = [time() + backoff, status_json, github_auth, attempts]
+
 def update_pending_status(status_url, job_url, filenames, github_auth):
     ''' Push pending status for head commit to Github status API.
     '''
@@ -328,6 +540,15 @@ def update_success_status(status_url, job_url, filenames, github_auth):
     
     return post_github_status(status_url, status, github_auth)
 
+def update_superseded_status(status_url, job_url, commit_sha, github_auth):
+    ''' Push superseded status for an earlier commit to Github status API.
+    '''
+    status = dict(context='openaddresses/hooked', state='error',
+                  description=u'Superseded by {}'.format(commit_sha[:7]),
+                  target_url=job_url)
+    
+    return post_github_status(status_url, status, github_auth)
+
 def find_batch_sources(owner, repository, github_auth, run_times={}):
     ''' Starting with a Github repo API URL, generate a stream of master sources.
     
@@ -337,24 +558,61 @@ def find_batch_sources(owner, repository, github_auth, run_times={}):
         - path: path of source JSON in OA git repo.
         - commit_sha: commit hash in OA git repo.
         - blob_sha: blob hash in OA git repo.
+        - run_time: seconds taken by the previous run, or None if unknown.
         - remain: count of sources to come
+    
+        Sources come from one git tree listing and one tarball download
+        where possible, with contents API requests for anything missing.
     '''
-    source_urls = list(_find_batch_source_urls(owner, repository, github_auth))
+    source_urls, contents = list_batch_source_urls(owner, repository, github_auth, run_times)
+    return iterate_batch_sources(source_urls, contents, github_auth)
+
+def list_batch_source_urls(owner, repository, github_auth, run_times={}):
+    ''' Return a list of master source URLs and a dictionary of known contents.
     
-    # sort with the shortest known runs at the end, keeping the 9999's alphabetical.
+        Source URLs are dicts like those from find_batch_sources() without
+        content, ordered longest known runs first after unknown ones.
+        Contents are base 64 source JSON keyed by blob hash.
+    '''
+    try:
+        source_urls, contents = _find_batch_source_archive(owner, repository, github_auth)
+    except Exception as e:
+        _L.warning('Falling back to contents API for batch sources: {}'.format(e))
+        source_urls, contents = list(_find_batch_source_urls(owner, repository, github_auth)), {}
+    
+    for source_url in source_urls:
+        source_url.update(run_time=run_times.get(source_url['path']))
+    
+    # sort longest known runs first after unknown ones, keeping ties alphabetical.
     source_urls.sort(key=lambda su: su['path'])
-    source_urls.sort(key=lambda su: (run_times.get(su['path']) or '9999'), reverse=True)
+    source_urls.sort(key=lambda su: float('inf') if su['run_time'] is None else su['run_time'], reverse=True)
+    
+    return source_urls, contents
+
+def iterate_batch_sources(source_urls, contents, github_auth):
+    ''' Generate sources from list_batch_source_urls() output, in order.
     
+        Sources missing from contents are requested from the contents API
+        one at a time, only as they're needed.
+    '''
     for (index, source_url) in enumerate(source_urls):
+        if source_url['blob_sha'] in contents:
+            source = dict(content=contents[source_url['blob_sha']])
+            source.update(remain=len(source_urls) - index - 1)
+            source.update(source_url)
+            
+            yield source
+            continue
+    
         _L.debug('Getting source {url}'.format(**source_url))
         try:
-            more_source = get(source_url['url'], auth=github_auth).json()
-        except ConnectionError:
+            more_source = requests.get(source_url['url'], auth=github_auth).json()
+        except requests.ConnectionError:
             _L.info('Retrying to download {url}'.format(**source))
             try:
                 sleep(GITHUB_RETRY_DELAY.seconds + GITHUB_RETRY_DELAY.days * 86400)
-                more_source = get(source_url['url'], auth=github_auth).json()
-            except ConnectionError:
+                more_source = requests.get(source_url['url'], auth=github_auth).json()
+            except requests.ConnectionError:
                 _L.error('Failed to download {url}'.format(**source_url))
                 raise
 
@@ -365,42 +623,163 @@ def find_batch_sources(owner, repository, github_auth, run_times={}):
         yield source
 
 def get_batch_run_times(db, owner, repository):
-    ''' Return dictionary of source paths to run time strings like '00:01:23'.
+    ''' Return dictionary of source paths to seconds taken by their latest runs.
+    
+        Run time is cache time plus process time, or None if process time is unknown.
     '''
     last_set = objects.read_latest_set(db, owner, repository)
 
-    return {run.source_path: run.state.process_time
+    return {run.source_path: _run_seconds(run.state.cache_time, run.state.process_time)
             for run in objects.read_completed_runs_to_date(db, last_set.id)
             if run.state}
 
-def _find_batch_source_urls(owner, repository, github_auth):
-    ''' Starting with a Github repo API URL, return a list of sources.
+def _run_seconds(cache_time, process_time):
+    ''' Return total seconds for cache and process time strings, or None.
+    '''
+    process_seconds = jobs.parse_process_time(process_time)
     
-        Sources are dictionaries, with keys commit_sha, url to content on Github,
-        blob_sha for git blob, and path like 'sources/xx/yy.json'.
+    if process_seconds is None:
+        return None
+    
+    return process_seconds + (jobs.parse_process_time(cache_time) or 0)
+
+def estimate_source_timeout(run_times):
+    ''' Return timeout in seconds for a list of past source run times in seconds.
+    
+        Return None if there are no past run times.
+    '''
+    if not run_times:
+        return None
+    
+    ordered = sorted(run_times)
+    index = int(math.ceil(len(ordered) * SOURCE_TIMEOUT_PERCENTILE / 100.)) - 1
+    timeout = ordered[max(index, 0)] * SOURCE_TIMEOUT_FACTOR
+
+    shortest = SOURCE_TIMEOUT_MIN.seconds + SOURCE_TIMEOUT_MIN.days * 86400
+    longest = jobs.JOB_TIMEOUT.seconds + jobs.JOB_TIMEOUT.days * 86400
+    
+    return int(min(max(timeout, shortest), longest))
+
+def get_source_timeout(db, source_path):
+    ''' Return timeout in seconds based on recent runs of a source, or None.
+    
+        If the latest run timed out, the next one gets SOURCE_TIMEOUT_RETRY_FACTOR
+        times as long, up to jobs.JOB_TIMEOUT.
     '''
-    resp = get('https://api.github.com/', auth=github_auth)
+    latest_run = objects.read_latest_source_run_state(db, source_path)
+    
+    if latest_run is not None:
+        status, state = latest_run
+        
+        if status is False and state.timeout is not None:
+            longest = jobs.JOB_TIMEOUT.seconds + jobs.JOB_TIMEOUT.days * 86400
+            return int(min(state.timeout * SOURCE_TIMEOUT_RETRY_FACTOR, longest))
+    
+    run_times = list()
+    recent = objects.read_source_run_times(db, source_path, SOURCE_TIMEOUT_HISTORY)
+    
+    for (cache_time, process_time) in recent:
+        run_seconds = _run_seconds(cache_time, process_time)
+        if run_seconds is not None:
+            run_times.append(run_seconds)
+    
+    return estimate_source_timeout(run_times)
+
+def _find_batch_commit(owner, repository, github_auth):
+    ''' Return Github API repository and latest default branch commit dictionaries.
+    '''
+    resp = requests.get('https://api.github.com/', auth=github_auth)
     if resp.status_code >= 400:
         raise Exception('Got status {} from Github API'.format(resp.status_code))
     start_url = expand_uri(resp.json()['repository_url'], dict(owner=owner, repo=repository))
     
     _L.info('Starting batch sources at {start_url}'.format(**locals()))
-    got = get(start_url, auth=github_auth).json()
-    contents_url, commits_url = got['contents_url'], got['commits_url']
+    repo = requests.get(start_url, auth=github_auth).json()
+    master_url = expand_uri(repo['commits_url'], dict(sha=repo['default_branch']))
 
-    master_url = expand_uri(commits_url, dict(sha=got['default_branch']))
+    _L.debug('Getting {ref} branch {master_url}'.format(ref=repo['default_branch'], **locals()))
+    commit = requests.get(master_url, auth=github_auth).json()
+    
+    return repo, commit
 
-    _L.debug('Getting {ref} branch {master_url}'.format(ref=got['default_branch'], **locals()))
-    got = get(master_url, auth=github_auth).json()
-    commit_sha, commit_date = got['sha'], got['commit']['committer']['date']
+def _find_batch_source_archive(owner, repository, github_auth):
+    ''' Starting with a Github repo API URL, return a list of sources and their contents.
+    
+        Sources are like those from _find_batch_source_urls(), but are listed
+        from one recursive git tree request. Contents are base64 strings
+        from one tarball download, keyed by blob_sha.
+    '''
+    repo, commit = _find_batch_commit(owner, repository, github_auth)
+    commit_sha, tree_sha = commit['sha'], commit['commit']['tree']['sha']
+    
+    tree_url = expand_uri(repo['trees_url'], dict(sha=tree_sha))
+    _L.debug('Getting tree {tree_url}'.format(**locals()))
+    
+    got = requests.get(tree_url, params=dict(recursive=1), auth=github_auth)
+    if got.status_code >= 400:
+        raise Exception('Got status {} from Github tree API'.format(got.status_code))
     
-    contents_url += '{?ref}' # So that we are consistently at the same commit.
+    tree = got.json()
+    if tree.get('truncated'):
+        raise Exception('Got truncated tree from Github tree API')
+
+    contents_url = repo['contents_url'] + '{?ref}' # So that we are consistently at the same commit.
+    sources_list = list()
+
+    for item in tree['tree']:
+        if item['type'] != 'blob' or relpath(item['path'], 'sources').startswith('..'):
+            continue
+        
+        if splitext(item['path'])[1] == '.json':
+            url = expand_uri(contents_url, dict(path=item['path'], ref=commit_sha))
+            sources_list.append(dict(commit_sha=commit_sha, url=url,
+                                     blob_sha=item['sha'], path=item['path']))
+    
+    archive_url = expand_uri(repo['archive_url'], dict(archive_format='tarball', ref=commit_sha))
+    _L.debug('Getting tarball {archive_url}'.format(**locals()))
+    
+    got = requests.get(archive_url, auth=github_auth)
+    if got.status_code >= 400:
+        raise Exception('Got status {} from Github archive API'.format(got.status_code))
+    
+    blob_shas = {source['path']: source['blob_sha'] for source in sources_list}
+    contents = dict()
+    
+    with tarfile.open(fileobj=BytesIO(got.content), mode='r:gz') as archive:
+        for member in archive:
+            # Tarball paths start with a directory named for the repository and commit.
+            _, _, path = member.name.partition('/')
+            
+            if not member.isfile() or path not in blob_shas:
+                continue
+            
+            content = archive.extractfile(member).read()
+            git_header = 'blob {}\0'.format(len(content)).encode('ascii')
+            
+            # Skip anything that doesn't match the tree, to be requested separately.
+            if sha1(git_header + content).hexdigest() == blob_shas[path]:
+                contents[blob_shas[path]] = b64encode(content).decode('ascii')
+    
+    _L.info('Found {} batch sources, {} in tarball'.format(len(sources_list), len(contents)))
+    
+    return sources_list, contents
+
+def _find_batch_source_urls(owner, repository, github_auth):
+    ''' Starting with a Github repo API URL, return a list of sources.
+    
+        Sources are dictionaries, with keys commit_sha, url to content on Github,
+        blob_sha for git blob, and path like 'sources/xx/yy.json'.
+    '''
+    repo, commit = _find_batch_commit(owner, repository, github_auth)
+    commit_sha = commit['sha']
+    
+    contents_url = repo['contents_url'] + '{?ref}' # So that we are consistently at the same commit.
     sources_urls = [expand_uri(contents_url, dict(path='sources', ref=commit_sha))]
     sources_list = list()
 
     for sources_url in sources_urls:
         _L.debug('Getting sources {sources_url}'.format(**locals()))
-        sources = get(sources_url, auth=github_auth).json()
+        sources = requests.get(sources_url, auth=github_auth).json()
     
         for source in sources:
             if source['type'] == 'dir':
@@ -421,15 +800,18 @@ def _find_batch_source_urls(owner, repository, github_auth):
 
 def enqueue_sources(queue, the_set, sources):
     ''' Batch task generator, yields counts of remaining expected paths.
+    
+        Keeps BATCH_QUEUE_DEPTH waiting tasks in the queue for each
+        recently-active worker, so none of them sit idle.
     '''
-    expected_paths = set()
+    expected_paths, run_times, speculated = set(), dict(), set()
     commit_sha = None
     
     #
-    # Enqueue each source if there is nothing else in the queue.
+    # Enqueue each source if the queue is not already deep enough.
     #
     for source in sources:
-        while len(queue) >= 1:
+        while len(queue) >= get_batch_queue_depth(queue):
             yield len(expected_paths)
         
         with queue as db:
@@ -438,15 +820,21 @@ def enqueue_sources(queue, the_set, sources):
                              name=source['path'],
                              content_b64=source['content'],
                              commit_sha=source['commit_sha'],
-                             file_id=source['blob_sha'])
+                             file_id=source['blob_sha'],
+                             timeout=get_source_timeout(db, source['path']))
         
             task_id = queue.put(task_data)
             expected_paths.add(source['path'])
+            run_times[source['path']] = source.get('run_time')
             commit_sha = source['commit_sha']
     
     while len(expected_paths):
         with queue as db:
             _update_expected_paths(db, expected_paths, the_set)
+        
+        if len(queue) == 0:
+            # Nothing left to hand out, so give idle workers the stragglers.
+            speculate_batch_runs(queue, the_set, run_times, speculated)
 
         yield len(expected_paths)
 
@@ -455,6 +843,78 @@ def enqueue_sources(queue, the_set, sources):
 
     yield 0
 
+def get_batch_queue_depth(queue):
+    ''' Return number of batch tasks to keep waiting in the queue.
+    '''
+    with queue as db:
+        workers_n = sum(map(len, get_recent_workers(db).values()))
+    
+    return max(1, workers_n * BATCH_QUEUE_DEPTH)
+
+def project_batch_time(run_times, workers_n):
+    ''' Return projected seconds to run sources with workers, given in order.
+    
+        Each run time goes to the next free worker, like tasks from the queue.
+        Unknown run times are guessed to be the average of the known ones.
+    '''
+    known_times = [run_time for run_time in run_times if run_time is not None]
+    guess = sum(known_times) / len(known_times) if known_times else 0
+    free_times = [0] * max(1, workers_n)
+    
+    for run_time in run_times:
+        free_time = heapq.heappop(free_times)
+        heapq.heappush(free_times, free_time + (guess if run_time is None else run_time))
+    
+    return max(free_times)
+
+def speculate_batch_runs(queue, the_set, run_times, speculated):
+    ''' Send duplicate tasks for slow runs in a set to idle workers.
+    
+        Runs taking SPECULATIVE_RUN_FACTOR times longer than the source's
+        previous run time in run_times get one duplicate, sharing the run ID.
+        Elapsed time counts from when the run was queued, so run times must
+        include cache time as well as process time, like get_batch_run_times().
+        Speculated run IDs are added to the set. Return number of tasks sent.
+    '''
+    with queue as db:
+        workers_n = sum(map(len, get_recent_workers(db).values()))
+        
+        # Due tasks are sent when runs are reserved, and hold the original task.
+        db.execute('''SELECT q.data, EXTRACT(EPOCH FROM NOW() - q.enqueued_at)
+                      FROM queue AS q
+                      JOIN runs AS r ON r.id = (q.data->>'run_id')::integer
+                      WHERE q.q_name = %s AND q.dequeued_at IS NULL
+                        AND (q.data->>'set_id')::integer = %s
+                        AND q.data->>'speculative' IS NULL
+                        AND r.status IS NULL
+                      ORDER BY q.enqueued_at''',
+                   (DUE_QUEUE, the_set.id))
+        
+        running = db.fetchall()
+    
+    # Every unfinished run and its duplicate keeps a worker busy.
+    busy_n = sum([2 if data['run_id'] in speculated else 1 for (data, _) in running])
+    idle_n, sent_n = workers_n - busy_n, 0
+    
+    for (data, elapsed) in running:
+        if idle_n <= 0:
+            break
+        
+        run_time = run_times.get(data['name'])
+        
+        if data['run_id'] in speculated or run_time is None:
+            continue
+        
+        if elapsed < run_time * SPECULATIVE_RUN_FACTOR:
+            continue
+        
+        _L.info(u'Sending duplicate of slow run {run_id} for {name} to task queue'.format(**data))
+        queue.put(dict(data['task_data'], speculative_run_id=data['run_id']))
+        speculated.add(data['run_id'])
+        idle_n, sent_n = idle_n - 1, sent_n + 1
+    
+    return sent_n
+
 def _update_expected_paths(db, expected_paths, the_set):
     ''' Discard sources from expected_paths set as they appear in runs table.
     '''
@@ -542,8 +1002,11 @@ def calculate_job_id(files):
     
     return job_id
 
-def create_queued_job(queue, files, job_url_template, commit_sha, owner, repo, status_url):
+def create_queued_job(queue, files, job_url_template, commit_sha, owner, repo, status_url,
+                      ref=None, github_auth=None):
     ''' Create a new job, and add its files to the queue.
+    
+        If ref is given, earlier jobs for other commits to it are superseded.
     '''
     filenames = list(files.keys())
     file_states = {name: None for name in filenames}
@@ -554,20 +1017,57 @@ def create_queued_job(queue, files, job_url_template, commit_sha, owner, repo, s
     job_status = None
 
     with queue as db:
-        task_files = add_files_to_queue(queue, job_id, job_url, files, commit_sha)
+        timeouts = {name: get_source_timeout(db, name) for name in filenames}
+        task_files = add_files_to_queue(queue, job_id, job_url, files, commit_sha, timeouts)
         add_job(db, job_id, None, task_files, file_states, file_results, owner, repo, status_url)
+        
+        if ref is not None:
+            supersede_jobs(db, job_id, job_url_template, owner, repo, ref, commit_sha, github_auth)
     
     return job_id
 
-def add_files_to_queue(queue, job_id, job_url, files, commit_sha):
+def supersede_jobs(db, job_id, job_url_template, owner, repo, ref, commit_sha, github_auth):
+    ''' Cancel earlier jobs for the same ref at other commits.
+    
+        Their files that haven't run yet are marked failed, and their waiting
+        tasks will be skipped by pop_task_from_taskqueue().
+    '''
+    for old_job_id in objects.add_job_ref(db, job_id, owner, repo, ref, commit_sha):
+        job = read_job(db, old_job_id)
+        
+        if job is None or None not in job.states.values():
+            # Finished jobs can stay as they are.
+            continue
+        
+        _L.info(u'Job {} for {} superseded by {}'.format(job.id, ref, commit_sha))
+        
+        for (filename, state) in job.states.items():
+            if state is None:
+                job.states[filename] = False
+                job.file_results[filename] = dict(message=u'Superseded by {}'.format(commit_sha))
+        
+        job.status = False
+        
+        write_job(db, job.id, job.status, job.task_files, job.states, job.file_results,
+                  job.github_owner, job.github_repository, job.github_status_url)
+        
+        try:
+            job_url = job_url_template and expand_uri(job_url_template, dict(id=job.id))
+            update_superseded_status(job.github_status_url, job_url, commit_sha, github_auth)
+        except Exception as e:
+            _L.warning('Failed to post superseded status for job {}: {}'.format(job.id, e))
+
+def add_files_to_queue(queue, job_id, job_url, files, commit_sha, timeouts={}):
     ''' Make a new task for each file, return dict of file IDs to file names.
+    
+        Optional timeouts dictionary has seconds allowed for each file name.
     '''
     tasks = {}
     
     for (file_name, (content_b64, file_id)) in files.items():
         task_data = dict(job_id=job_id, url=job_url, name=file_name,
                          content_b64=content_b64, file_id=file_id,
-                         commit_sha=commit_sha)
+                         commit_sha=commit_sha, timeout=timeouts.get(file_name))
     
         # Spread tasks out over time.
         delay = timedelta(seconds=len(tasks))
@@ -580,6 +1080,8 @@ def add_files_to_queue(queue, job_id, job_url, files, commit_sha):
 def is_completed_run(db, run_id, min_datetime):
     '''
     '''
+    from dateutil.tz import tzutc
+
     if min_datetime.tzinfo:
         # Convert known time zones to UTC.
         min_dtz = min_datetime.astimezone(tzutc())
@@ -599,17 +1101,27 @@ def is_completed_run(db, run_id, min_datetime):
 def update_job_status(db, job_id, job_url, filename, run_status, results, github_auth):
     '''
     '''
+    file_statuses = {filename: (run_status, results)}
+    update_job_statuses(db, job_id, job_url, file_statuses, github_auth)
+
+def update_job_statuses(db, job_id, job_url, file_statuses, github_auth):
+    ''' Update a job with new (run status, results) for each of several files.
+    
+        Job is written and its Github status is posted just once.
+    '''
     try:
         job = read_job(db, job_id)
     except TypeError:
         raise Exception('Job {} not found'.format(job_id))
 
-    if filename not in job.states:
-        raise Exception('Unknown file from job {}: "{}"'.format(job.id, filename))
+    for (filename, (run_status, results)) in file_statuses.items():
+        if filename not in job.states:
+            raise Exception('Unknown file from job {}: "{}"'.format(job.id, filename))
+    
+        job.states[filename] = run_status
+        job.file_results[filename] = results
     
     filenames = list(job.task_files.values())
-    job.states[filename] = run_status
-    job.file_results[filename] = results
     
     # Update job status.
 
@@ -628,6 +1140,10 @@ def update_job_status(db, job_id, job_url, filename, run_status, results, github
         _L.warning('No status_url to tell about {} status of job {}'.format(job.status, job.id))
         return
     
+    if objects.read_job_superseded_by(db, job.id):
+        # Leave the superseded status in place on Github.
+        return
+    
     if job.status is False:
         bad_files = [name for (name, state) in job.states.items() if state is False]
         update_failing_status(job.github_status_url, job_url, bad_files, filenames, github_auth)
@@ -652,28 +1168,109 @@ def is_merged_to_master(db, set_id, job_id, commit_sha, github_auth):
         # Missing set and job means unknown merge status.
         return None
     
-    try:
-        template1 = get('https://api.github.com/', auth=github_auth).json().get('repository_url')
-        repo_url = expand_uri(template1, dict(owner=job.github_owner, repo=job.github_repository))
+    key = job.github_owner, job.github_repository, commit_sha
     
-        template2 = get(repo_url, auth=github_auth).json().get('compare_url')
-        compare_url = expand_uri(template2, dict(base=commit_sha, head='master'))
+    if key in _merge_status_cache and _merge_status_cache[key][0] > time():
+        return _merge_status_cache[key][1]
     
-        compare = get(compare_url, auth=github_auth).json()
-        return compare['base_commit']['sha'] == compare['merge_base_commit']['sha']
+    try:
+        template = _get_compare_template(job.github_owner, job.github_repository, github_auth)
+        compare_url = expand_uri(template, dict(base=commit_sha, head='master'))
+    
+        compare = _get_github_json(compare_url, github_auth)
+        is_merged = compare['base_commit']['sha'] == compare['merge_base_commit']['sha']
 
     except Exception as e:
         _L.error('Failed to check merged status of {}/{} {}: {}'\
             .format(job.github_owner, job.github_repository, commit_sha, e))
         return None
+    
+    ttl = MERGE_STATUS_TTL.seconds + MERGE_STATUS_TTL.days * 86400
+    _merge_status_cache[key] = time() + ttl, is_merged
+    _trim_cache(_merge_status_cache)
+
+    return is_merged
+
+# Merge status by (owner, repository, commit_sha), see is_merged_to_master().
+_merge_status_cache = OrderedDict()
+
+# Github compare URL templates by (owner, repository), see _get_compare_template().
+_github_templates = dict()
+
+# Github API JSON responses with their ETags by URL, see _get_github_json().
+_github_etag_cache = OrderedDict()
+
+def _get_compare_template(owner, repository, github_auth):
+    ''' Return the Github compare URL template for a repository.
+    
+        Templates don't change, so they are only looked up once.
+    '''
+    if (owner, repository) not in _github_templates:
+        template = _get_github_json('https://api.github.com/', github_auth).get('repository_url')
+        repo_url = expand_uri(template, dict(owner=owner, repo=repository))
+        compare_url = _get_github_json(repo_url, github_auth).get('compare_url')
+        
+        if compare_url is None:
+            raise ValueError('Missing compare_url for {}/{}'.format(owner, repository))
+        
+        _github_templates[(owner, repository)] = compare_url
+    
+    return _github_templates[(owner, repository)]
+
+def _get_github_json(url, github_auth):
+    ''' GET JSON from Github API, revalidating earlier responses with ETags.
+    
+        Github doesn't count 304 Not Modified responses against the rate limit.
+    '''
+    headers = dict()
+    
+    if url in _github_etag_cache:
+        headers['If-None-Match'] = _github_etag_cache[url][0]
+    
+    got = requests.get(url, auth=github_auth, headers=headers)
+    
+    if got.status_code == 304 and url in _github_etag_cache:
+        return _github_etag_cache[url][1]
+    
+    data = got.json()
+    
+    if got.status_code in range(200, 299) and got.headers.get('ETag'):
+        _github_etag_cache[url] = got.headers['ETag'], data
+        _trim_cache(_github_etag_cache)
+    
+    return data
+
+def _trim_cache(cache):
+    ''' Drop the oldest entries from an OrderedDict cache over GITHUB_CACHE_SIZE.
+    '''
+    while len(cache) > GITHUB_CACHE_SIZE:
+        cache.popitem(last=False)
+
+# Slot number of this process in a multi-slot worker, see set_worker_slot().
+_worker_slot = {'slot': None}
+
+def set_worker_slot(slot):
+    ''' Give this process a worker slot number, to be added to its worker ID.
+    '''
+    _worker_slot['slot'] = slot
 
 def _worker_id():
-    return hex(getnode()).rstrip('L')
+    worker_id = hex(getnode()).rstrip('L')
+
+    if _worker_slot['slot'] is None:
+        return worker_id
+
+    return '{}-{}'.format(worker_id, _worker_slot['slot'])
 
-def _wait_for_work_lock(lock, heartbeat_queue, worker_kind):
+def _wait_for_work_lock(lock, heartbeat_queue, worker_kind, run_id=None, cancelled=None):
     ''' Wait around for worker while sending heartbeat pings.
+    
+        If cancelled threading.Event is given, set it once another attempt
+        has finished run_id, so the worker can stop its own job early.
     '''
     next_put = time()
+    check_interval = SPECULATIVE_CHECK_INTERVAL.seconds + SPECULATIVE_CHECK_INTERVAL.days * 86400
+    next_check = time() + check_interval
 
     while True:
         sleep(.1)
@@ -686,24 +1283,165 @@ def _wait_for_work_lock(lock, heartbeat_queue, worker_kind):
             # Keep this put() outside the lock, so threads don't confuse Postgres.
             heartbeat_queue.put({'worker_id': _worker_id(), 'worker_kind': worker_kind})
             next_put += HEARTBEAT_INTERVAL.seconds + HEARTBEAT_INTERVAL.days * 86400
+        
+        if cancelled is not None and not cancelled.is_set() and time() > next_check:
+            with heartbeat_queue as db:
+                run = objects.read_run(db, run_id)
+            
+            if run is not None and run.status is not None:
+                _L.info(u'Run {} was finished by another attempt, cancelling'.format(run_id))
+                cancelled.set()
+            
+            next_check += check_interval
 
-def pop_task_from_taskqueue(s3, task_queue, done_queue, due_queue, heartbeat_queue, output_dir, worker_kind):
+def listen_to_queues(conn, *names):
+    ''' Subscribe connection to NOTIFY messages for named queues or channels.
+    
+        PQ's insert trigger sends a NOTIFY on the queue name with each put().
+    '''
+    with conn.cursor() as db:
+        for name in names:
+            db.execute('LISTEN "{}"'.format(name))
+    
+    # LISTEN only takes effect once committed.
+    conn.commit()
+
+def unlisten_from_queues(conn, *names):
+    ''' Unsubscribe connection from named queues or channels, see listen_to_queues().
+    
+        Also drops any of their NOTIFY messages that already arrived.
     '''
+    with conn.cursor() as db:
+        for name in names:
+            db.execute('UNLISTEN "{}"'.format(name))
+    
+    conn.commit()
+    conn.notifies[:] = [n for n in conn.notifies if n.channel not in names]
+
+def wait_for_notifies(conn, timeout):
+    ''' Block until NOTIFY messages arrive or timeout seconds have passed.
+    
+        Connection must already be listening, see listen_to_queues().
+        Return a list of (channel, payload) tuples, empty after a timeout.
+    '''
+    if not conn.notifies:
+        select([conn], [], [], max(timeout, 0))
+        conn.poll()
+    
+    notifies = [(n.channel, n.payload) for n in conn.notifies]
+    del conn.notifies[:]
+    
+    return notifies
+
+def wait_for_run(conn, run_id, timeout):
+    ''' Wait up to timeout seconds for a run to be saved from the done queue.
+    '''
+    listen_to_queues(conn, RUNS_CHANNEL)
+    deadline = time() + timeout
+    
+    while time() < deadline:
+        if (RUNS_CHANNEL, str(run_id)) in wait_for_notifies(conn, deadline - time()):
+            return True
+    
+    return False
+
+# CI tasks taken in a row by this process and next idle heartbeat time,
+# see pop_task_from_lanes().
+_lane_status = {'ci streak': 0, 'next heartbeat': 0}
+
+def pop_task_from_lanes(s3, task_queue, batch_queue, done_queue, due_queue, heartbeat_queue, output_dir, worker_kind):
+    ''' Look for a task in the CI or batch task queue and run it, return True if one was found.
+    
+        CI tasks come first, but a batch task is taken after every
+        BATCH_FAIRNESS CI tasks so that batch sets keep moving. Idle workers
+        still put a heartbeat every HEARTBEAT_INTERVAL, so they are counted
+        by get_recent_workers() when sizing the batch queue.
+    '''
+    if _lane_status['ci streak'] < BATCH_FAIRNESS:
+        lanes = task_queue, batch_queue
+    else:
+        lanes = batch_queue, task_queue
+    
+    for lane in lanes:
+        if pop_task_from_taskqueue(s3, lane, done_queue, due_queue, heartbeat_queue, output_dir, worker_kind):
+            _lane_status['ci streak'] = 0 if lane is batch_queue else _lane_status['ci streak'] + 1
+            return True
+    
+    if time() > _lane_status['next heartbeat']:
+        heartbeat_queue.put({'worker_id': _worker_id(), 'worker_kind': worker_kind})
+        _lane_status['next heartbeat'] = time() + HEARTBEAT_INTERVAL.seconds + HEARTBEAT_INTERVAL.days * 86400
+    
+    return False
+
+def get_reusable_cache_state(db, source_path, content_b64, interval):
+    ''' Return cache state from a recent run of a source with the same data, or None.
+    
+        A source with only a changed conform section can skip downloading.
+    '''
+    try:
+        source = json.loads(b64decode(content_b64).decode('utf8'))
+    except ValueError:
+        return None
+    
+    if not source.get('data'):
+        return None
+    
+    for (run_id, source_data, state) in objects.read_cached_source_runs(db, source_path, interval):
+        try:
+            previous = json.loads(b64decode(bytes(source_data)).decode('utf8'))
+        except ValueError:
+            continue
+        
+        if all([previous.get(key) == source.get(key) for key in CACHE_REUSE_KEYS]):
+            _L.info(u'Reusing cached data for {} from run {}'.format(source_path, run_id))
+            return dict(cache=state.cache, fingerprint=state.fingerprint,
+                        version=state.version, run_id=run_id)
+
+def pop_task_from_taskqueue(s3, task_queue, done_queue, due_queue, heartbeat_queue, output_dir, worker_kind):
+    ''' Look for a task in the task queue and run it, return True if one was found.
+    
+        Does not block; use wait_for_notifies() to wait for new tasks.
     '''
     with task_queue as db:
-        task = task_queue.get()
+        task = task_queue.get(block=False)
 
-        # PQ will return NULL after 1 second timeout if not ask
         if task is None:
-            return
+            return False
 
         _L.info(u'Got file {name} from task queue'.format(**task.data))
+        
+        if task.data.get('job_id') and objects.read_job_superseded_by(db, task.data['job_id']):
+            _L.info(u'Skipping file {name} from superseded job {job_id}'.format(**task.data))
+            return True
+        
         passed_on_keys = 'job_id', 'file_id', 'name', 'url', 'content_b64', 'commit_sha', 'set_id'
         passed_on_kwargs = {k: task.data.get(k) for k in passed_on_keys}
         passed_on_kwargs['worker_id'] = _worker_id()
-
+        
+        # Older tasks have no timeout of their own.
+        timeout = task.data.get('timeout') or jobs.JOB_TIMEOUT.seconds + jobs.JOB_TIMEOUT.days * 86400
+        speculative_run_id = task.data.get('speculative_run_id')
+        retry_run_id = task.data.get('retry_run_id')
         interval = '{} seconds'.format(RUN_REUSE_TIMEOUT.seconds + RUN_REUSE_TIMEOUT.days * 86400)
-        previous_run = get_completed_file_run(db, task.data.get('file_id'), interval)
+        cache_state = previous_run = None
+
+        if speculative_run_id or retry_run_id:
+            # Duplicate of a slow batch run, see speculate_batch_runs(),
+            # or retry of a run whose worker died, see reap_dead_worker_tasks().
+            shared_run_id = speculative_run_id or retry_run_id
+            run = objects.read_run(db, shared_run_id)
+            
+            if run is None or run.status is not None:
+                _L.info(u'Skipping file {}, already finished in run {}'.format(task.data['name'], shared_run_id))
+                return True
+            
+            passed_on_kwargs['run_id'] = shared_run_id
+            
+            if speculative_run_id:
+                passed_on_kwargs['speculative'] = True
+
+        else:
+            previous_run = get_completed_file_run(db, task.data.get('file_id'), interval)
     
         if previous_run:
             # Make a copy of the previous run.
@@ -714,12 +1452,18 @@ def pop_task_from_taskqueue(s3, task_queue, done_queue, due_queue, heartbeat_que
             # Don't send a due task, since we will not be doing any actual work.
         
         else:
-            # Reserve space for a new run.
-            passed_on_kwargs['run_id'] = add_run(db)
+            if 'run_id' not in passed_on_kwargs:
+                # Reserve space for a new run.
+                passed_on_kwargs['run_id'] = add_run(db, task.data.get('retries', 0))
 
-            # Send a Due task, possibly for later.
+            # Send a Due task, possibly for later. Every attempt at a run sends
+            # one, so reap_dead_worker_tasks() can tell which workers hold it.
             due_task_data = dict(task_data=task.data, **passed_on_kwargs)
-            due_queue.put(due_task_data, schedule_at=td2str(jobs.JOB_TIMEOUT + DUETASK_DELAY))
+            due_queue.put(due_task_data, schedule_at=td2str(timedelta(seconds=timeout) + DUETASK_DELAY))
+            
+            # Skip downloading if only the conform section has changed.
+            cache_state = get_reusable_cache_state(db, task.data.get('name'),
+                                                   task.data.get('content_b64'), interval)
     
     if previous_run:
         # Re-use result from the previous run.
@@ -731,8 +1475,11 @@ def pop_task_from_taskqueue(s3, task_queue, done_queue, due_queue, heartbeat_que
         # Run the task.
         from . import worker # <-- TODO: un-suck this.
 
+        # Batch runs may be speculatively duplicated, and the first attempt to finish wins.
+        cancelled = threading.Event() if passed_on_kwargs['set_id'] else None
+
         work_lock = threading.Lock()
-        work_args = work_lock, heartbeat_queue, worker_kind
+        work_args = work_lock, heartbeat_queue, worker_kind, passed_on_kwargs['run_id'], cancelled
         work_wait = threading.Thread(target=_wait_for_work_lock, args=work_args)
 
         with work_lock:
@@ -740,65 +1487,154 @@ def pop_task_from_taskqueue(s3, task_queue, done_queue, due_queue, heartbeat_que
             work_wait.start()
 
             source_name, _ = splitext(relpath(passed_on_kwargs['name'], 'sources'))
-            result = worker.do_work(s3, passed_on_kwargs['run_id'], source_name,
-                                    passed_on_kwargs['content_b64'], output_dir)
+            
+            try:
+                result = worker.do_work(s3, passed_on_kwargs['run_id'], source_name,
+                                        passed_on_kwargs['content_b64'], output_dir,
+                                        timeout, cache_state, cancelled)
+            except jobs.JobCancelled:
+                result = None
         
         work_wait.join()
+        
+        if result is None:
+            # Another attempt finished this run, so there is nothing to send.
+            _L.info(u'Dropping cancelled file {name}'.format(**passed_on_kwargs))
+            return True
 
     # Send a Done task
+    listen_to_queues(done_queue.conn, RUNS_CHANNEL)
     done_task_data = dict(result=result, **passed_on_kwargs)
     done_queue.put(done_task_data, expected_at=td2str(timedelta(0)))
     _L.info('Done')
     
-    # Sleep a short time to allow done task to show up in runs table.
+    # Wait a short time to allow done task to show up in runs table.
     # In a one-worker situation with repetitive pull request jobs,
     # this helps the next job take advantage of previous run results.
-    sleep(WORKER_COOLDOWN.seconds + WORKER_COOLDOWN.days * 86400)
+    cooldown = WORKER_COOLDOWN.seconds + WORKER_COOLDOWN.days * 86400
+    
+    try:
+        wait_for_run(done_queue.conn, passed_on_kwargs['run_id'], cooldown)
+    finally:
+        unlisten_from_queues(done_queue.conn, RUNS_CHANNEL)
+    
+    return True
 
 def pop_task_from_donequeue(queue, github_auth):
     ''' Look for a completed job in the "done" task queue, update Github status.
+    
+        Return True if a task was found. Workers waiting in wait_for_run()
+        are notified when the transaction is committed.
     '''
-    with queue as db:
-        task = queue.get()
+    return bool(pop_tasks_from_donequeue(queue, github_auth, 1))
+
+def _save_done_runs(db, runs, speculative=False):
+    ''' Save runs with one query, or one at a time if that fails.
     
-        if task is None:
-            return
+        Savepoints keep a single bad run from rolling back the whole batch.
+    '''
+    if not runs:
+        return
     
-        _L.info(u'Got file {name} from done queue'.format(**task.data))
-        results = task.data['result']
-        message = results['message']
-        run_state = RunState(results.get('output', None))
-        content_b64 = task.data['content_b64']
-        commit_sha = task.data['commit_sha']
-        worker_id = task.data.get('worker_id')
-        set_id = task.data.get('set_id')
-        job_url = task.data['url']
-        filename = task.data['name']
-        file_id = task.data['file_id']
-        run_id = task.data['run_id']
-        job_id = task.data['job_id']
+    db.execute('SAVEPOINT set_runs')
+    
+    try:
+        set_runs(db, runs, speculative)
+    except Exception:
+        _L.warning('Failed to save {} runs together, saving each'.format(len(runs)), exc_info=True)
+        db.execute('ROLLBACK TO SAVEPOINT set_runs')
+    else:
+        db.execute('RELEASE SAVEPOINT set_runs')
+        return
+    
+    for run in runs:
+        db.execute('SAVEPOINT set_run')
         
-        if is_completed_run(db, run_id, task.enqueued_at):
-            # We are too late, this got handled.
-            return
+        try:
+            set_run(db, *run, speculative=speculative)
+        except Exception:
+            _L.error('Failed to save run {}'.format(run[0]), exc_info=True)
+            db.execute('ROLLBACK TO SAVEPOINT set_run')
+        else:
+            db.execute('RELEASE SAVEPOINT set_run')
+
+def pop_tasks_from_donequeue(queue, github_auth, limit=DONE_BATCH_SIZE):
+    ''' Look for up to limit completed jobs in the "done" task queue, update Github status.
+    
+        Runs are saved together, and each job is written and gets a Github
+        status just once for all its tasks. Return the number of tasks found.
+    '''
+    with queue as db:
+        tasks = []
         
-        run_status = bool(message == MAGIC_OK_MESSAGE)
-        is_merged = is_merged_to_master(db, set_id, job_id, commit_sha, github_auth)
+        while len(tasks) < limit:
+            task = queue.get(block=False)
+        
+            if task is None:
+                break
+            
+            tasks.append(task)
+        
+        runs, job_files, merged = OrderedDict(), OrderedDict(), dict()
         
-        set_run(db, run_id, filename, file_id, content_b64, run_state,
-                run_status, job_id, worker_id, commit_sha, is_merged, set_id)
+        for task in tasks:
+            _L.info(u'Got file {name} from done queue'.format(**task.data))
+            results = task.data['result']
+            message = results['message']
+            run_state = RunState(results.get('output', None))
+            content_b64 = task.data['content_b64']
+            commit_sha = task.data['commit_sha']
+            worker_id = task.data.get('worker_id')
+            set_id = task.data.get('set_id')
+            job_url = task.data['url']
+            filename = task.data['name']
+            file_id = task.data['file_id']
+            run_id = task.data['run_id']
+            job_id = task.data['job_id']
+            speculative = bool(task.data.get('speculative'))
+            
+            db.execute('SELECT pg_notify(%s, %s)', (RUNS_CHANNEL, str(run_id)))
 
-        if job_id:
-            update_job_status(db, job_id, job_url, filename, run_status, results, github_auth)
+            if is_completed_run(db, run_id, task.enqueued_at):
+                # We are too late, this got handled.
+                continue
+            
+            if speculative and run_id in runs:
+                # The original attempt finished alongside, and wins.
+                continue
+            
+            run_status = bool(message == MAGIC_OK_MESSAGE)
+            
+            # Tasks in a batch often share a set or commit, so check each just once.
+            if (set_id, job_id, commit_sha) not in merged:
+                merged[(set_id, job_id, commit_sha)] = is_merged_to_master(db, set_id, job_id, commit_sha, github_auth)
+            
+            is_merged = merged[(set_id, job_id, commit_sha)]
+            
+            runs[run_id] = speculative, (run_id, filename, file_id, content_b64, run_state,
+                                         run_status, job_id, worker_id, commit_sha, is_merged, set_id)
+            
+            if job_id:
+                job_url_files = job_files.setdefault(job_id, (job_url, OrderedDict()))
+                job_url_files[1][filename] = (run_status, results)
+        
+        # Results from speculative duplicates only count if no other attempt finished first.
+        _save_done_runs(db, [run for (speculative, run) in runs.values() if not speculative])
+        _save_done_runs(db, [run for (speculative, run) in runs.values() if speculative], True)
+        
+        for (job_id, (job_url, file_statuses)) in job_files.items():
+            update_job_statuses(db, job_id, job_url, file_statuses, github_auth)
+    
+    return len(tasks)
 
 def pop_task_from_duequeue(queue, github_auth):
-    '''
+    ''' Look for an overdue task in the "due" queue, return True if one was found.
     '''
     with queue as db:
-        task = queue.get()
+        task = queue.get(block=False)
     
         if task is None:
-            return
+            return False
         
         _L.info(u'Got file {name} from due queue'.format(**task.data))
         original_task = task.data['task_data']
@@ -814,7 +1650,7 @@ def pop_task_from_duequeue(queue, github_auth):
     
         if is_completed_run(db, run_id, task.enqueued_at):
             # Everything's fine, this got handled.
-            return
+            return True
 
         run_status = False
         is_merged = is_merged_to_master(db, set_id, job_id, commit_sha, github_auth)
@@ -824,12 +1660,78 @@ def pop_task_from_duequeue(queue, github_auth):
 
         if job_id:
             update_job_status(db, job_id, job_url, filename, run_status, False, github_auth)
+    
+    return True
+
+def reap_dead_worker_tasks(due_queue, task_queue, batch_queue):
+    ''' Send tasks held by workers with stale heartbeats back to their task queue.
+    
+        Each run is retried under its own run ID up to DEAD_WORKER_RETRIES
+        times, after which its due task is brought forward to fail it right
+        away. Runs still held by another live attempt, like a speculative
+        duplicate, are left to it. Return number of tasks found.
+    '''
+    with due_queue as db:
+        # Due tasks are sent for each attempt at a run, and hold its task.
+        db.execute('''SELECT q.id, q.data, EXISTS (
+                        SELECT 1 FROM queue AS q2
+                        LEFT JOIN heartbeats AS h ON h.worker_id = q2.data->>'worker_id'
+                        WHERE q2.q_name = q.q_name AND q2.dequeued_at IS NULL
+                          AND q2.id != q.id AND q2.data->>'run_id' = q.data->>'run_id'
+                          AND (q2.enqueued_at >= NOW() - INTERVAL %s
+                               OR h.datetime >= NOW() - INTERVAL %s)
+                        )
+                      FROM queue AS q
+                      JOIN runs AS r ON r.id = (q.data->>'run_id')::integer
+                      WHERE q.q_name = %s AND q.dequeued_at IS NULL
+                        AND q.schedule_at > NOW() AND r.status IS NULL
+                        AND q.enqueued_at < NOW() - INTERVAL %s
+                        AND NOT EXISTS (
+                          SELECT 1 FROM heartbeats AS h
+                          WHERE h.worker_id = q.data->>'worker_id'
+                            AND h.datetime >= NOW() - INTERVAL %s
+                          )
+                      FOR UPDATE OF q''',
+                   (DEAD_WORKER_TIMEOUT, DEAD_WORKER_TIMEOUT, DUE_QUEUE,
+                    DEAD_WORKER_TIMEOUT, DEAD_WORKER_TIMEOUT))
+        
+        due_tasks, reaped_run_ids = db.fetchall(), set()
+        
+        for (due_id, due_data, is_held) in due_tasks:
+            run_id = due_data['run_id']
+            
+            if is_held or run_id in reaped_run_ids:
+                # Another attempt still has this run, or it was just reaped.
+                _L.info(u'Worker {worker_id} died with {name}, leaving run {run_id} to another attempt'.format(**due_data))
+                db.execute('UPDATE queue SET dequeued_at = NOW() WHERE id = %s', (due_id, ))
+                continue
+            
+            reaped_run_ids.add(run_id)
+            task_data = {k: v for (k, v) in due_data['task_data'].items() if k != 'speculative_run_id'}
+            retries = task_data.get('retries', 0)
+            
+            if retries >= DEAD_WORKER_RETRIES:
+                _L.warning(u'Worker {worker_id} died with {name}, giving up after {retries} retries'.format(retries=retries, **due_data))
+                db.execute('UPDATE queue SET schedule_at = NOW() WHERE id = %s', (due_id, ))
+                continue
+            
+            _L.warning(u'Worker {worker_id} died with {name}, retrying run {run_id}'.format(**due_data))
+            db.execute('UPDATE queue SET dequeued_at = NOW() WHERE id = %s', (due_id, ))
+            db.execute('UPDATE runs SET retries = %s WHERE id = %s', (retries + 1, run_id))
+            
+            retry_data = dict(task_data, retries=retries + 1, retry_run_id=run_id)
+            queue = batch_queue if retry_data.get('set_id') else task_queue
+            queue.put(retry_data)
+    
+    return len(due_tasks)
 
 def flush_heartbeat_queue(queue):
     ''' Clear out heartbeat queue, logging each one.
     '''
     with queue as db:
-        for task in queue:
+        while True:
+            task = queue.get(block=False)
+
             if task is None:
                 break
 
@@ -846,6 +1748,17 @@ def flush_heartbeat_queue(queue):
                           VALUES (%s, %s, NOW())''',
                        (id, kind))
 
+def get_queue_wait(db, name):
+    ''' Return seconds that the oldest ready task in the named queue has waited.
+    '''
+    db.execute('''SELECT EXTRACT(EPOCH FROM NOW() - MIN(enqueued_at))
+                  FROM queue WHERE q_name = %s AND dequeued_at IS NULL
+                    AND (schedule_at IS NULL OR schedule_at <= NOW())''',
+               (name, ))
+    
+    (seconds, ) = db.fetchone()
+    return float(seconds or 0)
+
 def get_recent_workers(db):
     '''
     '''
@@ -866,22 +1779,84 @@ def db_connect(dsn=None, user=None, password=None, host=None, port=None, databas
         Use DSN string if given, but allow other calls for older systems.
     '''
     if dsn is None:
-        return connect(user=user, password=password, host=host, port=port, database=database, sslmode=sslmode)
+        return psycopg2.connect(user=user, password=password, host=host, port=port, database=database, sslmode=sslmode)
 
-    return connect(dsn)
+    return psycopg2.connect(dsn)
 
 def db_queue(conn, name):
-    return PQ(conn, table='queue')[name]
+    return pq.PQ(conn, table='queue')[name]
 
 def db_cursor(conn):
     return conn.cursor()
 
+# Database connections opened and replaced by this process, see connection_stats().
+_connection_stats = {'connects': 0, 'reconnects': 0}
+
+def connection_stats():
+    ''' Return counts of database connections opened and replaced by this process.
+    '''
+    return dict(_connection_stats)
+
+class PersistentConnection:
+    ''' Long-lived database connection for worker and dequeuer loops.
+
+        Connecting costs a TLS handshake and authentication, so loops
+        should hold one connection and reuse it. Each get() checks
+        that the connection is still usable, and quietly replaces it
+        if not. Listen again after each get() since LISTEN subscriptions
+        don't carry over to a new connection.
+    '''
+    def __init__(self, *args, **kwargs):
+        self.args, self.kwargs, self.conn = args, kwargs, None
+
+    def get(self):
+        ''' Return a usable connection, reconnecting if needed.
+        '''
+        if self.conn is not None and not self._is_healthy():
+            _L.warning('Replacing broken database connection')
+            _connection_stats['reconnects'] += 1
+            self.close()
+
+        if self.conn is None:
+            self.conn = db_connect(*self.args, **self.kwargs)
+            _connection_stats['connects'] += 1
+            _L.debug('Opened database connection, {connects} so far with {reconnects} reconnects'.format(**_connection_stats))
+
+        return self.conn
+
+    def _is_healthy(self):
+        if self.conn.closed:
+            return False
+
+        try:
+            # Clear out any transaction left behind by an earlier error.
+            self.conn.rollback()
+
+            with self.conn.cursor() as db:
+                db.execute('SELECT 1')
+
+            self.conn.rollback()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            return False
+        else:
+            return True
+
+    def close(self):
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except psycopg2.Error:
+                pass
+            self.conn = None
+
 class SnsHandler(logging.Handler):
     ''' Logs to the given Amazon SNS topic; meant for errors.
     '''
     def __init__(self, arn, *args, **kwargs):
         super(SnsHandler, self).__init__(*args, **kwargs)
         
+        from boto import connect_sns
+
         # Rely on boto AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY variables.
         self.arn, self.sns = arn, connect_sns()
 
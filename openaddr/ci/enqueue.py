@@ -3,11 +3,13 @@ import logging; _L = logging.getLogger('openaddr.ci.enqueue')
 from os import environ
 from itertools import count
 from time import time, sleep
+from datetime import datetime, timedelta
 from argparse import ArgumentParser
 
 from . import (
-    db_connect, db_queue, TASK_QUEUE, load_config, setup_logger,
-    enqueue_sources, find_batch_sources, get_batch_run_times
+    db_connect, db_queue, BATCH_TASK_QUEUE, load_config, setup_logger,
+    enqueue_sources, list_batch_source_urls, iterate_batch_sources,
+    get_batch_run_times, get_recent_workers, project_batch_time
     )
 
 from .objects import add_set
@@ -15,7 +17,9 @@ from ..util import set_autoscale_capacity
 from . import render_set_maps, log_function_errors
 from .. import S3
 
-from boto import connect_autoscale, connect_cloudwatch
+from ..lazy import LazyModule
+
+boto = LazyModule('boto')
 
 parser = ArgumentParser(description='Run some source files.')
 
@@ -51,6 +55,27 @@ parser.add_argument('-q', '--quiet', help='Turn off most logging',
                     action='store_const', dest='loglevel',
                     const=logging.WARNING, default=logging.INFO)
 
+def track_remaining(source_urls, sources, remaining):
+    ''' Generate sources, keeping a list of source URLs not yet generated in remaining.
+    '''
+    for (index, source) in enumerate(sources):
+        remaining['sources'] = source_urls[index:]
+        yield source
+    
+    remaining['sources'] = []
+
+def log_projected_time(queue, sources):
+    ''' Log projected completion time for sources with currently-active workers.
+    '''
+    with queue as db:
+        workers_n = sum(map(len, get_recent_workers(db).values()))
+    
+    seconds = project_batch_time([source['run_time'] for source in sources], workers_n)
+    finish = datetime.utcnow() + timedelta(seconds=seconds)
+    
+    _L.info('{} sources with {} workers projected to finish in {} at {:%Y-%m-%d %H:%M} UTC'.format(
+            len(sources), workers_n, timedelta(seconds=int(seconds)), finish))
+
 @log_function_errors
 def main():
     ''' Single threaded worker to serve the job queue.
@@ -58,15 +83,15 @@ def main():
     args = parser.parse_args()
     setup_logger(args.sns_arn, log_level=args.loglevel)
     s3 = S3(args.access_key, args.secret_key, args.bucket)
-    autoscale = connect_autoscale(args.access_key, args.secret_key)
-    cloudwatch = connect_cloudwatch(args.access_key, args.secret_key)
+    autoscale = boto.connect_autoscale(args.access_key, args.secret_key)
+    cloudwatch = boto.connect_cloudwatch(args.access_key, args.secret_key)
     github_auth = args.github_token, 'x-oauth-basic'
 
     next_queue_interval, next_autoscale_interval = 60, 43200
 
     try:
         with db_connect(args.database_url) as conn:
-            task_Q = db_queue(conn, TASK_QUEUE)
+            task_Q = db_queue(conn, BATCH_TASK_QUEUE)
             next_queue_report = time() + next_queue_interval
             next_autoscale_grow = time() + next_autoscale_interval
             minimum_capacity = count(1)
@@ -74,16 +99,22 @@ def main():
             with task_Q as db:
                 run_times = get_batch_run_times(db, args.owner, args.repository)
 
-            sources = find_batch_sources(args.owner, args.repository, github_auth, run_times)
+            # Only list sources up front, their contents may each need a request.
+            source_urls, contents = list_batch_source_urls(args.owner, args.repository, github_auth, run_times)
+            sources = iterate_batch_sources(source_urls, contents, github_auth)
+            remaining = dict(sources=source_urls)
             
             with task_Q as db:
                 new_set = add_set(db, args.owner, args.repository)
+            
+            log_projected_time(task_Q, source_urls)
 
-            for expected_count in enqueue_sources(task_Q, new_set, sources):
+            for expected_count in enqueue_sources(task_Q, new_set, track_remaining(source_urls, sources, remaining)):
                 if time() >= next_queue_report:
                     next_queue_report, n = time() + next_queue_interval, len(task_Q)
                     args = n, 's' if n != 1 else '', expected_count
                     _L.debug('Task queue has {} item{}, {} sources expected'.format(*args))
+                    log_projected_time(task_Q, remaining['sources'])
                 try:
                     if time() >= next_autoscale_grow:
                         next_autoscale_grow = time() + next_autoscale_interval
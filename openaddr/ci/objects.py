@@ -65,6 +65,12 @@ class Run:
         self.commit_sha = commit_sha
         self.is_merged = is_merged
 
+# Columns in state.txt, from ci.webapi and jobs.write_state_txt().
+CSV_HEADER = 'source', 'cache', 'sample', 'geometry type', 'address count', \
+             'version', 'fingerprint', 'cache time', 'processed', 'process time', \
+             'output', 'attribution required', 'attribution name', 'share-alike', \
+             'code version'
+
 class RunState:
     '''
     '''
@@ -73,7 +79,7 @@ class RunState:
         'address count', 'version', 'fingerprint', 'cache time', 'processed',
         'output', 'process time', 'website', 'skipped', 'license',
         'share-alike', 'attribution required', 'attribution name',
-        'attribution flag')}
+        'attribution flag', 'cache run', 'timeout')}
 
     def __init__(self, json_blob):
         blob_dict = dict(json_blob or {})
@@ -97,6 +103,8 @@ class RunState:
         self.attribution_required = blob_dict.get('attribution required')
         self.attribution_name = blob_dict.get('attribution name')
         self.attribution_flag = blob_dict.get('attribution flag')
+        self.cache_run = blob_dict.get('cache run')
+        self.timeout = blob_dict.get('timeout')
 
         unexpected = ', '.join(set(self.keys) - set(RunState.key_attrs.keys()))
         assert len(unexpected) == 0, 'RunState should not have keys {}'.format(unexpected)
@@ -159,6 +167,40 @@ def read_job(db, job_id):
         return Job(job_id, status, task_files, states, file_results,
                    github_owner, github_repository, github_status_url)
     
+def add_job_ref(db, job_id, owner, repository, ref, commit_sha):
+    ''' Save the git ref of a job, return IDs of earlier jobs it supersedes.
+    
+        Earlier jobs for the same ref at a different commit are superseded.
+    '''
+    db.execute('''UPDATE job_refs SET superseded_by = %s
+                  WHERE github_owner = %s AND github_repository = %s
+                    AND ref = %s AND commit_sha != %s
+                    AND superseded_by IS NULL
+                  RETURNING job_id''',
+               (commit_sha, owner, repository, ref, commit_sha))
+    
+    superseded_ids = [id for (id, ) in db.fetchall()]
+    
+    db.execute('''INSERT INTO job_refs
+                  (job_id, github_owner, github_repository, ref, commit_sha)
+                  VALUES (%s, %s, %s, %s, %s)''',
+               (job_id, owner, repository, ref, commit_sha))
+    
+    return superseded_ids
+
+def read_job_superseded_by(db, job_id):
+    ''' Return commit SHA that superseded a job, or None.
+    '''
+    db.execute('''SELECT superseded_by FROM job_refs
+                  WHERE job_id = %s LIMIT 1''', (job_id, ))
+    
+    try:
+        (superseded_by, ) = db.fetchone()
+    except TypeError:
+        return None
+    else:
+        return superseded_by
+
 def read_jobs(db, past_id):
     ''' Read information about recent jobs.
     
@@ -259,10 +301,12 @@ def read_latest_set(db, owner, repository):
     else:
         return Set(id, sha, start, end, world, europe, usa, own, repo)
 
-def add_run(db):
+def add_run(db, retries=0):
     ''' Reserve a row in the runs table and return its new ID.
+    
+        Retries counts earlier attempts lost to dead workers.
     '''
-    db.execute("INSERT INTO runs (datetime_tz) VALUES (NOW())")
+    db.execute("INSERT INTO runs (datetime_tz, retries) VALUES (NOW(), %s)", (retries, ))
     db.execute("SELECT currval('ints')")
     
     (run_id, ) = db.fetchone()
@@ -270,20 +314,56 @@ def add_run(db):
     return run_id
 
 def set_run(db, run_id, filename, file_id, content_b64, run_state, run_status,
-            job_id, worker_id, commit_sha, is_merged, set_id):
+            job_id, worker_id, commit_sha, is_merged, set_id, speculative=False):
     ''' Populate an identitified row in the runs table.
+    
+        Results from speculative duplicates only fill a row with no status yet.
     '''
+    guard = ' AND status IS NULL' if speculative else ''
+    
     db.execute('''UPDATE runs SET
                   source_path = %s, source_data = %s, source_id = %s,
                   state = %s::json, status = %s, worker_id = %s,
                   code_version = %s, job_id = %s, commit_sha = %s,
                   is_merged = %s, set_id = %s, datetime_tz = NOW()
-                  WHERE id = %s''',
+                  WHERE id = %s''' + guard,
                (filename, content_b64, file_id,
                run_state.to_json(), run_status, worker_id,
                __version__, job_id, commit_sha, is_merged,
                set_id, run_id))
 
+def set_runs(db, runs, speculative=False):
+    ''' Populate many identified rows in the runs table with one query.
+    
+        Each item in runs is a tuple of set_run() arguments without db,
+        and speculative applies to all of them like it does in set_run().
+    '''
+    if not runs:
+        return
+    
+    guard = ' AND runs.status IS NULL' if speculative else ''
+    
+    template = '''(%s::integer, %s::text, %s::bytea, %s::varchar, %s::json,
+                   %s::boolean, %s::varchar, %s::varchar, %s::varchar,
+                   %s::varchar, %s::boolean, %s::integer)'''
+    
+    values = [db.mogrify(template, (run_id, filename, content_b64, file_id,
+                                    run_state.to_json(), run_status, worker_id,
+                                    __version__, job_id, commit_sha, is_merged, set_id))
+              for (run_id, filename, file_id, content_b64, run_state, run_status,
+                   job_id, worker_id, commit_sha, is_merged, set_id) in runs]
+    
+    db.execute('''UPDATE runs SET
+                  source_path = v.source_path, source_data = v.source_data,
+                  source_id = v.source_id, state = v.state, status = v.status,
+                  worker_id = v.worker_id, code_version = v.code_version,
+                  job_id = v.job_id, commit_sha = v.commit_sha,
+                  is_merged = v.is_merged, set_id = v.set_id, datetime_tz = NOW()
+                  FROM (VALUES {}) AS v (id, source_path, source_data, source_id,
+                                         state, status, worker_id, code_version,
+                                         job_id, commit_sha, is_merged, set_id)
+                  WHERE runs.id = v.id'''.format(', '.join(v.decode('utf8') for v in values)) + guard)
+
 def copy_run(db, run_id, job_id, commit_sha, set_id):
     ''' Duplicate a previous run and return its new ID.
     
@@ -343,6 +423,54 @@ def get_completed_file_run(db, file_id, interval):
 
     return previous_run
 
+def read_cached_source_runs(db, source_path, interval, limit=10):
+    ''' Return ID, source data, and state of recent successful source runs with cached data.
+    '''
+    db.execute('''SELECT id, source_data, state FROM runs
+                  WHERE source_path = %s
+                    AND datetime_tz > NOW() - INTERVAL %s
+                    AND status = true
+                    AND state->>'cache' IS NOT NULL
+                  ORDER BY id DESC LIMIT %s''',
+               (source_path, interval, limit))
+    
+    return [(id, source_data, RunState(state)) for (id, source_data, state) in db.fetchall()]
+
+def read_source_run_times(db, source_path, limit):
+    ''' Return cache and process time strings from recent successful source runs.
+    
+        Runs that reused cached data from another run are left out,
+        because they skipped the download that usually takes longest.
+    '''
+    db.execute('''SELECT state->>'cache time', state->>'process time' FROM runs
+                  WHERE source_path = %s
+                    AND status = true
+                    AND copy_of IS NULL
+                    AND state->>'cache run' IS NULL
+                    AND state->>'cache time' IS NOT NULL
+                  ORDER BY id DESC LIMIT %s''',
+               (source_path, limit))
+    
+    return db.fetchall()
+
+def read_latest_source_run_state(db, source_path):
+    ''' Return status and RunState of the latest finished source run, or None.
+    '''
+    db.execute('''SELECT status, state FROM runs
+                  WHERE source_path = %s
+                    AND status IS NOT NULL
+                    AND copy_of IS NULL
+                  ORDER BY id DESC LIMIT 1''',
+               (source_path, ))
+    
+    row = db.fetchone()
+    
+    if row is None:
+        return None
+    
+    status, state = row
+    return status, RunState(state)
+
 def get_completed_run(db, run_id, min_dtz):
     '''
     '''
@@ -1,23 +1,25 @@
 import os
 from os.path import join, dirname
 
-from pq import PQ
-from psycopg2 import connect
+from ..lazy import LazyModule
+
+psycopg2 = LazyModule('psycopg2')
+pq = LazyModule('pq')
 
 def recreate(DATABASE_URL):
     '''
     '''
     schema_filename = join(dirname(__file__), 'schema.pgsql')
 
-    with connect(DATABASE_URL) as conn:
+    with psycopg2.connect(DATABASE_URL) as conn:
         with conn.cursor() as db:
             with open(schema_filename) as file:
                 db.execute(file.read())
             
             db.execute('DROP TABLE IF EXISTS queue')
 
-        pq = PQ(conn, table='queue')
-        pq.create()
+        queue = pq.PQ(conn, table='queue')
+        queue.create()
 
 def main():
     '''
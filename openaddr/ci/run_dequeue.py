@@ -2,14 +2,22 @@ import logging; _L = logging.getLogger('openaddr.ci.run_dequeue')
 
 from os import environ
 from time import sleep, time
-from boto import connect_cloudwatch
+
 
 from . import (
-    db_connect, db_queue, TASK_QUEUE, DONE_QUEUE, DUE_QUEUE, load_config,
-    pop_task_from_donequeue, pop_task_from_duequeue, setup_logger,
-    HEARTBEAT_QUEUE, flush_heartbeat_queue, get_recent_workers
+    db_queue, TASK_QUEUE, DONE_QUEUE, DUE_QUEUE, load_config,
+    pop_tasks_from_donequeue, pop_task_from_duequeue, setup_logger,
+    HEARTBEAT_QUEUE, flush_heartbeat_queue, get_recent_workers,
+    listen_to_queues, wait_for_notifies, QUEUE_POLL_INTERVAL,
+    PersistentConnection, connection_stats, StatusDispatcher,
+    set_status_dispatcher, BATCH_TASK_QUEUE, get_queue_wait,
+    reap_dead_worker_tasks
     )
 
+from ..lazy import LazyModule
+
+boto = LazyModule('boto')
+
 def main():
     '''
     '''
@@ -18,41 +26,70 @@ def main():
     checkin_time = time()
     try:
         # Rely on boto AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY variables.
-        cw = connect_cloudwatch()
+        cw = boto.connect_cloudwatch()
     except:
         cw = False
     
+    connection = PersistentConnection(config['DATABASE_URL'])
+    
+    # Post Github statuses in the background, so slow responses don't hold up queues.
+    set_status_dispatcher(StatusDispatcher())
+    
     while True:
         try:
-            with db_connect(config['DATABASE_URL']) as conn:
-                task_Q = db_queue(conn, TASK_QUEUE)
-                done_Q = db_queue(conn, DONE_QUEUE)
-                due_Q = db_queue(conn, DUE_QUEUE)
-                beat_Q = db_queue(conn, HEARTBEAT_QUEUE)
+            conn = connection.get()
+            task_Q = db_queue(conn, TASK_QUEUE)
+            batch_Q = db_queue(conn, BATCH_TASK_QUEUE)
+            done_Q = db_queue(conn, DONE_QUEUE)
+            due_Q = db_queue(conn, DUE_QUEUE)
+            beat_Q = db_queue(conn, HEARTBEAT_QUEUE)
+            
+            # Listen before looking, so no new task can slip by unnoticed.
+            listen_to_queues(conn, DONE_QUEUE, DUE_QUEUE, HEARTBEAT_QUEUE)
 
-                pop_task_from_donequeue(done_Q, config['GITHUB_AUTH'])
-                pop_task_from_duequeue(due_Q, config['GITHUB_AUTH'])
-                flush_heartbeat_queue(beat_Q)
+            got_done = pop_tasks_from_donequeue(done_Q, config['GITHUB_AUTH'])
+            got_due = pop_task_from_duequeue(due_Q, config['GITHUB_AUTH'])
+            flush_heartbeat_queue(beat_Q)
             
-                if time() < checkin_time:
-                    continue
+            if time() < checkin_time:
+                if not (got_done or got_due):
+                    # Due tasks are scheduled for later, so don't wait forever.
+                    timeout = min(QUEUE_POLL_INTERVAL.seconds, checkin_time - time())
+                    wait_for_notifies(conn, timeout)
+                continue
+
+            # Give work from vanished workers to someone else.
+            reap_dead_worker_tasks(due_Q, task_Q, batch_Q)
 
-                # Report basic information about current status.
-                with beat_Q as db:
-                    recent_workers = get_recent_workers(db)
-                    workers_n = sum(map(len, recent_workers.values()))
-                
-                task_n, done_n, due_n = map(len, (task_Q, done_Q, due_Q))
-                _L.info('{workers_n} active workers; queue lengths: {task_n} tasks, {done_n} done, {due_n} due'.format(**locals()))
-                
-                if cw:
-                    cw.put_metric_data('openaddr.ci', 'tasks queue', task_n, unit='Count')
-                    cw.put_metric_data('openaddr.ci', 'done queue', done_n, unit='Count')
-                    cw.put_metric_data('openaddr.ci', 'due queue', due_n, unit='Count')
-                    cw.put_metric_data('openaddr.ci', 'expected results', task_n + workers_n, unit='Count')
-                    cw.put_metric_data('openaddr.ci', 'active workers', workers_n, unit='Count')
+            # Report basic information about current status.
+            with beat_Q as db:
+                recent_workers = get_recent_workers(db)
+                workers_n = sum(map(len, recent_workers.values()))
+                task_wait = get_queue_wait(db, TASK_QUEUE)
+                batch_wait = get_queue_wait(db, BATCH_TASK_QUEUE)
+            
+            ci_n, batch_n, done_n, due_n = map(len, (task_Q, batch_Q, done_Q, due_Q))
+            task_n = ci_n + batch_n
+            _L.info('{workers_n} active workers; queue lengths: {ci_n} CI tasks, {batch_n} batch tasks, {done_n} done, {due_n} due'.format(**locals()))
+            _L.info('Oldest tasks waiting: {task_wait:.0f}s CI, {batch_wait:.0f}s batch'.format(**locals()))
+            
+            stats = connection_stats()
+            _L.info('{connects} database connections with {reconnects} reconnects'.format(**stats))
+            
+            if cw:
+                cw.put_metric_data('openaddr.ci', 'tasks queue', task_n, unit='Count')
+                cw.put_metric_data('openaddr.ci', 'ci tasks queue', ci_n, unit='Count')
+                cw.put_metric_data('openaddr.ci', 'batch tasks queue', batch_n, unit='Count')
+                cw.put_metric_data('openaddr.ci', 'ci tasks wait', task_wait, unit='Seconds')
+                cw.put_metric_data('openaddr.ci', 'batch tasks wait', batch_wait, unit='Seconds')
+                cw.put_metric_data('openaddr.ci', 'done queue', done_n, unit='Count')
+                cw.put_metric_data('openaddr.ci', 'due queue', due_n, unit='Count')
+                cw.put_metric_data('openaddr.ci', 'expected results', task_n + workers_n, unit='Count')
+                cw.put_metric_data('openaddr.ci', 'active workers', workers_n, unit='Count')
+                cw.put_metric_data('openaddr.ci', 'dequeue db connections', stats['connects'], unit='Count')
+                cw.put_metric_data('openaddr.ci', 'dequeue db reconnects', stats['reconnects'], unit='Count')
 
-                checkin_time = time() + 30
+            checkin_time = time() + 30
 
         except KeyboardInterrupt:
             raise
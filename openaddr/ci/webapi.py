@@ -10,18 +10,13 @@ from flask.ext.cors import CORS
 
 from .objects import (
     load_collection_zips_dict, read_latest_set, read_completed_runs_to_date,
-    new_read_completed_set_runs
+    new_read_completed_set_runs, CSV_HEADER
     )
 
 from . import setup_logger, db_connect, db_cursor
 from .webcommon import log_application_errors, nice_domain
 from ..compat import expand_uri, csvIO, csvDictWriter
 
-CSV_HEADER = 'source', 'cache', 'sample', 'geometry type', 'address count', \
-             'version', 'fingerprint', 'cache time', 'processed', 'process time', \
-             'output', 'attribution required', 'attribution name', 'share-alike', \
-             'code version'
-
 webapi = Blueprint('webapi', __name__)
 CORS(webapi)
 
@@ -19,7 +19,8 @@ from . import (
     load_config, setup_logger, skip_payload, get_commit_info,
     update_pending_status, update_error_status, update_failing_status,
     update_empty_status, update_success_status, process_payload_files,
-    db_connect, db_queue, db_cursor, TASK_QUEUE, create_queued_job
+    db_connect, db_queue, db_cursor, TASK_QUEUE, create_queued_job,
+    get_payload_ref
     )
 
 from .objects import (
@@ -128,8 +129,9 @@ def app_hook():
     with db_connect(current_app.config['DATABASE_URL']) as conn:
         queue = db_queue(conn, TASK_QUEUE)
         try:
-            job_id = create_queued_job(queue, files, job_url_template,
-                                       commit_sha, owner, repo, status_url)
+            ref = get_payload_ref(webhook_payload)
+            job_id = create_queued_job(queue, files, job_url_template, commit_sha,
+                                       owner, repo, status_url, ref, github_auth)
             job_url = expand_uri(job_url_template, dict(id=job_id))
         except Exception as e:
             # Oops, tell Github something went wrong.
@@ -9,21 +9,39 @@ enqueues a new message on a separate PQ queue when the work is done.
 import logging; _L = logging.getLogger('openaddr.ci.worker')
 
 from .. import compat, S3, package_output
-from ..jobs import JOB_TIMEOUT
+from ..jobs import JOB_TIMEOUT, ProcessOnePool, check_output_or_cancel
 
 from argparse import ArgumentParser
-import time, os, psycopg2, json, tempfile, shutil, base64
+from multiprocessing import Process
+from multiprocessing.pool import ThreadPool
+from hashlib import md5
+from io import BytesIO
+import time, os, json, tempfile, shutil, base64, threading
 from urllib.parse import urlparse, urljoin
 
 from . import (
-    db_connect, db_queue, db_queue, pop_task_from_taskqueue,
+    db_connect, db_queue, db_queue, pop_task_from_lanes, BATCH_TASK_QUEUE,
     MAGIC_OK_MESSAGE, DONE_QUEUE, TASK_QUEUE, DUE_QUEUE, setup_logger,
-    log_function_errors, HEARTBEAT_QUEUE
+    log_function_errors, HEARTBEAT_QUEUE, set_worker_slot, listen_to_queues,
+    wait_for_notifies, QUEUE_POLL_INTERVAL, PersistentConnection
     )
 
+# Optional ProcessOnePool, used instead of openaddr-process-one subprocesses.
+process_pool = None
+
+# Number of concurrent S3 uploads for each job, and for parts of each file.
+UPLOAD_THREADS = 4
+
+# Files larger than this are uploaded to S3 in parts of MULTIPART_PART_SIZE.
+MULTIPART_THRESHOLD = 64 * 1024 * 1024
+MULTIPART_PART_SIZE = 16 * 1024 * 1024
+
 def upload_file(s3, keyname, filename):
     ''' Create a new S3 key with filename contents, return its URL and MD5 hash.
     '''
+    if os.path.exists(filename) and os.path.getsize(filename) > MULTIPART_THRESHOLD:
+        return upload_multipart_file(s3, keyname, filename)
+    
     key = s3.new_key(keyname)
 
     kwargs = dict(policy='public-read', reduced_redundancy=True)
@@ -32,13 +50,82 @@ def upload_file(s3, keyname, filename):
     
     return url, key.md5
 
+def upload_multipart_file(s3, keyname, filename):
+    ''' Upload filename to a new S3 key in concurrent parts, return its URL and MD5 hash.
+    
+        S3 doesn't report a plain MD5 for multipart uploads, so it's calculated
+        here from the parts as they're read. s3 must give each thread its own
+        bucket connection, since boto connections aren't thread-safe.
+    '''
+    from boto.s3.multipart import MultiPartUpload
+
+    size = os.path.getsize(filename)
+    part_count = (size + MULTIPART_PART_SIZE - 1) // MULTIPART_PART_SIZE
+
+    kwargs = dict(policy='public-read', reduced_redundancy=True)
+    upload = s3.bucket.initiate_multipart_upload(keyname, **kwargs)
+    hash, hashed = md5(), {'count': 0, 'condition': threading.Condition()}
+    uploads = threading.local()
+    
+    def upload_part(index):
+        with open(filename, 'rb') as file:
+            file.seek(index * MULTIPART_PART_SIZE)
+            data = file.read(MULTIPART_PART_SIZE)
+        
+        # Hash parts in order, which holds at most one part per thread in memory.
+        with hashed['condition']:
+            while hashed['count'] != index:
+                hashed['condition'].wait()
+            hash.update(data)
+            hashed['count'] += 1
+            hashed['condition'].notify_all()
+        
+        # Point at the upload from this thread's own bucket connection, once per thread.
+        if not hasattr(uploads, 'upload'):
+            uploads.upload = MultiPartUpload(s3.bucket)
+            uploads.upload.id, uploads.upload.key_name = upload.id, upload.key_name
+        
+        uploads.upload.upload_part_from_file(BytesIO(data), index + 1, size=len(data))
+    
+    pool = ThreadPool(UPLOAD_THREADS)
+
+    try:
+        pool.map(upload_part, range(part_count), chunksize=1)
+    except Exception:
+        upload.cancel_upload()
+        raise
+    else:
+        upload.complete_upload()
+    finally:
+        pool.close()
+    
+    key = s3.new_key(keyname)
+    url = key.generate_url(expires_in=0, query_auth=False, force_http=True)
+    
+    return url, hash.hexdigest()
+
+def disk_usage(path):
+    ''' Return total size in bytes of all files under path.
+    '''
+    total = 0
+    
+    for (dirpath, _, filenames) in os.walk(path):
+        for filename in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, filename)).st_size
+            except OSError:
+                # Another slot removed it in the meantime.
+                pass
+    
+    return total
+
 def make_source_filename(source_name):
     '''
     '''
     return source_name.replace(u'/', u'--') + '.txt'
 
-def do_work(s3, run_id, source_name, job_contents_b64, output_dir):
-    "Do the actual work of running a source file in job_contents"
+def do_work(s3, run_id, source_name, job_contents_b64, output_dir, timeout=None, cache_state=None, cancelled=None):
+    "Do the actual work of running a source file in job_contents, allowing timeout seconds"
 
     # Make a directory to run the whole job
     workdir = tempfile.mkdtemp(prefix='work-', dir=output_dir)
@@ -55,10 +142,21 @@ def do_work(s3, run_id, source_name, job_contents_b64, output_dir):
     # Invoke the job to do
     logfile_path = os.path.join(workdir, 'logfile.txt')
     cmd = 'openaddr-process-one', '-l', logfile_path, out_fn, oa_dir
+    
+    if cache_state:
+        # Conform data cached by an earlier run, see ci.get_reusable_cache_state().
+        cached = {k: cache_state[k] for k in ('cache', 'fingerprint', 'version')}
+        cmd += '--cache-state', json.dumps(cached)
     try:
         known_error, cmd_status = False, 0
-        timeout_seconds = JOB_TIMEOUT.seconds + JOB_TIMEOUT.days * 86400
-        result_stdout = compat.check_output(cmd, timeout=timeout_seconds)
+        timeout_seconds = timeout or JOB_TIMEOUT.seconds + JOB_TIMEOUT.days * 86400
+        if process_pool is not None:
+            result_stdout = process_pool.check_output(cmd, timeout=timeout_seconds, cancelled=cancelled)
+        elif cancelled is not None:
+            # Stop early if another attempt finishes, see ci._wait_for_work_lock().
+            result_stdout = check_output_or_cancel(cmd, timeout_seconds, cancelled)
+        else:
+            result_stdout = compat.check_output(cmd, timeout=timeout_seconds)
     except compat.TimeoutExpired as e:
         known_error, cmd_status, result_stdout = True, None, e.output
     except compat.CalledProcessError as e:
@@ -81,6 +179,10 @@ def do_work(s3, run_id, source_name, job_contents_b64, output_dir):
                 output = dict()
             else:
                 output = dict(output=url)
+            
+            if cmd_status is None:
+                # Timed out, so the next run gets longer, see ci.get_source_timeout().
+                output.update(timeout=timeout_seconds)
 
             return dict(result_code=cmd_status, result_stdout=result_stdout,
                         message='Something went wrong in {0}'.format(*cmd),
@@ -100,37 +202,45 @@ def do_work(s3, run_id, source_name, job_contents_b64, output_dir):
                 result.update(result_code=-1, message='Failed to produce {} data'.format(key))
         
         index_dirname = os.path.dirname(state_fullpath)
+        uploads, archive_path = dict(), None
+        pool = ThreadPool(UPLOAD_THREADS)
         
-        if index['cache']:
-            # e.g. /runs/0/cache.zip
-            cache_path = os.path.join(index_dirname, index['cache'])
-            key_name = '/runs/{run}/{cache}'.format(run=run_id, **index)
-            url, fingerprint = upload_file(s3, key_name, cache_path)
-            index['cache'], index['fingerprint'] = url, fingerprint
-        
-        if index['sample']:
-            # e.g. /runs/0/sample.json
-            sample_path = os.path.join(index_dirname, index['sample'])
-            key_name = '/runs/{run}/{sample}'.format(run=run_id, **index)
-            url, _ = upload_file(s3, key_name, sample_path)
-            index['sample'] = url
-        
-        if index['processed']:
-            # e.g. /runs/0/fr/paris.zip
-            processed_path = os.path.join(index_dirname, index['processed'])
-            package_args = index.get('website') or 'Unknown', index.get('license') or 'Unknown'
-            archive_path = package_output(source_name, processed_path, *package_args)
-            key_name = u'/runs/{run}/{name}.zip'.format(run=run_id, name=source_name)
-            url, _ = upload_file(s3, key_name, archive_path)
-            index['processed'] = url
-            os.remove(archive_path)
+        try:
+            if cache_state:
+                # Reused cache is already uploaded, so note where it came from.
+                index['cache run'] = cache_state['run_id']
+            
+            for key in ('cache', 'sample', 'output'):
+                if key == 'cache' and cache_state:
+                    continue
+                elif index[key]:
+                    # e.g. /runs/0/cache.zip, /runs/0/sample.json, /runs/0/output.txt
+                    file_path = os.path.join(index_dirname, index[key])
+                    key_name = '/runs/{run}/{name}'.format(run=run_id, name=index[key])
+                    uploads[key] = pool.apply_async(upload_file, (s3, key_name, file_path))
+            
+            if index['processed']:
+                # e.g. /runs/0/fr/paris.zip, packaged while the others upload.
+                processed_path = os.path.join(index_dirname, index['processed'])
+                package_args = index.get('website') or 'Unknown', index.get('license') or 'Unknown'
+                archive_path = package_output(source_name, processed_path, *package_args)
+                key_name = u'/runs/{run}/{name}.zip'.format(run=run_id, name=source_name)
+                uploads['processed'] = pool.apply_async(upload_file, (s3, key_name, archive_path))
+            
+            # Every URL must be in index before it's returned.
+            for (key, upload) in uploads.items():
+                url, fingerprint = upload.get()
+                index[key] = url
+                
+                if key == 'cache':
+                    index['fingerprint'] = fingerprint
         
-        if index['output']:
-            # e.g. /runs/0/output.txt
-            output_path = os.path.join(index_dirname, index['output'])
-            key_name = '/runs/{run}/{output}'.format(run=run_id, **index)
-            url, _ = upload_file(s3, key_name, output_path)
-            index['output'] = url
+        finally:
+            pool.close()
+            pool.join()
+            
+            if archive_path:
+                os.remove(archive_path)
         
         result['output'] = index
     
@@ -162,32 +272,99 @@ parser.add_argument('-q', '--quiet', help='Turn off most logging',
                     action='store_const', dest='loglevel',
                     const=logging.WARNING, default=logging.INFO)
 
+parser.add_argument('--slots', type=int, default=1,
+                    help='Number of tasks to run at once, each in its own process. Defaults to 1.')
+
+parser.add_argument('--output-dir',
+                    help='Optional directory for work in progress. Defaults to a new temporary directory.')
+
+parser.add_argument('--disk-budget', type=float,
+                    help='Optional gigabytes of work in progress allowed under output directory. New tasks wait while over budget.')
+
+parser.add_argument('--prefork', action='store_true',
+                    help='Run sources in processes forked from a warm, pre-imported fork server instead of new openaddr-process-one commands.')
+
 worker_kind = os.environ.get('WORKER_KIND')
 
-@log_function_errors
-def main():
-    ''' Single threaded worker to serve the job queue.
+# Time to wait before checking disk budget again.
+DISK_BUDGET_DELAY = 15
+
+# Time to wait before restarting a slot process that has exited.
+SLOT_RESTART_DELAY = 5
+
+def run_tasks(args, slot=None):
+    ''' Fetch and run tasks in a loop, in a worker slot if slot is given.
     '''
-    args = parser.parse_args()
-    setup_logger(args.sns_arn, log_level=args.loglevel)
+    if slot is not None:
+        set_worker_slot(slot)
+    
     s3 = S3(args.access_key, args.secret_key, args.bucket)
+    connection = PersistentConnection(args.database_url)
     
-    # Fetch and run jobs in a loop    
-    while True:
-        worker_dir = tempfile.mkdtemp(prefix='worker-')
+    # do_work() makes and removes its own directory for each task inside this one.
+    worker_dir = tempfile.mkdtemp(prefix='worker-', dir=args.output_dir)
     
-        try:
-            with db_connect(args.database_url) as conn:
+    # Fetch and run jobs in a loop    
+    try:
+        while True:
+            if args.disk_budget and disk_usage(args.output_dir) > args.disk_budget * 1024**3:
+                _L.info('Over {}GB disk budget in {}, waiting'.format(args.disk_budget, args.output_dir))
+                time.sleep(DISK_BUDGET_DELAY)
+                continue
+        
+            try:
+                conn = connection.get()
                 task_Q = db_queue(conn, TASK_QUEUE)
+                batch_Q = db_queue(conn, BATCH_TASK_QUEUE)
                 done_Q = db_queue(conn, DONE_QUEUE)
                 due_Q = db_queue(conn, DUE_QUEUE)
                 beat_Q = db_queue(conn, HEARTBEAT_QUEUE)
-                pop_task_from_taskqueue(s3, task_Q, done_Q, due_Q, beat_Q, worker_dir, worker_kind)
-        except:
-            _L.error('Error in worker main()', exc_info=True)
-            time.sleep(5)
-        finally:
-            shutil.rmtree(worker_dir)
+                
+                # Listen before looking, so no new task can slip by unnoticed.
+                listen_to_queues(conn, TASK_QUEUE, BATCH_TASK_QUEUE)
+                
+                if not pop_task_from_lanes(s3, task_Q, batch_Q, done_Q, due_Q, beat_Q, worker_dir, worker_kind):
+                    wait_for_notifies(conn, QUEUE_POLL_INTERVAL.seconds)
+            except:
+                _L.error('Error in worker run_tasks()', exc_info=True)
+                time.sleep(5)
+    finally:
+        connection.close()
+        shutil.rmtree(worker_dir)
+
+@log_function_errors
+def main():
+    ''' Worker to serve the job queue, with one or more task slots.
+    '''
+    args = parser.parse_args()
+    setup_logger(args.sns_arn, log_level=args.loglevel)
+
+    if args.prefork:
+        if ProcessOnePool.available():
+            global process_pool
+            process_pool = ProcessOnePool(args.loglevel)
+        else:
+            _L.warning('Fork server is not available, using openaddr-process-one')
+    
+    if args.slots > 1 or args.disk_budget:
+        # Slots share one output directory so the disk budget covers all of them.
+        args.output_dir = args.output_dir or tempfile.mkdtemp(prefix='worker-slots-')
+    
+    if args.slots <= 1:
+        return run_tasks(args)
+    
+    slots = [None] * args.slots
+    
+    while True:
+        for (slot, process) in enumerate(slots):
+            if process is None or not process.is_alive():
+                if process is not None:
+                    _L.error('Worker slot {} exited with code {}'.format(slot, process.exitcode))
+                
+                slots[slot] = Process(target=run_tasks, args=(args, slot))
+                slots[slot].start()
+        
+        time.sleep(SLOT_RESTART_DELAY)
 
 if __name__ == '__main__':
     exit(main())
@@ -7,7 +7,10 @@ if PY2:
     import unicodecsv, subprocess32, uritemplate
     unicodecsv.field_size_limit(sys.maxsize)
     
+    from urlparse import urlparse
+    
     check_output = subprocess32.check_output
+    Popen, PIPE = subprocess32.Popen, subprocess32.PIPE
     CalledProcessError = subprocess32.CalledProcessError
     TimeoutExpired = subprocess32.TimeoutExpired
     
@@ -75,9 +78,11 @@ if PY2:
 else:
     import csv, subprocess
     from uritemplate import expand as expand_uri
+    from urllib.parse import urlparse
     standard_library = None
     
     check_output = subprocess.check_output
+    Popen, PIPE = subprocess.Popen, subprocess.PIPE
     CalledProcessError = subprocess.CalledProcessError
     TimeoutExpired = subprocess.TimeoutExpired
     
@@ -111,8 +116,7 @@ else:
         '''
         return io.open(filename, mode=mode, encoding=encoding)
 
-try:
-    import cairo
-except ImportError:
-    # http://stackoverflow.com/questions/11491268/install-pycairo-in-virtualenv
-    import cairocffi as cairo
+from .lazy import LazyModule
+
+# http://stackoverflow.com/questions/11491268/install-pycairo-in-virtualenv
+cairo = LazyModule('cairo', fallbacks=['cairocffi'])
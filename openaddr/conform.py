@@ -24,8 +24,10 @@ from uuid import uuid4
 from .compat import csvopen, csvreader, csvDictReader, csvDictWriter
 from .sample import sample_geojson
 
-from osgeo import ogr, osr
-ogr.UseExceptions()
+from .lazy import LazyModule
+
+ogr = LazyModule('osgeo.ogr', lambda ogr: ogr.UseExceptions())
+osr = LazyModule('osgeo.osr')
 
 # The canonical output schema for conform
 OPENADDR_CSV_SCHEMA = ['LON', 'LAT', 'NUMBER', 'STREET', 'UNIT', 'CITY',
@@ -48,25 +50,37 @@ attrib_types = {
 
 UNZIPPED_DIRNAME = 'unzipped'
 
-geometry_types = {
-    ogr.wkbPoint: 'Point',
-    ogr.wkbPoint25D: 'Point 2.5D',
-    ogr.wkbLineString: 'LineString',
-    ogr.wkbLineString25D: 'LineString 2.5D',
-    ogr.wkbLinearRing: 'LinearRing',
-    ogr.wkbPolygon: 'Polygon',
-    ogr.wkbPolygon25D: 'Polygon 2.5D',
-    ogr.wkbMultiPoint: 'MultiPoint',
-    ogr.wkbMultiPoint25D: 'MultiPoint 2.5D',
-    ogr.wkbMultiLineString: 'MultiLineString',
-    ogr.wkbMultiLineString25D: 'MultiLineString 2.5D',
-    ogr.wkbMultiPolygon: 'MultiPolygon',
-    ogr.wkbMultiPolygon25D: 'MultiPolygon 2.5D',
-    ogr.wkbGeometryCollection: 'GeometryCollection',
-    ogr.wkbGeometryCollection25D: 'GeometryCollection 2.5D',
-    ogr.wkbUnknown: 'Unknown'
+# Names of OGR geometry type constants, looked up in geometry_types().
+_geometry_type_names = {
+    'wkbPoint': 'Point',
+    'wkbPoint25D': 'Point 2.5D',
+    'wkbLineString': 'LineString',
+    'wkbLineString25D': 'LineString 2.5D',
+    'wkbLinearRing': 'LinearRing',
+    'wkbPolygon': 'Polygon',
+    'wkbPolygon25D': 'Polygon 2.5D',
+    'wkbMultiPoint': 'MultiPoint',
+    'wkbMultiPoint25D': 'MultiPoint 2.5D',
+    'wkbMultiLineString': 'MultiLineString',
+    'wkbMultiLineString25D': 'MultiLineString 2.5D',
+    'wkbMultiPolygon': 'MultiPolygon',
+    'wkbMultiPolygon25D': 'MultiPolygon 2.5D',
+    'wkbGeometryCollection': 'GeometryCollection',
+    'wkbGeometryCollection25D': 'GeometryCollection 2.5D',
+    'wkbUnknown': 'Unknown',
     }
 
+# Built on first use, so that ogr is only imported when it's needed.
+_geometry_types = {}
+
+def geometry_types():
+    ''' Return a dictionary of OGR geometry types to readable names.
+    '''
+    if not _geometry_types:
+        _geometry_types.update({getattr(ogr, name): value for (name, value) in _geometry_type_names.items()})
+
+    return _geometry_types
+
 def mkdirsp(path):
     try:
         os.makedirs(path)
@@ -277,11 +291,11 @@ class ExcerptDataTask(object):
             raise ValueError('Not enough rows in data source')
         
         # Determine geometry_type from layer, sample, or give up.
-        if layer_defn.GetGeomType() in geometry_types:
-            geometry_type = geometry_types.get(layer_defn.GetGeomType(), None)
+        if layer_defn.GetGeomType() in geometry_types():
+            geometry_type = geometry_types().get(layer_defn.GetGeomType(), None)
         elif fieldnames[-3:] == [X_FIELDNAME, Y_FIELDNAME, GEOM_FIELDNAME]:
             geometry = ogr.CreateGeometryFromWkt(data_sample[1][-1])
-            geometry_type = geometry_types.get(geometry.GetGeometryType(), None)
+            geometry_type = geometry_types().get(geometry.GetGeometryType(), None)
         else:
             geometry_type = None
 
@@ -341,7 +355,7 @@ class ExcerptDataTask(object):
             if len(data_sample) >= 2 and GEOM_FIELDNAME in data_sample[0]:
                 geom_index = data_sample[0].index(GEOM_FIELDNAME)
                 geometry = ogr.CreateGeometryFromWkt(data_sample[1][geom_index])
-                geometry_type = geometry_types.get(geometry.GetGeometryType(), None)
+                geometry_type = geometry_types().get(geometry.GetGeometryType(), None)
             else:
                 geometry_type = None
 
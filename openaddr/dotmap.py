@@ -15,12 +15,15 @@ from time import sleep
 import json, subprocess
 
 from uritemplate import expand
-import requests, boto3
 
 from .compat import csvDictReader, csvIO, PY2
 from .ci import db_connect, db_cursor, setup_logger
 from .ci.objects import read_latest_set, read_completed_runs_to_date
 from . import iterate_local_processed_files
+from .lazy import LazyModule
+
+requests = LazyModule('requests')
+boto3 = LazyModule('boto3')
 
 MAPBOX_API_BASE = 'https://api.mapbox.com/uploads/v1/'
 
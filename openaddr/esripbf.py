@@ -0,0 +1,276 @@
+''' Decoder for Esri protocol buffer (f=pbf) feature query responses.
+
+Follows the FeatureCollectionPBuffer schema in esripbf.proto, and returns
+dictionaries shaped like the equivalent f=json responses so that callers
+can treat the two formats the same way.
+'''
+from __future__ import absolute_import, division, print_function
+from .compat import standard_library
+
+import struct
+
+VARINT, FIXED64, DELIMITED, FIXED32 = 0, 1, 2, 5
+
+GEOMETRY_TYPES = {
+    0: 'esriGeometryPoint', 1: 'esriGeometryMultipoint',
+    2: 'esriGeometryPolyline', 3: 'esriGeometryPolygon',
+    4: 'esriGeometryMultiPatch', 127: None,
+    }
+
+FIELD_TYPES = {
+    0: 'esriFieldTypeSmallInteger', 1: 'esriFieldTypeInteger',
+    2: 'esriFieldTypeSingle', 3: 'esriFieldTypeDouble',
+    4: 'esriFieldTypeString', 5: 'esriFieldTypeDate',
+    6: 'esriFieldTypeOID', 7: 'esriFieldTypeGeometry',
+    8: 'esriFieldTypeBlob', 9: 'esriFieldTypeRaster',
+    10: 'esriFieldTypeGUID', 11: 'esriFieldTypeGlobalID',
+    12: 'esriFieldTypeXML',
+    }
+
+UPPER_LEFT, LOWER_LEFT = 0, 1
+
+# Decimal places kept in coordinates, like geometryPrecision in f=json queries.
+GEOMETRY_PRECISION = 7
+
+class DecodeError(ValueError):
+    pass
+
+def _read_varint(buf, pos):
+    ''' Return an unsigned varint value and the position after it.
+    '''
+    value, shift = 0, 0
+    while True:
+        if pos >= len(buf):
+            raise DecodeError('Truncated varint')
+        byte = buf[pos]
+        value |= (byte & 0x7f) << shift
+        pos += 1
+        if not (byte & 0x80):
+            return value, pos
+        shift += 7
+        if shift > 63:
+            raise DecodeError('Varint is too long')
+
+def _zigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+def _signed64(value):
+    return value - (1 << 64) if value & (1 << 63) else value
+
+def _iter_fields(buf):
+    ''' Generate (field number, wire type, value) for each field in a message.
+
+        Varints are returned as unsigned integers, everything else as bytes.
+    '''
+    buf, pos = bytearray(buf), 0
+
+    while pos < len(buf):
+        key, pos = _read_varint(buf, pos)
+        number, wire_type = key >> 3, key & 0x07
+
+        if wire_type == VARINT:
+            value, pos = _read_varint(buf, pos)
+        elif wire_type == FIXED64:
+            value, pos = bytes(buf[pos:pos+8]), pos + 8
+        elif wire_type == FIXED32:
+            value, pos = bytes(buf[pos:pos+4]), pos + 4
+        elif wire_type == DELIMITED:
+            length, pos = _read_varint(buf, pos)
+            value, pos = bytes(buf[pos:pos+length]), pos + length
+        else:
+            raise DecodeError('Unsupported wire type {}'.format(wire_type))
+
+        if pos > len(buf):
+            raise DecodeError('Truncated message')
+
+        yield number, wire_type, value
+
+def _read_packed(value, wire_type):
+    ''' Return a list of unsigned varints from a packed or unpacked field.
+    '''
+    if wire_type == VARINT:
+        return [value]
+
+    buf, pos, values = bytearray(value), 0, []
+    while pos < len(buf):
+        item, pos = _read_varint(buf, pos)
+        values.append(item)
+
+    return values
+
+def _double(value):
+    return struct.unpack('<d', value)[0]
+
+def _decode_value(buf):
+    ''' Decode a single Value message to a Python value.
+    '''
+    for number, wire_type, value in _iter_fields(buf):
+        if number == 1:
+            return value.decode('utf8')
+        elif number == 2:
+            return struct.unpack('<f', value)[0]
+        elif number == 3:
+            return _double(value)
+        elif number in (4, 8):
+            return _zigzag(value)
+        elif number in (5, 7):
+            return value
+        elif number == 6:
+            return _signed64(value)
+        elif number == 9:
+            return bool(value)
+
+    # An empty Value message is a null.
+    return None
+
+def _decode_field(buf):
+    field = dict()
+    for number, _, value in _iter_fields(buf):
+        if number == 1:
+            field['name'] = value.decode('utf8')
+        elif number == 2:
+            field['type'] = FIELD_TYPES.get(value)
+        elif number == 3:
+            field['alias'] = value.decode('utf8')
+    return field
+
+def _decode_transform(buf):
+    ''' Return origin position, (x scale, y scale), and (x translate, y translate).
+    '''
+    origin, scale, translate = UPPER_LEFT, [1., 1.], [0., 0.]
+
+    for number, _, value in _iter_fields(buf):
+        if number == 1:
+            origin = value
+        elif number in (2, 3):
+            target = scale if number == 2 else translate
+            for axis, _, part in _iter_fields(value):
+                if axis in (1, 2):
+                    target[axis - 1] = _double(part)
+
+    return origin, tuple(scale), tuple(translate)
+
+def _decode_geometry(buf):
+    ''' Return lengths and zigzag-decoded coordinate deltas for a Geometry.
+    '''
+    lengths, coords = [], []
+    for number, wire_type, value in _iter_fields(buf):
+        if number == 2:
+            lengths.extend(_read_packed(value, wire_type))
+        elif number == 3:
+            coords.extend(map(_zigzag, _read_packed(value, wire_type)))
+    return lengths, coords
+
+def _build_parts(lengths, coords, dimensions, transform):
+    ''' Apply delta decoding and the quantization transform to coordinates.
+
+        Returns a list of parts, each a list of [x, y] pairs rounded
+        to GEOMETRY_PRECISION decimal places.
+    '''
+    origin, (x_scale, y_scale), (x_trans, y_trans) = transform
+    y_sign = -1 if origin == UPPER_LEFT else 1
+
+    if not lengths:
+        lengths = [len(coords) // dimensions]
+
+    parts, offset, qx, qy = [], 0, 0, 0
+
+    for length in lengths:
+        part = []
+        for index in range(offset, offset + length * dimensions, dimensions):
+            if index + 1 >= len(coords):
+                raise DecodeError('Geometry has fewer coordinates than expected')
+            qx, qy = qx + coords[index], qy + coords[index + 1]
+            part.append([round(x_trans + x_scale * qx, GEOMETRY_PRECISION),
+                         round(y_trans + y_sign * y_scale * qy, GEOMETRY_PRECISION)])
+        parts.append(part)
+        offset += length * dimensions
+
+    return parts
+
+def _esri_geometry(geometry_type, parts):
+    ''' Return an Esri JSON geometry dictionary for the given parts.
+    '''
+    if geometry_type == 'esriGeometryPoint':
+        (x, y), = parts[0]
+        return dict(x=x, y=y)
+    elif geometry_type == 'esriGeometryMultipoint':
+        return dict(points=[point for part in parts for point in part])
+    elif geometry_type == 'esriGeometryPolyline':
+        return dict(paths=parts)
+    elif geometry_type == 'esriGeometryPolygon':
+        return dict(rings=parts)
+    else:
+        raise DecodeError("Don't know how to decode geometry type {}".format(geometry_type))
+
+def decode_feature_collection(data):
+    ''' Decode a FeatureCollectionPBuffer into an Esri JSON-like dictionary.
+
+        Result has geometryType, objectIdFieldName, exceededTransferLimit,
+        fields, and features keys, or count or objectIds for those queries.
+    '''
+    query_result = None
+    for number, _, value in _iter_fields(data):
+        if number == 2:
+            query_result = value
+
+    if query_result is None:
+        raise DecodeError('No query result in protocol buffer')
+
+    for number, _, value in _iter_fields(query_result):
+        if number == 1:
+            return _decode_feature_result(value)
+        elif number == 2:
+            return dict(count=dict((n, v) for (n, _, v) in _iter_fields(value)).get(1, 0))
+        elif number == 3:
+            oids = [oid for (n, t, v) in _iter_fields(value) if n == 3
+                    for oid in _read_packed(v, t)]
+            return dict(objectIds=oids)
+
+    raise DecodeError('Empty query result in protocol buffer')
+
+def _decode_feature_result(buf):
+    result = dict(geometryType=GEOMETRY_TYPES[0], exceededTransferLimit=False,
+                  fields=[], features=[])
+
+    has_z, has_m, transform = False, False, (UPPER_LEFT, (1., 1.), (0., 0.))
+    raw_features = []
+
+    for number, _, value in _iter_fields(buf):
+        if number == 1:
+            result['objectIdFieldName'] = value.decode('utf8')
+        elif number == 7:
+            result['geometryType'] = GEOMETRY_TYPES.get(value)
+        elif number == 9:
+            result['exceededTransferLimit'] = bool(value)
+        elif number == 10:
+            has_z = bool(value)
+        elif number == 11:
+            has_m = bool(value)
+        elif number == 12:
+            transform = _decode_transform(value)
+        elif number == 13:
+            result['fields'].append(_decode_field(value))
+        elif number == 15:
+            # Fields and transform may come after features, so decode later.
+            raw_features.append(value)
+
+    names = [field.get('name') for field in result['fields']]
+    dimensions = 2 + int(has_z) + int(has_m)
+
+    for raw_feature in raw_features:
+        values, feature = [], dict()
+
+        for number, _, value in _iter_fields(raw_feature):
+            if number == 1:
+                values.append(_decode_value(value))
+            elif number == 2:
+                lengths, coords = _decode_geometry(value)
+                if coords:
+                    parts = _build_parts(lengths, coords, dimensions, transform)
+                    feature['geometry'] = _esri_geometry(result['geometryType'], parts)
+
+        feature['attributes'] = dict(zip(names, values))
+        result['features'].append(feature)
+
+    return result
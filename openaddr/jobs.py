@@ -18,8 +18,12 @@ import time
 import os
 import os.path
 import json
+import re
 
-from . import process_one, compat
+from argparse import ArgumentParser
+
+from . import process_one, compat, __version__
+from .compat import urlparse
 
 #
 # Configuration variables
@@ -28,6 +32,14 @@ from . import process_one, compat
 # After this long, a job will be killed with SIGALRM
 JOB_TIMEOUT = timedelta(hours=9)
 
+# Modules imported once by the ProcessOnePool fork server. Heavy
+# dependencies are named here because openaddr only imports them lazily.
+PRELOAD_MODULES = ['openaddr.jobs', 'osgeo.ogr', 'osgeo.osr', 'requests',
+                   'requests_ftp', 'simplejson', 'ijson']
+
+# Seconds between checks for cancellation while waiting on a job.
+CANCEL_CHECK_INTERVAL = 1
+
 class JobTimeoutException(Exception):
     ''' Exception raised if a per-job timeout fires.
     '''
@@ -35,6 +47,11 @@ class JobTimeoutException(Exception):
         super(JobTimeoutException, self).__init__()
         self.jobstack = jobstack
 
+class JobCancelled(Exception):
+    ''' Exception raised after a job was stopped early because it was cancelled.
+    '''
+    pass
+
 # http://stackoverflow.com/questions/8616630/time-out-decorator-on-a-multprocessing-function
 def timeout(timeout):
     ''' Function decorator that raises a JobTimeoutException exception
@@ -49,11 +66,11 @@ def timeout(timeout):
             old_handler = signal.signal(signal.SIGALRM, timeout_handler)
             signal.alarm(timeout)
 
-            result = f(*args, **kwargs)  # f() always returns, in this scheme
-
-            signal.signal(signal.SIGALRM, old_handler)  # Old signal handler is restored
-            signal.alarm(0)  # Alarm removed
-            return result
+            try:
+                return f(*args, **kwargs)
+            finally:
+                signal.alarm(0)  # Alarm removed
+                signal.signal(signal.SIGALRM, old_handler)  # Old signal handler is restored
 
         if compat.PY2:
             new_f.func_name = f.func_name
@@ -117,3 +134,327 @@ def setup_logger(logfile = None, log_level = logging.DEBUG, log_stderr = True, l
             handler2.setLevel(log_level)
             handler2.setFormatter(logging.Formatter(log_format.format('%(asctime)s')))
             everything_logger.addHandler(handler2)
+
+def _process_one_child(source, destination, cache_state, logfile, log_level, connection):
+    ''' Run process_one.process() in a child process, like openaddr-process-one.
+
+        Sends the same bytes openaddr-process-one would print to stdout.
+    '''
+    setup_logger(logfile=logfile, log_level=log_level)
+
+    try:
+        file_path = process_one.process(source, destination, cache_state=cache_state)
+    except Exception as e:
+        _L.error(e, exc_info=True)
+        connection.close()
+        raise SystemExit(1)
+    else:
+        connection.send((file_path + u'\n').encode('utf8'))
+        connection.close()
+
+class ProcessOnePool:
+    ''' Runs process_one.process() in processes forked from a warm fork server.
+
+        The fork server imports openaddr once, so each job starts with GDAL,
+        requests, boto and the rest already loaded. Every job still gets its
+        own process, hard timeout, and log file, like openaddr-process-one.
+        Requires Python 3's multiprocessing "forkserver" start method.
+    '''
+    def __init__(self, log_level=logging.INFO):
+        self.log_level = log_level
+        self.context = multiprocessing.get_context('forkserver')
+        self.context.set_forkserver_preload(PRELOAD_MODULES)
+
+    @staticmethod
+    def available():
+        return hasattr(multiprocessing, 'get_context') \
+            and 'forkserver' in multiprocessing.get_all_start_methods()
+
+    def check_output(self, cmd, timeout, cancelled=None):
+        ''' Run an openaddr-process-one command tuple, return its output.
+
+            Raises compat.TimeoutExpired and compat.CalledProcessError
+            just like compat.check_output() does for the real command,
+            and JobCancelled if optional cancelled threading.Event is set.
+        '''
+        args = process_one.parser.parse_args(cmd[1:])
+
+        receiver, sender = self.context.Pipe(duplex=False)
+        process = self.context.Process(target=_process_one_child,
+                                       args=(args.source, args.destination, args.cache_state,
+                                             args.logfile, self.log_level, sender))
+        process.start()
+        sender.close()
+
+        deadline, output = time.time() + timeout, b''
+
+        try:
+            while time.time() < deadline and not (cancelled and cancelled.is_set()):
+                if receiver.poll(min(max(deadline - time.time(), 0), CANCEL_CHECK_INTERVAL)):
+                    output = receiver.recv()
+                    break
+        except EOFError:
+            # Child exited without sending anything.
+            pass
+        finally:
+            receiver.close()
+
+        if cancelled and cancelled.is_set():
+            process.terminate()
+            process.join()
+            raise JobCancelled(cmd)
+
+        process.join(max(deadline - time.time(), 0))
+
+        if process.is_alive():
+            process.terminate()
+            process.join()
+            raise compat.TimeoutExpired(cmd, timeout, output)
+
+        if process.exitcode != 0:
+            raise compat.CalledProcessError(process.exitcode, cmd, output)
+
+        return output
+
+def check_output_or_cancel(cmd, timeout, cancelled):
+    ''' Run a command tuple like compat.check_output(), return its output.
+
+        Kills the command and raises JobCancelled if the cancelled
+        threading.Event is set before it finishes.
+    '''
+    process = compat.Popen(cmd, stdout=compat.PIPE)
+    deadline = time.time() + timeout
+
+    while True:
+        try:
+            wait = min(max(deadline - time.time(), 0), CANCEL_CHECK_INTERVAL)
+            output, _ = process.communicate(timeout=wait)
+        except compat.TimeoutExpired:
+            if cancelled.is_set():
+                process.kill()
+                process.communicate()
+                raise JobCancelled(cmd)
+            
+            if time.time() >= deadline:
+                process.kill()
+                output, _ = process.communicate()
+                raise compat.TimeoutExpired(cmd, timeout, output)
+        else:
+            break
+
+    if process.returncode != 0:
+        raise compat.CalledProcessError(process.returncode, cmd, output)
+
+    return output
+
+def find_source_files(sources_dir):
+    ''' Return a sorted list of source JSON file paths under sources_dir.
+    '''
+    source_paths = list()
+
+    for (dirpath, dirnames, filenames) in os.walk(sources_dir):
+        source_paths.extend([os.path.join(dirpath, filename)
+                             for filename in filenames if filename.endswith('.json')])
+
+    return sorted(source_paths)
+
+def read_process_times(state_path):
+    ''' Return dictionary of source names to process time strings from a state.txt.
+    '''
+    with compat.csvopen(state_path, 'r', encoding='utf8') as file:
+        rows = compat.csvDictReader(file, dialect='excel-tab', encoding='utf8')
+        return {row['source']: row['process time'] for row in rows
+                if row.get('process time')}
+
+def parse_process_time(value):
+    ''' Return seconds from a process time string like '1 day, 0:01:23.4', or None.
+    '''
+    match = re.match(r'^(?:(\d+) days?, )?(\d+):(\d\d):(\d\d(?:\.\d+)?)$', value or '')
+    
+    if match is None:
+        return None
+    
+    days, hours, minutes, seconds = match.groups()
+    return int(days or 0) * 86400 + int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+def order_source_files(source_paths, sources_dir, process_times):
+    ''' Return source paths with the longest previous runs first.
+
+        Sources with no known process time come before all others,
+        like the batch ordering in ci.find_batch_sources().
+    '''
+    def run_time(path):
+        seconds = parse_process_time(process_times.get(os.path.relpath(path, sources_dir)))
+        return float('inf') if seconds is None else seconds
+
+    return sorted(sorted(source_paths), key=run_time, reverse=True)
+
+def _process_one_job(source_path, destination, timeout_seconds):
+    ''' Run process_one.process() with a timeout in a pool worker.
+
+        Returns source_path and a state file path, or None on failure.
+    '''
+    process = timeout(timeout_seconds)(process_one.process)
+
+    try:
+        return source_path, process(source_path, destination)
+    except JobTimeoutException:
+        _L.error(u'Timed out processing {}'.format(source_path))
+    except Exception as e:
+        _L.error(u'Failed to process {}: {}'.format(source_path, e), exc_info=True)
+
+    return source_path, None
+
+def _ignore_control_signals():
+    ''' Leave SIGUSR1 and SIGUSR2 to the master process.
+    '''
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+    signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+
+def run_all_process_ones(source_paths, sources_dir, destination, workers=None,
+                         job_timeout=JOB_TIMEOUT):
+    ''' Process many sources in a multiprocessing.Pool, return state file paths.
+
+        Sources are processed in the given order and each gets a SIGALRM
+        timeout. Send SIGUSR1 to stop waiting and report finished sources.
+        Return value is a dictionary of source paths to state paths or None.
+    '''
+    timeout_seconds = job_timeout.seconds + job_timeout.days * 86400
+    shutdown = {'requested': False}
+
+    def request_shutdown(signum, frame):
+        _L.warning('Shutting down and reporting after SIGUSR1')
+        shutdown['requested'] = True
+
+    def debug_stack(signum, frame):
+        traceback.print_stack(frame)
+        import pdb; pdb.Pdb().set_trace(frame)
+
+    # New process for each source, so stray GDAL state and memory don't accumulate.
+    pool = multiprocessing.Pool(workers, _ignore_control_signals, maxtasksperchild=1)
+    old_handlers = signal.signal(signal.SIGUSR1, request_shutdown), \
+                   signal.signal(signal.SIGUSR2, debug_stack)
+
+    try:
+        results = list()
+
+        for source_path in source_paths:
+            reldir = os.path.dirname(os.path.relpath(source_path, sources_dir))
+            source_destination = os.path.join(destination, reldir)
+
+            if not os.path.exists(source_destination):
+                os.makedirs(source_destination)
+
+            args = source_path, source_destination, timeout_seconds
+            results.append(pool.apply_async(_process_one_job, args))
+
+        pool.close()
+        state_paths = {path: None for path in source_paths}
+
+        for (index, result) in enumerate(results):
+            while not result.ready() and not shutdown['requested']:
+                result.wait(1)
+
+            if shutdown['requested']:
+                break
+
+            source_path, state_path = result.get()
+            state_paths[source_path] = state_path
+            _L.info(u'Finished {} of {}: {}'.format(index + 1, len(results), source_path))
+
+        if shutdown['requested']:
+            pool.terminate()
+
+        pool.join()
+
+    finally:
+        signal.signal(signal.SIGUSR1, old_handlers[0])
+        signal.signal(signal.SIGUSR2, old_handlers[1])
+
+    return state_paths
+
+def write_state_txt(state_paths, sources_dir, destination):
+    ''' Write a combined state.txt like ci.webapi /state.txt, return its path.
+
+        File paths in the combined state are relative to destination.
+    '''
+    from .ci.objects import CSV_HEADER
+    rows = list()
+
+    for source_path in sorted(state_paths):
+        row = {col: None for col in CSV_HEADER}
+        row['source'] = os.path.relpath(source_path, sources_dir)
+        row['code version'] = __version__
+
+        if state_paths[source_path]:
+            with open(state_paths[source_path]) as file:
+                state = dict(zip(*json.load(file)))
+
+            statedir = os.path.relpath(os.path.dirname(state_paths[source_path]), destination)
+            row.update({col: state.get(col) for col in CSV_HEADER if col in state})
+            row['source'] = os.path.relpath(source_path, sources_dir)
+
+            for col in ('cache', 'sample', 'processed', 'output'):
+                if row[col] and not urlparse(row[col]).scheme:
+                    row[col] = os.path.join(statedir, row[col])
+
+        rows.append(row)
+
+    state_txt_path = os.path.join(destination, 'state.txt')
+
+    with compat.csvopen(state_txt_path, 'w', encoding='utf8') as file:
+        output = compat.csvDictWriter(file, CSV_HEADER, dialect='excel-tab', encoding='utf8')
+        output.writerow({col: col for col in CSV_HEADER})
+        for row in rows:
+            output.writerow(row)
+
+    return state_txt_path
+
+parser = ArgumentParser(description='Run all sources in a directory locally, write a combined state.txt.')
+
+parser.add_argument('sources', help='Required directory of source JSON files.')
+parser.add_argument('destination', help='Required output directory name.')
+
+parser.add_argument('-s', '--state', help='Optional previous state.txt, used to start the longest sources first. Defaults to state.txt in destination.')
+
+parser.add_argument('-j', '--jobs', type=int, help='Number of parallel jobs. Defaults to the number of CPUs.')
+
+parser.add_argument('-t', '--timeout', type=float, default=JOB_TIMEOUT.total_seconds() / 3600,
+                    help='Hours to allow each source. Defaults to {:g}.'.format(JOB_TIMEOUT.total_seconds() / 3600))
+
+parser.add_argument('-l', '--logfile', help='Optional log file name.')
+
+parser.add_argument('-v', '--verbose', help='Turn on verbose logging',
+                    action='store_const', dest='loglevel',
+                    const=logging.DEBUG, default=logging.INFO)
+
+parser.add_argument('-q', '--quiet', help='Turn off most logging',
+                    action='store_const', dest='loglevel',
+                    const=logging.WARNING, default=logging.INFO)
+
+def main():
+    ''' Process every source in a directory locally, longest known runs first.
+    
+        Process times come from a previous state.txt when there is one.
+        Prints the combined state.txt path for the destination directory.
+    '''
+    args = parser.parse_args()
+    setup_logger(logfile=args.logfile, log_level=args.loglevel)
+
+    if not os.path.exists(args.destination):
+        os.makedirs(args.destination)
+
+    state_path = args.state or os.path.join(args.destination, 'state.txt')
+    process_times = read_process_times(state_path) if os.path.exists(state_path) else {}
+
+    source_paths = order_source_files(find_source_files(args.sources), args.sources, process_times)
+    _L.info('Processing {} sources with {} known process times'.format(len(source_paths), len(process_times)))
+
+    state_paths = run_all_process_ones(source_paths, args.sources, args.destination,
+                                       args.jobs, timedelta(hours=args.timeout))
+
+    print(write_state_txt(state_paths, args.sources, args.destination))
+    return 0
+
+if __name__ == '__main__':
+    exit(main())
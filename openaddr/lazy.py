@@ -0,0 +1,60 @@
+''' Deferred imports for heavy dependencies.
+
+GDAL, boto, Flask, psycopg2 and friends take a big share of startup time,
+and many commands never touch some of them. A LazyModule stands in for
+a module at import time and imports the real thing on first use:
+
+    ogr = LazyModule('osgeo.ogr', lambda ogr: ogr.UseExceptions())
+'''
+from __future__ import absolute_import, division, print_function
+
+import importlib
+import threading
+
+_lock = threading.RLock()
+
+class LazyModule:
+    ''' Module stand-in that imports the named module on first attribute access.
+
+        on_import is called once with the real module before it's used.
+        Fallback names are tried in order if the first import fails.
+    '''
+    def __init__(self, name, on_import=None, fallbacks=()):
+        self.__dict__.update(_names=(name, ) + tuple(fallbacks),
+                             _on_import=on_import, _module=None)
+
+    def _load(self):
+        if self.__dict__['_module'] is not None:
+            return self.__dict__['_module']
+
+        with _lock:
+            if self.__dict__['_module'] is None:
+                module = _import_first(self.__dict__['_names'])
+                if self.__dict__['_on_import']:
+                    self.__dict__['_on_import'](module)
+                self.__dict__['_module'] = module
+
+        return self.__dict__['_module']
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._load(), name, value)
+
+    def __delattr__(self, name):
+        delattr(self._load(), name)
+
+    def __repr__(self):
+        return '<LazyModule {}>'.format(' or '.join(self.__dict__['_names']))
+
+def _import_first(names):
+    ''' Import and return the first of names that can be imported.
+    '''
+    for name in names[:-1]:
+        try:
+            return importlib.import_module(name)
+        except ImportError:
+            pass
+
+    return importlib.import_module(names[-1])
@@ -12,6 +12,7 @@ from _thread import get_ident
 import tempfile, json, csv
 
 from . import cache, conform, CacheResult, ConformResult
+from .cache import link_or_copy
 from .compat import csvopen, csvwriter
 
 class SourceSaysSkip(RuntimeError): pass
@@ -30,10 +31,12 @@ def boolstr(value):
     
     raise ValueError(repr(value))
 
-def process(source, destination, extras=dict()):
+def process(source, destination, extras=dict(), cache_state=None):
     ''' Process a single source and destination, return path to JSON state file.
     
-        Creates a new directory and files under destination.
+        Creates a new directory and files under destination. Optional
+        cache_state dictionary has cache, fingerprint, and version of data
+        cached by an earlier run, to be conformed instead of downloading anew.
     '''
     temp_dir = tempfile.mkdtemp(prefix='process_one-', dir=destination)
     temp_src = join(temp_dir, basename(source))
@@ -50,8 +53,13 @@ def process(source, destination, extras=dict()):
             if json.load(file).get('skip', None):
                 raise SourceSaysSkip()
     
-        # Cache source data.
-        cache_result = cache(temp_src, temp_dir, extras)
+        if cache_state:
+            # Reuse source data cached by an earlier run.
+            cache_result = CacheResult(cache_state.get('cache'), cache_state.get('fingerprint'),
+                                       cache_state.get('version'), None)
+        else:
+            # Cache source data.
+            cache_result = cache(temp_src, temp_dir, extras)
     
         if not cache_result.cache:
             _L.warning('Nothing cached')
@@ -123,7 +131,7 @@ def write_state(source, skipped, destination, log_handler, cache_result,
         scheme, _, cache_path1, _, _, _ = urlparse(cache_result.cache)
         if scheme in ('file', ''):
             cache_path2 = join(statedir, 'cache{1}'.format(*splitext(cache_path1)))
-            copy(cache_path1, cache_path2)
+            link_or_copy(cache_path1, cache_path2)
             state_cache = relpath(cache_path2, statedir)
         else:
             state_cache = cache_result.cache
@@ -133,7 +141,7 @@ def write_state(source, skipped, destination, log_handler, cache_result,
     if conform_result.path:
         _, _, processed_path1, _, _, _ = urlparse(conform_result.path)
         processed_path2 = join(statedir, 'out{1}'.format(*splitext(processed_path1)))
-        copy(processed_path1, processed_path2)
+        link_or_copy(processed_path1, processed_path2)
 
     # Write the sample data to a sample.json file
     if conform_result.sample:
@@ -183,6 +191,9 @@ parser.add_argument('destination', help='Required output directory name.')
 
 parser.add_argument('-l', '--logfile', help='Optional log file name.')
 
+parser.add_argument('--cache-state', type=json.loads,
+                    help='Optional JSON object with cache, fingerprint, and version of previously-cached data to use instead of downloading.')
+
 parser.add_argument('-v', '--verbose', help='Turn on verbose logging',
                     action='store_const', dest='loglevel',
                     const=logging.DEBUG, default=logging.INFO)
@@ -200,7 +211,8 @@ def main():
     setup_logger(logfile=args.logfile, log_level=args.loglevel)
     
     try:
-        file_path = process(args.source.decode('utf8'), args.destination.decode('utf8'))
+        file_path = process(args.source.decode('utf8'), args.destination.decode('utf8'),
+                            cache_state=args.cache_state)
     except Exception as e:
         _L.error(e, exc_info=True)
         return 1
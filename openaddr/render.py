@@ -12,8 +12,10 @@ import json
 
 from .compat import cairo
 from . import SOURCES_DIR
-from osgeo import ogr, osr
-import requests
+from .conform import ogr, osr
+from .lazy import LazyModule
+
+requests = LazyModule('requests')
 
 # Areas
 WORLD, USA, EUROPE = 54029, 2163, 'Europe'
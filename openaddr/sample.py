@@ -1,9 +1,13 @@
 from __future__ import absolute_import, division, print_function
 from .compat import standard_library
 
-import json, ijson
+import json
 from itertools import chain
 
+from .lazy import LazyModule
+
+ijson = LazyModule('ijson')
+
 def _build_value(data):
     ''' Build a value (number, array, whatever) from an ijson stream.
     '''
@@ -1263,6 +1263,27 @@ class TestPackage (unittest.TestCase):
         self.assertEqual(os.stat(filename).st_mtime, 1439980544)
         remove(filename)
 
+    def test_lazy_imports(self):
+        ''' Heavy dependencies should not load just from importing the package or its commands.
+        '''
+        heavy = 'osgeo', 'ogr', 'boto', 'boto3', 'flask', 'psycopg2', 'pq', 'cairo', 'cairocffi', 'requests'
+        code = 'import sys, {}; print(",".join(sorted(set({}) & set(sys.modules))))'
+        root = join(dirname(__file__), '..', '..')
+        
+        # Every console script module from setup.py, like benchmarks/import_time.py.
+        with open(join(root, 'setup.py')) as file:
+            modules = re.findall(r"'[\w-]+ = ([\w.]+):\w+'", file.read())
+        
+        self.assertTrue(len(modules) > 0)
+        
+        for module_name in ['openaddr', 'openaddr.ci'] + modules:
+            process = Popen((sys.executable, '-c', code.format(module_name, repr(heavy))),
+                            stdout=PIPE, cwd=root)
+            stdout, _ = process.communicate()
+            
+            self.assertEqual(process.returncode, 0, module_name)
+            self.assertEqual(stdout.decode('utf8').strip(), '', module_name)
+
 @contextmanager
 def locked_open(filename):
     ''' Open and lock a file, for use with threads and processes.
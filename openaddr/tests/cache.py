@@ -3,14 +3,25 @@ from __future__ import absolute_import, division, print_function
 from urllib.parse import urlparse, parse_qs
 from os.path import join, dirname
 
+import json
 import shutil
 import mimetypes
 
+import os
 import unittest
 import httmock
 import tempfile
-
-from ..cache import guess_url_file_extension, EsriRestDownloadTask
+import random
+import mock
+
+from ..cache import (
+    guess_url_file_extension, EsriRestDownloadTask, DownloadError,
+    EsriPageSizer, OffsetPages, WherePages, ObjectIdPages, point_geometry_values,
+    link_or_copy
+    )
+from ..compat import csvopen, csvDictReader
+from .. import esripbf
+from .esri_server import FakeEsriServer
 
 class TestCacheExtensionGuessing (unittest.TestCase):
 
@@ -54,6 +65,43 @@ class TestCacheExtensionGuessing (unittest.TestCase):
             assert guess_url_file_extension('http://dcatlas.dcgis.dc.gov/catalog/download.asp?downloadID=2182&downloadTYPE=ESRI') == '.zip'
             assert guess_url_file_extension('http://data.northcowichan.ca/DataBrowser/DownloadCsv?container=mncowichan&entitySet=PropertyReport&filter=NOFILTER') == '.csv', guess_url_file_extension('http://data.northcowichan.ca/DataBrowser/DownloadCsv?container=mncowichan&entitySet=PropertyReport&filter=NOFILTER')
 
+class TestCacheLinkOrCopy (unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='testLinkOrCopy-')
+        self.src_path = join(self.workdir, 'source.txt')
+
+        with open(self.src_path, 'w') as file:
+            file.write('Hello world')
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_link(self):
+        """ Files Are Hard-Linked When Possible """
+        os.mkdir(join(self.workdir, 'dest'))
+        dest_path = link_or_copy(self.src_path, join(self.workdir, 'dest'))
+
+        self.assertEqual(dest_path, join(self.workdir, 'dest', 'source.txt'))
+        self.assertTrue(os.path.samefile(self.src_path, dest_path))
+
+        # Linking over an existing file replaces it.
+        self.assertEqual(link_or_copy(self.src_path, dest_path), dest_path)
+        self.assertTrue(os.path.samefile(self.src_path, dest_path))
+
+    def test_copy(self):
+        """ Files Are Copied When Linking Fails """
+        dest_path = join(self.workdir, 'dest.txt')
+
+        with mock.patch('os.link') as link:
+            link.side_effect = OSError(18, 'Invalid cross-device link')
+            link_or_copy(self.src_path, dest_path)
+
+        self.assertFalse(os.path.samefile(self.src_path, dest_path))
+
+        with open(dest_path) as file:
+            self.assertEqual(file.read(), 'Hello world')
+
 class TestCacheEsriDownload (unittest.TestCase):
 
     def setUp(self):
@@ -149,8 +197,10 @@ class TestCacheEsriDownload (unittest.TestCase):
                     local_path = join(data_dirname, 'us-mn-washington-count-only.json')
                 elif body_data.get('resultRecordCount') == ['1']:
                     local_path = join(data_dirname, 'us-mn-washington-0.json')
-                elif body_data.get('outFields') == ['*']:
+                elif body_data.get('outFields') == ['*'] and body_data.get('resultOffset') == ['0']:
                     local_path = join(data_dirname, 'us-mn-washington-0-allfields.json')
+                elif body_data.get('outFields') == ['*']:
+                    return httmock.response(200, b'{"features": []}', headers={'Content-Type': 'application/json'})
 
             elif path == '/arcgis/rest/services/Public/Public_Parcels/MapServer/0':
                 if qs.get('f') == ['json']:
@@ -192,8 +242,27 @@ class TestCacheEsriDownload (unittest.TestCase):
                 if qs.get('f') == ['json']:
                     local_path = join(data_dirname, 'us-mi-kent-metadata.json')
 
+        if host == 'gis.example.com':
+            qs = parse_qs(query)
+
+            if path == '/arcgis/rest/services/Broken/MapServer/0/query':
+                body_data = parse_qs(request.body) if request.body else {}
+
+                if qs.get('returnIdsOnly') == ['true']:
+                    local_path = join(data_dirname, 'us-ca-carson-ids-only.json')
+                elif qs.get('returnCountOnly') == ['true']:
+                    local_path = join(data_dirname, 'us-ca-carson-count-only.json')
+                elif body_data.get('outSR') == ['4326']:
+                    local_path = join(data_dirname, 'us-mn-washington-0.json')
+
+            elif path == '/arcgis/rest/services/Broken/MapServer/0':
+                if qs.get('f') == ['json']:
+                    local_path = join(data_dirname, 'us-ca-carson-metadata.json')
+
         if local_path:
             type, _ = mimetypes.guess_type(local_path)
+            if local_path.endswith('.pbf'):
+                type = 'application/x-protobuf'
             with open(local_path, 'rb') as file:
                 return httmock.response(200, file.read(), headers={'Content-Type': type})
         
@@ -205,6 +274,67 @@ class TestCacheEsriDownload (unittest.TestCase):
             task = EsriRestDownloadTask('us-ca-carson')
             task.download(['http://www.carsonproperty.info/ArcGIS/rest/services/basemap/MapServer/1'], self.workdir, None)
 
+    def test_download_carson_rows(self):
+        """ ESRI Caching Streams Every Feature Into The CSV """
+        with httmock.HTTMock(self.response_content):
+            task = EsriRestDownloadTask('us-ca-carson')
+            (path, ) = task.download(['http://www.carsonproperty.info/ArcGIS/rest/services/basemap/MapServer/1'], self.workdir, None)
+
+        with csvopen(path, 'r', encoding='utf-8') as file:
+            rows = list(csvDictReader(file, encoding='utf-8'))
+
+        self.assertEqual(len(rows), 5)
+        self.assertEqual(rows[0]['OA:x'], '-118.2661258')
+        self.assertEqual(rows[0]['OA:y'], '33.8322558')
+
+    def test_download_error_page(self):
+        """ ESRI Caching Raises An Error For Error Responses While Streaming """
+        with httmock.HTTMock(self.response_content):
+            task = EsriRestDownloadTask('us-xx-broken')
+            with self.assertRaises(DownloadError) as e:
+                task.download(['http://gis.example.com/arcgis/rest/services/Broken/MapServer/0'], self.workdir, None)
+
+        self.assertIn('Server said: Failed to execute query.', str(e.exception))
+
+    def test_point_geometry_values(self):
+        """ ESRI Point Geometries Without OGR Match OGR """
+        with open(join(dirname(__file__), 'data', 'us-ca-carson-0.json')) as file:
+            features = [feature for feature in json.load(file)['features'] if 'geometry' in feature]
+
+        features += [
+            {'geometry': {'x': -122, 'y': 37}},
+            {'geometry': {'x': -122.5, 'y': 37}},
+            {'geometry': {'x': -118.2661258, 'y': 33.8322558}},
+            {'geometry': {'x': 0.1, 'y': -45.9999999}},
+            ]
+
+        task = EsriRestDownloadTask('us-ca-carson')
+
+        for feature in features:
+            expected = task.ogr_geometry_values('esriGeometryPoint', feature)
+            self.assertEqual(point_geometry_values('esriGeometryPoint', feature), expected)
+
+        multipoint = {'geometry': {'points': [[-122.5, 37.1], [-122.25, 37.3], [-122, 37]]}}
+        expected = task.ogr_geometry_values('esriGeometryMultipoint', multipoint)
+        self.assertEqual(point_geometry_values('esriGeometryMultipoint', multipoint), expected)
+
+        # Random decimal degrees at the requested precision all match OGR.
+        rand = random.Random(0)
+        for i in range(2000):
+            x = round(rand.uniform(-180, 180), rand.randint(0, 7))
+            y = round(rand.uniform(-90, 90), rand.randint(0, 7))
+            feature = {'geometry': {'x': x, 'y': y}}
+            expected = task.ogr_geometry_values('esriGeometryPoint', feature)
+            self.assertEqual(point_geometry_values('esriGeometryPoint', feature), expected, (x, y))
+
+        # Values the fast formatter isn't trusted with are left to OGR.
+        for value in (-0., 1e-9, 1e20, 6474022.25, 2**40, 123.123456789012345, .1 + .2):
+            self.assertIsNone(point_geometry_values('esriGeometryPoint', {'geometry': {'x': value, 'y': 37}}))
+
+        self.assertIsNone(point_geometry_values('esriGeometryPoint', {'geometry': {'x': 'NaN', 'y': 'NaN'}}))
+        self.assertIsNone(point_geometry_values('esriGeometryPoint', {}))
+        self.assertIsNone(point_geometry_values('esriGeometryPolygon', {'geometry': {'rings': []}}))
+
     def test_download_madison(self):
         """ ESRI Caching Supports Statistics Pagination """
         with httmock.HTTMock(self.response_content):
@@ -266,3 +396,272 @@ class TestCacheEsriDownload (unittest.TestCase):
         with httmock.HTTMock(self.response_content):
             task = EsriRestDownloadTask('us-mn-washington')
             task.download(['http://maps.co.washington.mn.us/arcgis/rest/services/Public/Public_Parcels/MapServer/0'], self.workdir, conform)
+
+class TestCacheEsriProtobuf (unittest.TestCase):
+
+    def test_decode_carson(self):
+        """ Protocol Buffer Features Match Their JSON Equivalents """
+        data_dirname = join(dirname(__file__), 'data')
+
+        with open(join(data_dirname, 'us-ca-carson-0.pbf'), 'rb') as file:
+            pbf_data = esripbf.decode_feature_collection(file.read())
+
+        with open(join(data_dirname, 'us-ca-carson-0.json')) as file:
+            json_data = json.load(file)
+
+        self.assertEqual(pbf_data['geometryType'], json_data['geometryType'])
+        self.assertEqual(len(pbf_data['features']), len(json_data['features']))
+
+        for pbf_feature, json_feature in zip(pbf_data['features'], json_data['features']):
+            self.assertEqual(pbf_feature['attributes'], json_feature['attributes'])
+            self.assertEqual('geometry' in pbf_feature, 'geometry' in json_feature)
+
+            if 'geometry' in json_feature:
+                self.assertAlmostEqual(pbf_feature['geometry']['x'], json_feature['geometry']['x'], places=7)
+                self.assertAlmostEqual(pbf_feature['geometry']['y'], json_feature['geometry']['y'], places=7)
+
+    def test_decode_parts(self):
+        """ Protocol Buffer Coordinates Are Delta-Encoded Across Parts """
+        transform = esripbf.LOWER_LEFT, (.5, .5), (10., 20.)
+        parts = esripbf._build_parts([2, 3], [0, 0, 2, 2, 2, -2, -2, 0, 0, 4], 2, transform)
+        self.assertEqual(parts, [[[10., 20.], [11., 21.]], [[12., 20.], [11., 20.], [11., 22.]]])
+
+        transform = esripbf.UPPER_LEFT, (.5, .5), (10., 20.)
+        parts = esripbf._build_parts([], [4, 4], 2, transform)
+        self.assertEqual(esripbf._esri_geometry('esriGeometryPoint', parts), dict(x=12., y=18.))
+
+        transform = esripbf.LOWER_LEFT, (1e-9, 1e-9), (-118., 33.)
+        parts = esripbf._build_parts([], [-266125844, 832255761], 2, transform)
+        self.assertEqual(parts, [[[-118.2661258, 33.8322558]]], 'Should match geometryPrecision=7')
+
+    def test_decode_garbage(self):
+        """ Protocol Buffer Decoding Rejects Non-Protobuf Input """
+        with self.assertRaises(esripbf.DecodeError):
+            esripbf.decode_feature_collection(b'{"error":{"code":400}}')
+
+class TestCacheEsriPaging (unittest.TestCase):
+
+    def test_page_sizer(self):
+        """ ESRI Page Sizes Shrink On Trouble And Grow While Faster """
+        sizer = EsriPageSizer(1000)
+        self.assertEqual(sizer.size, 1000)
+
+        # Timeouts halve the page size.
+        self.assertTrue(sizer.shrink())
+        self.assertEqual(sizer.size, 500)
+
+        # Pages that get faster per feature grow the size back up.
+        sizer.record(500, 500, 5.)
+        self.assertEqual(sizer.size, 750)
+        sizer.record(750, 750, 6.)
+        self.assertEqual(sizer.size, 1000)
+
+        # Slower pages stop growth.
+        sizer.record(1000, 1000, 20.)
+        self.assertEqual(sizer.size, 1000)
+
+        # A truncated page sets a new maximum.
+        self.assertTrue(sizer.shrink(200))
+        self.assertEqual((sizer.size, sizer.maximum), (200, 200))
+        sizer.record(200, 200, .1)
+        self.assertEqual(sizer.size, 200)
+
+        self.assertEqual(len(sizer.history), 4)
+
+        # It can't get any smaller than the minimum.
+        sizer = EsriPageSizer(2)
+        self.assertTrue(sizer.shrink())
+        self.assertFalse(sizer.shrink())
+        self.assertEqual(sizer.size, 1)
+
+    def test_offset_pages(self):
+        """ ESRI Offset Pages Advance By Features Returned """
+        pages = OffsetPages({'where': '1=1'}, 250)
+        self.assertEqual(pages.next_args(100), {'where': '1=1', 'resultOffset': 0, 'resultRecordCount': 100})
+
+        pages.advance(100, 60)
+        self.assertEqual(pages.next_args(60)['resultOffset'], 60)
+        self.assertFalse(pages.done())
+
+        pages.advance(60, 0)
+        self.assertTrue(pages.done())
+
+    def test_where_pages(self):
+        """ ESRI Where Clause Pages Cover The OID Range """
+        pages, wheres = WherePages({}, 'OID', 1, 25), []
+        while not pages.done():
+            wheres.append(pages.next_args(10)['where'])
+            pages.advance(10, 10)
+
+        self.assertEqual(wheres, ['OID > 0 AND OID <= 10', 'OID > 10 AND OID <= 20', 'OID > 20 AND OID <= 25'])
+
+    def test_object_id_pages(self):
+        """ ESRI Object ID Pages Use The Requested Chunk Size """
+        pages, chunks = ObjectIdPages({}, list(range(1, 8))), []
+        while not pages.done():
+            chunks.append(pages.next_args(3)['objectIds'])
+            pages.advance(3, 3)
+
+        self.assertEqual(chunks, ['1,2,3', '4,5,6', '7'])
+
+class TestCacheEsriServer (unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='testCacheServer-')
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def download_path(self, server, subdir=''):
+        task = EsriRestDownloadTask('us-xx-fake')
+        (path, ) = task.download([server.url], join(self.workdir, subdir), None)
+        return path
+
+    def download_oids(self, server):
+        with csvopen(self.download_path(server), 'r', encoding='utf-8') as file:
+            return [int(row['OBJECTID']) for row in csvDictReader(file, encoding='utf-8')]
+
+    def test_offset_paging(self):
+        """ ESRI Caching Gets Every Feature With resultOffset Paging """
+        for supports_pbf in (True, False):
+            with FakeEsriServer(feature_count=250, max_record_count=100, supports_pagination=True, supports_pbf=supports_pbf) as server:
+                self.assertEqual(self.download_oids(server), server.oids)
+
+    def test_where_paging(self):
+        """ ESRI Caching Gets Every Feature With OID Where Clause Paging """
+        for supports_pbf in (True, False):
+            with FakeEsriServer(feature_count=250, max_record_count=100, supports_statistics=True, supports_pbf=supports_pbf) as server:
+                self.assertEqual(self.download_oids(server), server.oids)
+
+    def test_object_id_paging(self):
+        """ ESRI Caching Gets Every Feature With OID Enumeration """
+        for supports_pbf in (True, False):
+            with FakeEsriServer(feature_count=250, max_record_count=100, supports_pbf=supports_pbf) as server:
+                self.assertEqual(self.download_oids(server), server.oids)
+
+    def test_truncated_pages(self):
+        """ ESRI Caching Gets Every Feature When The Server Returns Less Than maxRecordCount """
+        for kwargs in (dict(supports_pagination=True), dict(supports_statistics=True), dict()):
+            for supports_pbf in (True, False):
+                with FakeEsriServer(feature_count=250, max_record_count=100, record_limit=30, supports_pbf=supports_pbf, **kwargs) as server:
+                    self.assertEqual(self.download_oids(server), server.oids)
+
+    def test_empty_truncated_pages(self):
+        """ ESRI Caching Retries Truncated Pages With No Features At A Smaller Size """
+        for kwargs in (dict(supports_pagination=True), dict(supports_statistics=True), dict()):
+            for supports_pbf in (True, False):
+                with FakeEsriServer(feature_count=250, max_record_count=100, empty_pages=2, supports_pbf=supports_pbf, **kwargs) as server:
+                    self.assertEqual(self.download_oids(server), server.oids)
+
+        # A server that never returns anything gives up at the smallest page.
+        with FakeEsriServer(feature_count=250, max_record_count=100, empty_pages=100) as server:
+            with self.assertRaises(DownloadError):
+                self.download_oids(server)
+
+    def test_stream_timeouts(self):
+        """ ESRI Caching Shrinks Pages After Timeouts While Streaming """
+        from .. import cache
+        real_request, timeouts = cache.request, [1]
+
+        def slow_request(*args, **kwargs):
+            response = real_request(*args, **kwargs)
+            if kwargs.get('stream') and timeouts:
+                def iter_content(*args, **kwargs):
+                    yield b'{"features": ['
+                    timeouts.pop()
+                    raise cache.requests.packages.urllib3.exceptions.ReadTimeoutError(None, None, 'Read timed out.')
+                response.iter_content = iter_content
+            return response
+
+        with mock.patch('openaddr.cache.request', side_effect=slow_request):
+            with FakeEsriServer(feature_count=250, max_record_count=100, supports_pagination=True, supports_pbf=False) as server:
+                task = EsriRestDownloadTask('us-xx-fake')
+                (path, ) = task.download([server.url], self.workdir, None)
+
+        with csvopen(path, 'r', encoding='utf-8') as file:
+            oids = [int(row['OBJECTID']) for row in csvDictReader(file, encoding='utf-8')]
+
+        (sizer, ) = task.page_sizers
+        self.assertEqual(oids, server.oids)
+        self.assertEqual(sizer.history[0][0], 50)
+
+    def test_server_errors(self):
+        """ ESRI Caching Raises DownloadError For Server Errors """
+        with FakeEsriServer(feature_count=250, error_rate=1) as server:
+            with self.assertRaises(DownloadError):
+                self.download_oids(server)
+
+    def test_pbf_download(self):
+        """ ESRI Caching Uses Protocol Buffers When Advertised """
+        pbf_path = join(dirname(__file__), 'data', 'us-ca-carson-0.pbf')
+
+        with FakeEsriServer(pbf_path=pbf_path) as server:
+            path = self.download_path(server)
+
+        formats = [args.get('f') for (_, args) in server.requests if 'outSR' in args]
+        self.assertEqual(formats, ['pbf'])
+
+        with csvopen(path, 'r', encoding='utf-8') as file:
+            rows = list(csvDictReader(file, encoding='utf-8'))
+
+        self.assertEqual(len(rows), 5)
+        self.assertEqual(rows[0]['ADDRESS'], '555 E CARSON ST 122')
+        self.assertEqual(rows[0]['OA:x'], '-118.2661258')
+        self.assertEqual(rows[0]['OA:y'], '33.8322558')
+
+    def test_pbf_fallback(self):
+        """ ESRI Caching Falls Back To JSON When Protocol Buffers Fail """
+        pbf_path = join(dirname(__file__), 'data', 'us-ca-carson-0.pbf')
+
+        with FakeEsriServer(pbf_path=pbf_path) as server:
+            with csvopen(self.download_path(server, 'pbf'), 'r', encoding='utf-8') as file:
+                pbf_rows = list(csvDictReader(file, encoding='utf-8'))
+
+        with FakeEsriServer(pbf_path=pbf_path, pbf_errors=True) as server:
+            with csvopen(self.download_path(server, 'json'), 'r', encoding='utf-8') as file:
+                json_rows = list(csvDictReader(file, encoding='utf-8'))
+
+        formats = [args.get('f') for (_, args) in server.requests if 'outSR' in args]
+        self.assertEqual(formats, ['pbf', 'json'])
+        self.assertEqual(json_rows, pbf_rows)
+
+    def test_stream_errors(self):
+        """ ESRI Caching Raises DownloadError For Connections Lost Mid-Stream """
+        from .. import cache
+        real_request = cache.request
+
+        def dropped_request(*args, **kwargs):
+            response = real_request(*args, **kwargs)
+            if kwargs.get('stream'):
+                def iter_content(*args, **kwargs):
+                    yield b'{"features": ['
+                    raise cache.requests.exceptions.ChunkedEncodingError('Connection dropped')
+                response.iter_content = iter_content
+            return response
+
+        with mock.patch('openaddr.cache.request', side_effect=dropped_request):
+            with FakeEsriServer(feature_count=250, supports_pbf=False) as server:
+                with self.assertRaises(DownloadError) as e:
+                    self.download_oids(server)
+
+        self.assertIn('Could not connect to URL', str(e.exception))
+
+    def test_responses_closed(self):
+        """ ESRI Caching Closes Streamed Responses, Even After Errors """
+        from .. import cache
+        responses, real_request = [], cache.request
+
+        def tracked_request(*args, **kwargs):
+            response = real_request(*args, **kwargs)
+            if kwargs.get('stream'):
+                response.close = mock.Mock(wraps=response.close)
+                responses.append(response)
+            return response
+
+        with mock.patch('openaddr.cache.request', side_effect=tracked_request):
+            with FakeEsriServer(feature_count=250, error_rate=1, supports_pbf=False) as server:
+                with self.assertRaises(DownloadError):
+                    self.download_oids(server)
+
+        self.assertTrue(len(responses) > 0)
+        self.assertTrue(all([response.close.called for response in responses]))
@@ -15,7 +15,7 @@ from io import BytesIO, StringIO
 from mock import patch
 from time import sleep
 from uuid import uuid4
-import hmac, hashlib, mock
+import hmac, hashlib, mock, time, tarfile
 
 import unittest, json, os, sys, itertools
 
@@ -28,11 +28,20 @@ DATABASE_URL = os.environ.get('DATABASE_URL', 'postgres:///hooked_on_sources')
 from ..ci import (
     db_connect, db_cursor, db_queue, recreate_db, worker,
     pop_task_from_donequeue, pop_task_from_taskqueue, pop_task_from_duequeue,
+    pop_tasks_from_donequeue,
     create_queued_job, TASK_QUEUE, DONE_QUEUE, DUE_QUEUE, MAGIC_OK_MESSAGE,
     enqueue_sources, find_batch_sources, render_set_maps, render_index_maps,
     is_merged_to_master, get_commit_info, HEARTBEAT_QUEUE, flush_heartbeat_queue,
     get_recent_workers, PERMANENT_KIND, TEMPORARY_KIND, load_config,
-    get_batch_run_times
+    get_batch_run_times, set_worker_slot, _worker_id, listen_to_queues,
+    wait_for_notifies, wait_for_run, RUNS_CHANNEL, PersistentConnection,
+    unlisten_from_queues,
+    connection_stats, StatusDispatcher, _merge_status_cache, _github_templates,
+    _github_etag_cache, get_batch_queue_depth, project_batch_time,
+    pop_task_from_lanes, get_queue_wait, BATCH_TASK_QUEUE, reap_dead_worker_tasks,
+    estimate_source_timeout, get_source_timeout, speculate_batch_runs,
+    get_reusable_cache_state, _save_done_runs, list_batch_source_urls,
+    iterate_batch_sources
     )
 
 from ..ci.objects import (
@@ -40,7 +49,8 @@ from ..ci.objects import (
     Set, add_set, complete_set, update_set_renders, read_set, read_sets,
     add_run, set_run, copy_run, get_completed_file_run, get_completed_run,
     read_completed_set_runs, new_read_completed_set_runs, read_latest_set,
-    read_run, read_completed_runs_to_date, read_latest_run, Run, RunState
+    read_run, read_completed_runs_to_date, read_latest_run, Run, RunState,
+    read_source_run_times, read_cached_source_runs, read_latest_source_run_state
     )
 
 from ..ci.collect import (
@@ -49,8 +59,8 @@ from ..ci.collect import (
     expand_and_add_csv_to_zipfile, write_to_s3, MULTIPART_CHUNK_SIZE
     )
 
-from ..jobs import JOB_TIMEOUT
-from ..ci.worker import make_source_filename
+from ..jobs import JOB_TIMEOUT, JobCancelled
+from ..ci.worker import make_source_filename, upload_file, disk_usage
 from ..ci.webhooks import apply_webhooks_blueprint
 from ..ci.webapi import apply_webapi_blueprint
 from .. import compat, LocalProcessedResult
@@ -300,7 +310,7 @@ class TestObjects (unittest.TestCase):
         self.assertEqual(run_id, 456)
 
         self.db.execute.assert_has_calls([
-               mock.call("INSERT INTO runs (datetime_tz) VALUES (NOW())"),
+               mock.call("INSERT INTO runs (datetime_tz, retries) VALUES (NOW(), %s)", (0, )),
                mock.call("SELECT currval('ints')")
                ])
     
@@ -320,7 +330,29 @@ class TestObjects (unittest.TestCase):
                    '{}', True, '',
                    __version__, 'xyz', '', False,
                    123, 456))
+        
+        self.db.reset_mock()
+        set_run(self.db, 456, '', '', b'', RunState({}), True, 'xyz', '', '', False, 123, speculative=True)
+        self.assertTrue(self.db.execute.call_args[0][0].endswith('WHERE id = %s AND status IS NULL'))
 
+    def test_save_done_runs(self):
+        ''' Check behavior of ci._save_done_runs() when saving together fails
+        '''
+        runs = [(456, '', '', b'', RunState({}), True, 'xyz', '', '', False, 123),
+                (789, '', '', b'', RunState({}), True, 'xyz', '', '', False, 123)]
+        
+        with patch('openaddr.ci.set_runs') as set_runs, patch('openaddr.ci.set_run') as set_run:
+            set_runs.side_effect = ValueError('Bad run')
+            set_run.side_effect = [ValueError('Bad run'), None]
+            _save_done_runs(self.db, runs, True)
+        
+        set_runs.assert_called_once_with(self.db, runs, True)
+        self.assertEqual(set_run.mock_calls, [mock.call(self.db, *run, speculative=True) for run in runs])
+        self.assertEqual([call[0][0] for call in self.db.execute.call_args_list],
+                         ['SAVEPOINT set_runs', 'ROLLBACK TO SAVEPOINT set_runs',
+                          'SAVEPOINT set_run', 'ROLLBACK TO SAVEPOINT set_run',
+                          'SAVEPOINT set_run', 'RELEASE SAVEPOINT set_run'])
+    
     def test_copy_run(self):
         ''' Check behavior of objects.copy_run()
         '''
@@ -408,6 +440,61 @@ class TestObjects (unittest.TestCase):
                   ORDER BY id DESC LIMIT 1''',
                   ('abc', timedelta(0)))
 
+    def test_read_source_run_times(self):
+        ''' Check behavior of objects.read_source_run_times()
+        '''
+        self.db.fetchall.return_value = [('0:00:01', '0:00:30')]
+        
+        run_times = read_source_run_times(self.db, 'sources/a.json', 10)
+        self.assertEqual(run_times, [('0:00:01', '0:00:30')])
+
+        self.db.execute.assert_called_once_with(
+               '''SELECT state->>'cache time', state->>'process time' FROM runs
+                  WHERE source_path = %s
+                    AND status = true
+                    AND copy_of IS NULL
+                    AND state->>'cache run' IS NULL
+                    AND state->>'cache time' IS NOT NULL
+                  ORDER BY id DESC LIMIT %s''',
+                  ('sources/a.json', 10))
+
+    def test_read_latest_source_run_state(self):
+        ''' Check behavior of objects.read_latest_source_run_state()
+        '''
+        self.db.fetchone.return_value = (False, {'timeout': 90})
+        
+        status, state = read_latest_source_run_state(self.db, 'sources/a.json')
+        self.assertEqual((status, state.timeout), (False, 90))
+
+        self.db.execute.assert_called_once_with(
+               '''SELECT status, state FROM runs
+                  WHERE source_path = %s
+                    AND status IS NOT NULL
+                    AND copy_of IS NULL
+                  ORDER BY id DESC LIMIT 1''',
+                  ('sources/a.json', ))
+        
+        self.db.fetchone.return_value = None
+        self.assertIsNone(read_latest_source_run_state(self.db, 'sources/a.json'))
+
+    def test_read_cached_source_runs(self):
+        ''' Check behavior of objects.read_cached_source_runs()
+        '''
+        self.db.fetchall.return_value = [(456, b'', {'cache': 'http://example.com/cache.zip'})]
+        
+        ((run_id, source_data, state), ) = read_cached_source_runs(self.db, 'sources/a.json', '1 day')
+        self.assertEqual(run_id, 456)
+        self.assertEqual(state.cache, 'http://example.com/cache.zip')
+
+        self.db.execute.assert_called_once_with(
+               '''SELECT id, source_data, state FROM runs
+                  WHERE source_path = %s
+                    AND datetime_tz > NOW() - INTERVAL %s
+                    AND status = true
+                    AND state->>'cache' IS NOT NULL
+                  ORDER BY id DESC LIMIT %s''',
+                  ('sources/a.json', '1 day', 10))
+
     def test_get_completed_run_yes(self):
         ''' Check behavior of objects.get_completed_run_yes()
         '''
@@ -1224,6 +1311,42 @@ class TestHook (unittest.TestCase):
                     self.assertEqual(self.last_status_state, 'failure')
                     self.assertTrue('Failed' in self.last_status_message)
 
+    def test_webhook_two_master_commits_batched(self):
+        ''' Push two commits with San Francisco and Berkeley sources directly to master.
+        
+            Both completion tasks are handled in one batch with one Github status.
+        '''
+        data = '''{\r          "after": "ded44ed5f1733bb93d84f94afe9383e2d47bbbaa", \r          "base_ref": null, \r          "before": "e91fbc420f08890960f50f863626e1062f922522", \r          "commits": [\r            {\r              "added": [\r                "sources/us-ca-san_francisco.json"\r              ], \r              "author": {\r                "email": "mike@teczno.com", \r                "name": "Michal Migurski", \r                "username": "migurski"\r              }, \r              "committer": {\r                "email": "mike@teczno.com", \r                "name": "Michal Migurski", \r                "username": "migurski"\r              }, \r              "distinct": true, \r              "id": "73a81c5b337bd393273a222f1cd191d7e634df51", \r              "message": "Added SF", \r              "modified": [], \r              "removed": [], \r              "timestamp": "2015-04-25T17:25:45-07:00", \r              "url": "https://github.com/openaddresses/hooked-on-sources/commit/73a81c5b337bd393273a222f1cd191d7e634df51"\r            }, \r            {\r              "added": [\r                "sources/us-ca-berkeley.json"\r              ], \r              "author": {\r                "email": "mike@teczno.com", \r                "name": "Michal Migurski", \r                "username": "migurski"\r              }, \r              "committer": {\r                "email": "mike@teczno.com", \r                "name": "Michal Migurski", \r                "username": "migurski"\r              }, \r              "distinct": true, \r              "id": "ded44ed5f1733bb93d84f94afe9383e2d47bbbaa", \r              "message": "Added Berkeley", \r              "modified": [], \r              "removed": [], \r              "timestamp": "2015-04-25T17:25:55-07:00", \r              "url": "https://github.com/openaddresses/hooked-on-sources/commit/ded44ed5f1733bb93d84f94afe9383e2d47bbbaa"\r            }\r          ], \r          "compare": "https://github.com/openaddresses/hooked-on-sources/compare/e91fbc420f08...ded44ed5f173", \r          "created": false, \r          "deleted": false, \r          "forced": false, \r          "head_commit": {\r            "added": [\r              "sources/us-ca-berkeley.json"\r            ], \r            "author": {\r              "email": "mike@teczno.com", \r              "name": "Michal Migurski", \r              "username": "migurski"\r            }, \r            "committer": {\r              "email": "mike@teczno.com", \r              "name": "Michal Migurski", \r              "username": "migurski"\r            }, \r            "distinct": true, \r            "id": "ded44ed5f1733bb93d84f94afe9383e2d47bbbaa", \r            "message": "Added Berkeley", \r            "modified": [], \r            "removed": [], \r            "timestamp": "2015-04-25T17:25:55-07:00", \r            "url": "https://github.com/openaddresses/hooked-on-sources/commit/ded44ed5f1733bb93d84f94afe9383e2d47bbbaa"\r          }, \r          "organization": {\r            "avatar_url": "https://avatars.githubusercontent.com/u/6895392?v=3", \r            "description": "The free and open global address collection ", \r            "events_url": "https://api.github.com/orgs/openaddresses/events", \r            "id": 6895392, \r            "login": "openaddresses", \r            "members_url": "https://api.github.com/orgs/openaddresses/members{/member}", \r            "public_members_url": "https://api.github.com/orgs/openaddresses/public_members{/member}", \r            "repos_url": "https://api.github.com/orgs/openaddresses/repos", \r            "url": "https://api.github.com/orgs/openaddresses"\r          }, \r          "pusher": {\r            "email": "mike-github@teczno.com", \r            "name": "migurski"\r          }, \r          "ref": "refs/heads/master", \r          "repository": {\r            "archive_url": "https://api.github.com/repos/openaddresses/hooked-on-sources/{archive_format}{/ref}", \r            "assignees_url": "https://api.github.com/repos/openaddresses/hooked-on-sources/assignees{/user}", \r            "blobs_url": "https://api.github.com/repos/openaddresses/hooked-on-sources/git/blobs{/sha}", \r            "branches_url": "https://api.github.com/repos/openaddresses/hooked-on-sources/branches{/branch}", \r            "clone_url": "https://github.com/openaddresses/hooked-on-sources.git", \r            "collaborators_url": "https://api.github.com/repos/openaddresses/hooked-on-sources/collaborators{/collaborator}", \r            "comments_url": "https://api.github.com/repos/openaddresses/hooked-on-sources/comments{/number}", \r            "commits_url": "https://api.github.com/repos/openaddresses/hooked-on-sources/commits{/sha}", \r            "compare_url": "https://api.github.com/repos/openaddresses/hooked-on-sources/compare/{base}...{head}", \r            "contents_url": "https://api.github.com/repos/openaddresses/hooked-on-sources/contents/{+path}", \r            "contributors_url": "https://api.github.com/repos/openaddresses/hooked-on-sources/contributors", \r            "created_at": 1430006167, \r            "default_branch": "master", \r            "description": "Temporary repository for testing Github webhook features", \r            "downloads_url": "https://api.github.com/repos/openaddresses/hooked-on-sources/downloads", \r            "events_url": "https://api.github.com/repos/openaddresses/hooked-on-sources/events", \r            "fork": false, \r            "forks": 0, \r            "forks_count": 0, \r            "forks_url": "https://api.github.com/repos/openaddresses/hooked-on-sources/forks", \r            "full_name": "openaddresses/hooked-on-sources", \r            "git_commits_url": "https://api.github.com/repos/openaddresses/hooked-on-sources/git/commits{/sha}", \r            "git_refs_url": "https://api.github.com/repos/openaddresses/hooked-on-sources/git/refs{/sha}", \r            "git_tags_url": "https://api.github.com/repos/openaddresses/hooked-on-sources/git/tags{/sha}", \r            "git_url": "git://github.com/openaddresses/hooked-on-sources.git", \r            "has_downloads": true, \r            "has_issues": true, \r            "has_pages": false, \r            "has_wiki": true, \r            "homepage": null, \r            "hooks_url": "https://api.github.com/repos/openaddresses/hooked-on-sources/hooks", \r            "html_url": "https://github.com/openaddresses/hooked-on-sources", \r            "id": 34590951, \r            "issue_comment_url": "https://api.github.com/repos/openaddresses/hooked-on-sources/issues/comments{/number}", \r            "issue_events_url": "https://api.github.com/repos/openaddresses/hooked-on-sources/issues/events{/number}", \r            "issues_url": "https://api.github.com/repos/openaddresses/hooked-on-sources/issues{/number}", \r            "keys_url": "https://api.github.com/repos/openaddresses/hooked-on-sources/keys{/key_id}", \r            "labels_url": "https://api.github.com/repos/openaddresses/hooked-on-sources/labels{/name}", \r            "language": null, \r            "languages_url": "https://api.github.com/repos/openaddresses/hooked-on-sources/languages", \r            "master_branch": "master", \r            "merges_url": "https://api.github.com/repos/openaddresses/hooked-on-sources/merges", \r            "milestones_url": "https://api.github.com/repos/openaddresses/hooked-on-sources/milestones{/number}", \r            "mirror_url": null, \r            "name": "hooked-on-sources", \r            "notifications_url": "https://api.github.com/repos/openaddresses/hooked-on-sources/notifications{?since,all,participating}", \r            "open_issues": 0, \r            "open_issues_count": 0, \r            "organization": "openaddresses", \r            "owner": {\r              "email": "openaddresses@gmail.com", \r              "name": "openaddresses"\r            }, \r            "private": false, \r            "pulls_url": "https://api.github.com/repos/openaddresses/hooked-on-sources/pulls{/number}", \r            "pushed_at": 1430007964, \r            "releases_url": "https://api.github.com/repos/openaddresses/hooked-on-sources/releases{/id}", \r            "size": 0, \r            "ssh_url": "git@github.com:openaddresses/hooked-on-sources.git", \r            "stargazers": 0, \r            "stargazers_count": 0, \r            "stargazers_url": "https://api.github.com/repos/openaddresses/hooked-on-sources/stargazers", \r            "statuses_url": "https://api.github.com/repos/openaddresses/hooked-on-sources/statuses/{sha}", \r            "subscribers_url": "https://api.github.com/repos/openaddresses/hooked-on-sources/subscribers", \r            "subscription_url": "https://api.github.com/repos/openaddresses/hooked-on-sources/subscription", \r            "svn_url": "https://github.com/openaddresses/hooked-on-sources", \r            "tags_url": "https://api.github.com/repos/openaddresses/hooked-on-sources/tags", \r            "teams_url": "https://api.github.com/repos/openaddresses/hooked-on-sources/teams", \r            "trees_url": "https://api.github.com/repos/openaddresses/hooked-on-sources/git/trees{/sha}", \r            "updated_at": "2015-04-25T23:56:07Z", \r            "url": "https://github.com/openaddresses/hooked-on-sources", \r            "watchers": 0, \r            "watchers_count": 0\r          }, \r          "sender": {\r            "avatar_url": "https://avatars.githubusercontent.com/u/58730?v=3", \r            "events_url": "https://api.github.com/users/migurski/events{/privacy}", \r            "followers_url": "https://api.github.com/users/migurski/followers", \r            "following_url": "https://api.github.com/users/migurski/following{/other_user}", \r            "gists_url": "https://api.github.com/users/migurski/gists{/gist_id}", \r            "gravatar_id": "", \r            "html_url": "https://github.com/migurski", \r            "id": 58730, \r            "login": "migurski", \r            "organizations_url": "https://api.github.com/users/migurski/orgs", \r            "received_events_url": "https://api.github.com/users/migurski/received_events", \r            "repos_url": "https://api.github.com/users/migurski/repos", \r            "site_admin": false, \r            "starred_url": "https://api.github.com/users/migurski/starred{/owner}{/repo}", \r            "subscriptions_url": "https://api.github.com/users/migurski/subscriptions", \r            "type": "User", \r            "url": "https://api.github.com/users/migurski"\r          }\r        }'''
+        
+        with HTTMock(self.response_content):
+            posted = self.client.post('/hook', data=data, headers=signed(data))
+        
+        self.assertEqual(posted.status_code, 200)
+        self.assertEqual(self.last_status_state, 'pending')
+        
+        for message in (MAGIC_OK_MESSAGE, 'Something went wrong'):
+            # Put back a completion task to the done queue for each task.
+            with db_connect(self.database_url) as conn:
+                task = db_queue(conn, TASK_QUEUE).get()
+                task.data['result'] = dict(message=message)
+                task.data['run_id'] = -1
+                db_queue(conn, DONE_QUEUE).put(task.data)
+        
+        with db_connect(self.database_url) as conn:
+            with HTTMock(self.response_content), \
+                 patch('openaddr.ci.post_github_status') as post_github_status:
+                count = pop_tasks_from_donequeue(db_queue(conn, DONE_QUEUE), self.github_auth)
+                self.assertEqual(pop_tasks_from_donequeue(db_queue(conn, DONE_QUEUE), self.github_auth), 0)
+            
+            with db_cursor(conn) as db:
+                job = read_job(db, task.data['job_id'])
+        
+        self.assertEqual(count, 2, 'Should have handled both tasks together')
+        self.assertEqual(post_github_status.call_count, 1, 'Should have posted just one status')
+        self.assertEqual(post_github_status.call_args[0][1]['state'], 'failure')
+        self.assertEqual(sorted(job.states.values()), [False, True])
+        self.assertIs(job.status, False)
+
     def test_webhook_two_branch_commits(self):
         ''' Push two commits with addition and removal of Polish source to a branch.
         
@@ -1601,6 +1724,65 @@ class TestRuns (unittest.TestCase):
         print('Unknowable Request {} "{}"'.format(request.method, url.geturl()), file=sys.stderr)
         raise ValueError('Unknowable Request {} "{}"'.format(request.method, url.geturl()))
 
+    def test_queue_notifies(self):
+        ''' Test that queue listeners wake up on put() and pg_notify().
+        '''
+        with db_connect(self.database_url) as conn1, db_connect(self.database_url) as conn2:
+            listen_to_queues(conn1, TASK_QUEUE, RUNS_CHANNEL)
+            
+            started = datetime.now()
+            self.assertEqual(wait_for_notifies(conn1, .2), [], 'Should time out empty')
+            self.assertTrue(datetime.now() - started >= timedelta(seconds=.2))
+            
+            db_queue(conn2, TASK_QUEUE).put({'name': 'yo'})
+            db_queue(conn2, DONE_QUEUE).put({'name': 'yo'})
+            self.assertEqual(wait_for_notifies(conn1, 5), [(TASK_QUEUE, '')])
+            
+            with conn2.cursor() as db:
+                db.execute('SELECT pg_notify(%s, %s)', (RUNS_CHANNEL, '1'))
+                db.execute('SELECT pg_notify(%s, %s)', (RUNS_CHANNEL, '2'))
+            conn2.commit()
+            
+            self.assertTrue(wait_for_run(conn1, 2, 5), 'Should see run 2 saved')
+            self.assertFalse(wait_for_run(conn1, 3, .2), 'Should not see run 3 saved')
+            
+            with conn2.cursor() as db:
+                db.execute('SELECT pg_notify(%s, %s)', (RUNS_CHANNEL, '3'))
+            conn2.commit()
+            
+            unlisten_from_queues(conn1, RUNS_CHANNEL)
+            self.assertEqual(wait_for_notifies(conn1, .2), [], 'Should drop run 3 notify')
+            
+            with conn1.cursor() as db:
+                db.execute('SELECT pg_listening_channels()')
+                self.assertEqual([row[0] for row in db.fetchall()], [TASK_QUEUE])
+
+    def test_persistent_connection(self):
+        ''' Test that a persistent connection is reused, and replaced when broken.
+        '''
+        connection = PersistentConnection(self.database_url)
+        stats1 = connection_stats()
+        
+        conn1 = connection.get()
+        self.assertIs(connection.get(), conn1, 'Should reuse a healthy connection')
+        
+        with conn1.cursor() as db:
+            self.assertRaises(Exception, db.execute, 'SELECT nonsense FROM nowhere')
+        
+        self.assertIs(connection.get(), conn1, 'Should recover from a failed transaction')
+        
+        conn1.close()
+        conn2 = connection.get()
+        self.assertIsNot(conn2, conn1, 'Should replace a closed connection')
+        self.assertFalse(conn2.closed)
+        
+        stats2 = connection_stats()
+        self.assertEqual(stats2['connects'] - stats1['connects'], 2)
+        self.assertEqual(stats2['reconnects'] - stats1['reconnects'], 1)
+        
+        connection.close()
+        self.assertTrue(conn2.closed)
+
     @patch('openaddr.jobs.JOB_TIMEOUT', new=timedelta(seconds=1))
     @patch('openaddr.ci.DUETASK_DELAY', new=timedelta(seconds=1))
     @patch('openaddr.ci.WORKER_COOLDOWN', new=timedelta(seconds=0))
@@ -1615,7 +1797,7 @@ class TestRuns (unittest.TestCase):
         
         source_id, source_path = '0xDEADBEEF', 'sources/us-ca-oakland.json'
         
-        def returns_plausible_result(s3, run_id, source_name, content, output_dir):
+        def returns_plausible_result(s3, run_id, source_name, content, output_dir, timeout=None, cache_state=None, cancelled=None):
             return dict(message=MAGIC_OK_MESSAGE, output={"source": "user_input.txt"})
         
         do_work.side_effect = returns_plausible_result
@@ -1661,6 +1843,313 @@ class TestRuns (unittest.TestCase):
                 recent_workers = get_recent_workers(db)
                 self.assertEqual(len(recent_workers[TEMPORARY_KIND]), 1)
      
+    @patch('openaddr.ci.WORKER_COOLDOWN', new=timedelta(seconds=0))
+    @patch('openaddr.ci.worker.do_work')
+    def test_superseded_job(self, do_work):
+        ''' Test that a newer commit to a pull request cancels waiting tasks.
+        '''
+        def returns_plausible_result(s3, run_id, source_name, content, output_dir, timeout=None, cache_state=None, cancelled=None):
+            return dict(message=MAGIC_OK_MESSAGE, output={"source": "user_input.txt"})
+        
+        do_work.side_effect = returns_plausible_result
+
+        with db_connect(self.database_url) as conn:
+            task_Q = db_queue(conn, TASK_QUEUE)
+            done_Q = db_queue(conn, DONE_QUEUE)
+            due_Q = db_queue(conn, DUE_QUEUE)
+            beat_Q = db_queue(conn, HEARTBEAT_QUEUE)
+            
+            files1 = {'sources/a.json': (en64(b'{}'), 'a1'), 'sources/b.json': (en64(b'{}'), 'b1')}
+            files2 = {'sources/a.json': (en64(b'{ }'), 'a2')}
+            
+            with patch('openaddr.ci.post_github_status') as post_github_status:
+                job_id1 = create_queued_job(task_Q, files1, *self.fake_queued_job_args_unmerged,
+                                            ref='pull/1', github_auth=self.github_auth)
+                self.assertEqual(post_github_status.call_count, 0)
+
+                job_id2 = create_queued_job(task_Q, files2, *self.fake_queued_job_args,
+                                            ref='pull/1', github_auth=self.github_auth)
+                self.assertEqual(post_github_status.call_count, 1)
+            
+            status_url, status_json, _ = post_github_status.call_args[0]
+            self.assertEqual(status_url, self.fake_queued_job_args_unmerged[-1])
+            self.assertEqual(status_json['state'], 'error')
+            self.assertTrue('Superseded' in status_json['description'])
+            
+            with task_Q as db:
+                job1, job2 = read_job(db, job_id1), read_job(db, job_id2)
+            
+            self.assertIs(job1.status, False)
+            self.assertEqual(set(job1.states.values()), set([False]))
+            self.assertIsNone(job2.status)
+            
+            with HTTMock(self.response_content):
+                while pop_task_from_taskqueue(self.s3, task_Q, done_Q, due_Q, beat_Q, self.output_dir, None):
+                    pass
+            
+            self.assertEqual(do_work.call_count, 1, 'Should only run the newer job')
+            self.assertEqual(len(done_Q), 1)
+
+    @patch('openaddr.ci.DEAD_WORKER_TIMEOUT', new=timedelta(seconds=1))
+    @patch('openaddr.ci.DEAD_WORKER_RETRIES', new=1)
+    @patch('openaddr.ci.WORKER_COOLDOWN', new=timedelta(seconds=0))
+    @patch('openaddr.ci.worker.do_work')
+    def test_dead_worker(self, do_work):
+        ''' Test that tasks from workers without heartbeats are retried, then failed.
+        '''
+        def dies_without_a_trace(s3, run_id, source_name, content, output_dir, timeout=None, cache_state=None, cancelled=None):
+            raise NotImplementedError('Worker vanished.')
+        
+        do_work.side_effect = dies_without_a_trace
+
+        with db_connect(self.database_url) as conn:
+            task_Q = db_queue(conn, TASK_QUEUE)
+            batch_Q = db_queue(conn, BATCH_TASK_QUEUE)
+            done_Q = db_queue(conn, DONE_QUEUE)
+            due_Q = db_queue(conn, DUE_QUEUE)
+            beat_Q = db_queue(conn, HEARTBEAT_QUEUE)
+            
+            task_Q.put(dict(name='sources/a.json', content_b64=en64(b'{}'), file_id='a',
+                            job_id=None, url=None, commit_sha=None, set_id=None))
+            
+            with self.assertRaises(NotImplementedError):
+                pop_task_from_taskqueue(self.s3, task_Q, done_Q, due_Q, beat_Q, self.output_dir, None)
+            
+            flush_heartbeat_queue(beat_Q)
+            self.assertEqual(reap_dead_worker_tasks(due_Q, task_Q, batch_Q), 0, 'Worker is still alive')
+            self.assertEqual(len(task_Q), 0)
+            
+            sleep(1.1)
+            self.assertEqual(reap_dead_worker_tasks(due_Q, task_Q, batch_Q), 1)
+            self.assertEqual(len(task_Q), 1, 'Task should be back in the queue')
+            self.assertEqual(len(due_Q), 0)
+            
+            with self.assertRaises(NotImplementedError):
+                pop_task_from_taskqueue(self.s3, task_Q, done_Q, due_Q, beat_Q, self.output_dir, None)
+            
+            run_ids = [call[0][1] for call in do_work.call_args_list]
+            self.assertEqual(run_ids[0], run_ids[1], 'Retry should reuse the run')
+            
+            with task_Q as db:
+                db.execute('SELECT retries FROM runs ORDER BY id')
+                self.assertEqual([retries for (retries, ) in db.fetchall()], [1])
+            
+            sleep(1.1)
+            self.assertEqual(reap_dead_worker_tasks(due_Q, task_Q, batch_Q), 1)
+            self.assertEqual(len(task_Q), 0, 'Task should not be retried again')
+            
+            # Due task is now due, and will fail the run.
+            pop_task_from_duequeue(due_Q, None)
+
+            with task_Q as db:
+                db.execute('SELECT status, retries FROM runs ORDER BY id')
+                self.assertEqual(db.fetchall()[-1], (False, 1))
+
+    @patch('openaddr.ci.DEAD_WORKER_TIMEOUT', new=timedelta(seconds=1))
+    @patch('openaddr.ci.WORKER_COOLDOWN', new=timedelta(seconds=0))
+    @patch('openaddr.ci.worker.do_work')
+    def test_dead_worker_speculated(self, do_work):
+        ''' Test that a dead worker's run is left to a live speculative duplicate.
+        '''
+        def dies_without_a_trace(s3, run_id, source_name, content, output_dir, timeout=None, cache_state=None, cancelled=None):
+            raise NotImplementedError('Worker vanished.')
+        
+        do_work.side_effect = dies_without_a_trace
+
+        with db_connect(self.database_url) as conn:
+            task_Q = db_queue(conn, TASK_QUEUE)
+            batch_Q = db_queue(conn, BATCH_TASK_QUEUE)
+            done_Q = db_queue(conn, DONE_QUEUE)
+            due_Q = db_queue(conn, DUE_QUEUE)
+            beat_Q = db_queue(conn, HEARTBEAT_QUEUE)
+            
+            with batch_Q as db:
+                the_set = add_set(db, 'openaddresses', 'hooked-on-sources')
+            
+            task_data = dict(name='sources/a.json', content_b64=en64(b'{}'), file_id='a',
+                             job_id=None, url=None, commit_sha=None, set_id=the_set.id)
+            batch_Q.put(task_data)
+            
+            with self.assertRaises(NotImplementedError):
+                pop_task_from_taskqueue(self.s3, batch_Q, done_Q, due_Q, beat_Q, self.output_dir, None)
+            
+            run_id = do_work.call_args[0][1]
+            batch_Q.put(dict(task_data, speculative_run_id=run_id))
+            
+            with patch.dict('openaddr.ci._worker_slot', {'slot': 1}):
+                with self.assertRaises(NotImplementedError):
+                    pop_task_from_taskqueue(self.s3, batch_Q, done_Q, due_Q, beat_Q, self.output_dir, None)
+                
+                duplicate_worker_id = _worker_id()
+            
+            self.assertEqual(len(due_Q), 2, 'Each attempt should send a due task')
+            flush_heartbeat_queue(beat_Q)
+            
+            # Only the duplicate's worker is still alive.
+            sleep(1.1)
+            beat_Q.put({'worker_id': duplicate_worker_id, 'worker_kind': None})
+            flush_heartbeat_queue(beat_Q)
+            
+            self.assertEqual(reap_dead_worker_tasks(due_Q, task_Q, batch_Q), 1)
+            self.assertEqual(len(batch_Q), 0, 'Run should be left to the duplicate')
+            self.assertEqual(len(due_Q), 1)
+            
+            # Now the duplicate's worker is gone too.
+            sleep(1.1)
+            self.assertEqual(reap_dead_worker_tasks(due_Q, task_Q, batch_Q), 1)
+            self.assertEqual(len(batch_Q), 1, 'Run should be retried')
+            
+            retry_data = batch_Q.get(block=False).data
+            self.assertEqual(retry_data['retry_run_id'], run_id)
+            self.assertNotIn('speculative_run_id', retry_data)
+
+            with batch_Q as db:
+                run = read_run(db, run_id)
+                self.assertIsNone(run.status, 'Run should wait for its retry')
+
+    @patch('openaddr.ci.WORKER_COOLDOWN', new=timedelta(seconds=0))
+    @patch('openaddr.ci.worker.do_work')
+    def test_speculative_run(self, do_work):
+        ''' Test that slow batch runs are duplicated once, and only one result is kept.
+        '''
+        def is_still_busy(s3, run_id, source_name, content, output_dir, timeout=None, cache_state=None, cancelled=None):
+            raise NotImplementedError('Worker is still busy.')
+        
+        def returns_plausible_result(s3, run_id, source_name, content, output_dir, timeout=None, cache_state=None, cancelled=None):
+            return dict(message=MAGIC_OK_MESSAGE, output={"source": "user_input.txt"})
+        
+        do_work.side_effect = is_still_busy
+
+        with db_connect(self.database_url) as conn:
+            batch_Q = db_queue(conn, BATCH_TASK_QUEUE)
+            done_Q = db_queue(conn, DONE_QUEUE)
+            due_Q = db_queue(conn, DUE_QUEUE)
+            beat_Q = db_queue(conn, HEARTBEAT_QUEUE)
+            
+            with batch_Q as db:
+                the_set = add_set(db, 'openaddresses', 'hooked-on-sources')
+            
+            task_data = dict(name='sources/a.json', content_b64=en64(b'{}'), file_id='a',
+                             job_id=None, url=None, commit_sha=None, set_id=the_set.id)
+            batch_Q.put(task_data)
+            
+            with self.assertRaises(NotImplementedError):
+                pop_task_from_taskqueue(self.s3, batch_Q, done_Q, due_Q, beat_Q, self.output_dir, None)
+            
+            run_id = do_work.call_args[0][1]
+            flush_heartbeat_queue(beat_Q)
+            speculated, run_times = set(), {'sources/a.json': .1}
+            sleep(.2)
+            
+            self.assertEqual(speculate_batch_runs(batch_Q, the_set, run_times, speculated), 0, 'No workers are idle')
+            
+            beat_Q.put({'worker_id': 'idle', 'worker_kind': TEMPORARY_KIND})
+            flush_heartbeat_queue(beat_Q)
+            
+            # A previous run that spent most of its time caching isn't slow yet.
+            with patch('openaddr.ci.objects.read_latest_set'), \
+                 patch('openaddr.ci.objects.read_completed_runs_to_date') as read_completed_runs_to_date:
+                state = RunState({'cache time': '0:00:10', 'process time': '0:00:00.05'})
+                read_completed_runs_to_date.return_value = [Run(None, 'sources/a.json', None, b'', None, state,
+                                                                None, None, None, None, None, None, None, None)]
+                cache_run_times = get_batch_run_times(None, 'openaddresses', 'hooked-on-sources')
+            
+            self.assertEqual(speculate_batch_runs(batch_Q, the_set, cache_run_times, speculated), 0, 'Should count cache time')
+            self.assertEqual(speculated, set())
+            
+            self.assertEqual(speculate_batch_runs(batch_Q, the_set, run_times, speculated), 1)
+            self.assertEqual(speculate_batch_runs(batch_Q, the_set, run_times, speculated), 0, 'Should only duplicate once')
+            self.assertEqual(speculated, set([run_id]))
+            self.assertEqual(len(batch_Q), 1)
+            
+            do_work.side_effect = returns_plausible_result
+            pop_task_from_taskqueue(self.s3, batch_Q, done_Q, due_Q, beat_Q, self.output_dir, None)
+            self.assertEqual(do_work.call_args[0][1], run_id, 'Should share the original run')
+            
+            pop_task_from_donequeue(done_Q, None)
+            
+            # A late duplicate is skipped, and a late speculative result is ignored.
+            batch_Q.put(dict(task_data, speculative_run_id=run_id))
+            self.assertTrue(pop_task_from_taskqueue(self.s3, batch_Q, done_Q, due_Q, beat_Q, self.output_dir, None))
+            self.assertEqual(do_work.call_count, 2)
+            
+            with batch_Q as db:
+                set_run(db, run_id, 'sources/a.json', 'a', en64(b'{}'), RunState(None),
+                        False, None, None, None, True, the_set.id, speculative=True)
+                self.assertIs(read_run(db, run_id).status, True)
+    
+    @patch('openaddr.ci.WORKER_COOLDOWN', new=timedelta(seconds=0))
+    @patch('openaddr.ci.SPECULATIVE_CHECK_INTERVAL', new=timedelta(seconds=1))
+    @patch('openaddr.ci.worker.do_work')
+    def test_speculative_run_loser(self, do_work):
+        ''' Test that the losing attempt at a speculated run is cancelled.
+        '''
+        def loses_the_race(s3, run_id, source_name, content, output_dir, timeout=None, cache_state=None, cancelled=None):
+            with db_connect(self.database_url) as conn2:
+                with conn2.cursor() as db:
+                    set_run(db, run_id, 'sources/a.json', 'a', en64(b'{}'), RunState(None),
+                            True, None, 'winner', None, True, the_set.id, speculative=True)
+            
+            self.assertTrue(cancelled.wait(5), 'Should be cancelled once the run is finished')
+            raise JobCancelled()
+        
+        do_work.side_effect = loses_the_race
+
+        with db_connect(self.database_url) as conn:
+            batch_Q = db_queue(conn, BATCH_TASK_QUEUE)
+            done_Q = db_queue(conn, DONE_QUEUE)
+            due_Q = db_queue(conn, DUE_QUEUE)
+            beat_Q = db_queue(conn, HEARTBEAT_QUEUE)
+            
+            with batch_Q as db:
+                the_set = add_set(db, 'openaddresses', 'hooked-on-sources')
+            
+            batch_Q.put(dict(name='sources/a.json', content_b64=en64(b'{}'), file_id='a',
+                             job_id=None, url=None, commit_sha=None, set_id=the_set.id))
+            
+            self.assertTrue(pop_task_from_taskqueue(self.s3, batch_Q, done_Q, due_Q, beat_Q, self.output_dir, None))
+            self.assertEqual(len(done_Q), 0, 'Should not send a result from the loser')
+            
+            with batch_Q as db:
+                run = read_run(db, do_work.call_args[0][1])
+                self.assertEqual((run.status, run.worker_id), (True, 'winner'))
+
+    @patch('openaddr.ci.BATCH_FAIRNESS', new=2)
+    @patch.dict('openaddr.ci._lane_status', {'ci streak': 0})
+    @patch('openaddr.ci.WORKER_COOLDOWN', new=timedelta(seconds=0))
+    @patch('openaddr.ci.worker.do_work')
+    def test_task_lanes(self, do_work):
+        ''' Test that CI tasks come before batch tasks, but not forever.
+        '''
+        source_names = []
+        
+        def returns_plausible_result(s3, run_id, source_name, content, output_dir, timeout=None, cache_state=None, cancelled=None):
+            source_names.append(source_name)
+            return dict(message=MAGIC_OK_MESSAGE, output={"source": "user_input.txt"})
+        
+        do_work.side_effect = returns_plausible_result
+
+        with db_connect(self.database_url) as conn:
+            task_Q = db_queue(conn, TASK_QUEUE)
+            batch_Q = db_queue(conn, BATCH_TASK_QUEUE)
+            done_Q = db_queue(conn, DONE_QUEUE)
+            due_Q = db_queue(conn, DUE_QUEUE)
+            beat_Q = db_queue(conn, HEARTBEAT_QUEUE)
+            
+            for (queue, name) in [(batch_Q, 'b1'), (batch_Q, 'b2'), (task_Q, 'c1'), (task_Q, 'c2'),
+                                  (task_Q, 'c3'), (task_Q, 'c4'), (task_Q, 'c5')]:
+                queue.put(dict(name='sources/{}.json'.format(name), content_b64=en64(b'{}'),
+                               file_id=name, job_id=None, url=None, commit_sha=None, set_id=None))
+            
+            with task_Q as db:
+                self.assertTrue(get_queue_wait(db, TASK_QUEUE) >= 0)
+                self.assertEqual(get_queue_wait(db, 'nothing'), 0)
+            
+            while pop_task_from_lanes(self.s3, task_Q, batch_Q, done_Q, due_Q, beat_Q, self.output_dir, None):
+                pass
+        
+        self.assertEqual(source_names, ['c1', 'c2', 'b1', 'c3', 'c4', 'b2', 'c5'])
+
     @patch('openaddr.jobs.JOB_TIMEOUT', new=timedelta(seconds=2))
     @patch('openaddr.ci.DUETASK_DELAY', new=timedelta(seconds=1))
     @patch('openaddr.ci.WORKER_COOLDOWN', new=timedelta(seconds=0))
@@ -1740,7 +2229,7 @@ class TestRuns (unittest.TestCase):
     def test_overdue_run(self, do_work):
         ''' Test a run that succeeds past its due date.
         '''
-        def returns_plausible_result(s3, run_id, source_name, content, output_dir):
+        def returns_plausible_result(s3, run_id, source_name, content, output_dir, timeout=None, cache_state=None, cancelled=None):
             return dict(message=MAGIC_OK_MESSAGE, output={"source": "user_input.txt"})
 
         do_work.side_effect = returns_plausible_result
@@ -1843,6 +2332,7 @@ class TestRuns (unittest.TestCase):
             
             # Look for log file message in output.
             self.assertIn(b'Took too long.', self.s3._read_fake_key(urlparse(state['output']).path))
+            self.assertEqual(state['timeout'], 1, 'Should remember the timeout')
 
     @patch('openaddr.jobs.JOB_TIMEOUT', new=timedelta(seconds=1))
     @patch('openaddr.ci.DUETASK_DELAY', new=timedelta(seconds=1))
@@ -1905,10 +2395,10 @@ class TestRuns (unittest.TestCase):
         source_id, source_path = '0xDEADBEEF', 'sources/us-ca-oakland.json'
         fprint = itertools.count(1)
         
-        def returns_plausible_result(s3, run_id, source_name, content, output_dir):
+        def returns_plausible_result(s3, run_id, source_name, content, output_dir, timeout=None, cache_state=None, cancelled=None):
             return dict(message='Something went wrong', output={"source": "user_input.txt", "fingerprint": next(fprint)}, result_code=0, result_stdout='...')
         
-        def raises_an_error(s3, run_id, source_name, content, output_dir):
+        def raises_an_error(s3, run_id, source_name, content, output_dir, timeout=None, cache_state=None, cancelled=None):
             raise Exception('Worker did not know to re-use previous run')
         
         # Do the work.
@@ -2012,7 +2502,7 @@ class TestRuns (unittest.TestCase):
         source_id, source_path = '0xDEADBEEF', 'sources/us-ca-oakland.json'
         fprint = itertools.count(1)
         
-        def returns_plausible_result(s3, run_id, source_name, content, output_dir):
+        def returns_plausible_result(s3, run_id, source_name, content, output_dir, timeout=None, cache_state=None, cancelled=None):
             return dict(message=MAGIC_OK_MESSAGE, output={"source": "user_input.txt", "fingerprint": next(fprint)}, result_code=0, result_stdout='...')
         
         do_work.side_effect = returns_plausible_result
@@ -2089,6 +2579,59 @@ class TestWorker (unittest.TestCase):
         self.assertEqual(make_source_filename(u'yo/yo'), u'yo--yo.txt')
         self.assertEqual(make_source_filename(u'yó/yó'), u'yó--yó.txt')
     
+    def test_worker_slots(self):
+        '''
+        '''
+        plain_id = _worker_id()
+        
+        try:
+            set_worker_slot(11)
+            slot_id = _worker_id()
+        finally:
+            set_worker_slot(None)
+        
+        self.assertEqual(slot_id, plain_id + '-11')
+        self.assertEqual(_worker_id(), plain_id)
+        self.assertTrue(len(slot_id) <= 32, 'Should fit in runs.worker_id')
+        
+        os.mkdir(join(self.output_dir, 'work'))
+        for (name, size) in (('a.txt', 10), ('work/b.txt', 25)):
+            with open(join(self.output_dir, name), 'wb') as file:
+                file.write(b'x' * size)
+        
+        self.assertEqual(disk_usage(self.output_dir), 35)
+    
+    @patch('openaddr.ci.worker.MULTIPART_PART_SIZE', 10)
+    @patch('openaddr.ci.worker.MULTIPART_THRESHOLD', 16)
+    def test_upload_multipart_file(self):
+        '''
+        '''
+        filename = join(self.output_dir, 'cache.csv')
+        with open(filename, 'wb') as file:
+            file.write(b'0123456789abcdefghijABCDE')
+        
+        s3, parts = mock.Mock(), dict()
+        s3.new_key.return_value.generate_url.return_value = 'http://fake-s3.local/runs/1/cache.csv'
+        
+        def upload_part_from_file(file, part_num, size):
+            parts[part_num] = file.read(size)
+        
+        upload = s3.bucket.initiate_multipart_upload.return_value
+        upload.id, upload.key_name = 'upload-id', '/runs/1/cache.csv'
+        
+        with mock.patch('boto.s3.multipart.MultiPartUpload') as MultiPartUpload:
+            part_upload = MultiPartUpload.return_value
+            part_upload.upload_part_from_file.side_effect = upload_part_from_file
+            url, fingerprint = upload_file(s3, '/runs/1/cache.csv', filename)
+        
+        self.assertEqual(url, 'http://fake-s3.local/runs/1/cache.csv')
+        self.assertEqual(fingerprint, hashlib.md5(b'0123456789abcdefghijABCDE').hexdigest())
+        self.assertEqual(parts, {1: b'0123456789', 2: b'abcdefghij', 3: b'ABCDE'})
+        self.assertEqual((part_upload.id, part_upload.key_name), ('upload-id', '/runs/1/cache.csv'))
+        self.assertFalse(s3.bucket.get_all_multipart_uploads.called)
+        self.assertTrue(upload.complete_upload.called)
+        self.assertFalse(s3.new_key.return_value.set_contents_from_filename.called)
+    
     @patch('tempfile.mkdtemp')
     @patch('openaddr.compat.check_output')
     def test_happy_worker(self, check_output, mkdtemp):
@@ -2154,6 +2697,65 @@ class TestWorker (unittest.TestCase):
         self.assertTrue(u'Website: http://example.com\n' in readme_content)
         self.assertTrue(u'License: GPL\n' in readme_content)
     
+    def test_reusable_cache_state(self):
+        ''' Test that cached data is reused when only the conform section changes.
+        '''
+        source1 = b'{"data": "http://example.com/a.zip", "type": "http", "conform": {"type": "shapefile"}}'
+        source2 = b'{"data": "http://example.com/a.zip", "type": "http", "conform": {"type": "csv"}}'
+        source3 = b'{"data": "http://example.com/b.zip", "type": "http", "conform": {"type": "csv"}}'
+        state = {'cache': 'http://example.com/cache.zip', 'fingerprint': 'xyz', 'version': None}
+        
+        db = mock.Mock()
+        db.fetchall.return_value = [(456, en64(source1).encode('ascii'), state)]
+        
+        self.assertEqual(get_reusable_cache_state(db, 'sources/a.json', en64(source2), '1 day'),
+                         dict(cache='http://example.com/cache.zip', fingerprint='xyz', version=None, run_id=456))
+        
+        self.assertIsNone(get_reusable_cache_state(db, 'sources/a.json', en64(source3), '1 day'))
+        self.assertIsNone(get_reusable_cache_state(db, 'sources/a.json', en64(b'{}'), '1 day'))
+        self.assertIsNone(get_reusable_cache_state(db, 'sources/a.json', en64(b'nope'), '1 day'))
+    
+    @patch('tempfile.mkdtemp')
+    @patch('openaddr.compat.check_output')
+    def test_cache_reusing_worker(self, check_output, mkdtemp):
+        '''
+        '''
+        def does_what_its_told(cmd, timeout=None):
+            index_path = '{id}/out/user_input/index.json'.format(**task_data)
+            index_filename = os.path.join(self.output_dir, index_path)
+            index_dirname = os.path.dirname(index_filename)
+            os.makedirs(index_dirname)
+            
+            with open(index_filename, 'w') as file:
+                file.write('''[ ["skipped", "source", "cache", "sample", "website", "license", "geometry type", "address count", "version", "fingerprint", "cache time", "processed", "process time", "output"], [false, "user_input.txt", "http://example.com/cache.zip", "sample.json", "http://example.com", "GPL", "Point", 62384, null, "xyz", null, "out.csv", "0:00:33.808682", "output.txt"] ]''')
+            
+            for name in ('sample.json', 'out.csv', 'output.txt'):
+                with open(os.path.join(index_dirname, name), 'w') as file:
+                    file.write('Yo')
+            
+            return index_filename
+        
+        def same_tempdir_every_time(prefix, dir):
+            os.mkdir(join(dir, 'work'))
+            return join(dir, 'work')
+        
+        task_data = dict(id='0xDEADBEEF', content='{ }', name='Dead Beef', url=None)
+        check_output.side_effect = does_what_its_told
+        mkdtemp.side_effect = same_tempdir_every_time
+        
+        cache_state = dict(cache='http://example.com/cache.zip', fingerprint='xyz', version=None, run_id=456)
+        result = worker.do_work(self.s3, -1, 'user_input', task_data['content'], self.output_dir, None, cache_state)
+        
+        (cmd, ), _ = check_output.call_args
+        self.assertEqual(cmd[-2], '--cache-state')
+        self.assertEqual(json.loads(cmd[-1]), dict(cache='http://example.com/cache.zip', fingerprint='xyz', version=None))
+        
+        self.assertEqual(result['message'], MAGIC_OK_MESSAGE)
+        self.assertEqual(result['output']['cache'], 'http://example.com/cache.zip', 'Should not upload again')
+        self.assertEqual(result['output']['fingerprint'], 'xyz')
+        self.assertEqual(result['output']['cache run'], 456)
+        self.assertEqual(RunState(result['output']).cache_run, 456)
+
     @patch('tempfile.mkdtemp')
     @patch('openaddr.compat.check_output')
     def test_angry_worker(self, check_output, mkdtemp):
@@ -2185,6 +2787,38 @@ class TestWorker (unittest.TestCase):
         self.assertEqual(result['result_stdout'], 'Everything is ruined.\n')
         self.assertEqual(result['result_code'], 1)
 
+    @patch('tempfile.mkdtemp')
+    @patch('openaddr.compat.check_output')
+    @patch('openaddr.ci.worker.process_pool')
+    def test_preforked_angry_worker(self, process_pool, check_output, mkdtemp):
+        '''
+        '''
+        def raises_called_process_error(cmd, timeout=None, cancelled=None):
+            raise compat.CalledProcessError(1, cmd, 'Everything is ruined.\n')
+        
+        def same_tempdir_every_time(prefix, dir):
+            os.mkdir(join(dir, 'work'))
+            return join(dir, 'work')
+        
+        task_data = dict(id='0xDEADBEEF', content='{ }', name='Dead Beef', url=None)
+        process_pool.check_output.side_effect = raises_called_process_error
+        mkdtemp.side_effect = same_tempdir_every_time
+        
+        job_id, content = task_data['id'], task_data['content']
+        result = worker.do_work(self.s3, -1, 'angry', content, self.output_dir)
+        
+        self.assertFalse(check_output.called)
+        process_pool.check_output.assert_called_with((
+            'openaddr-process-one', '-l',
+            os.path.join(self.output_dir, 'work/logfile.txt'),
+            os.path.join(self.output_dir, 'work/angry.txt'),
+            os.path.join(self.output_dir, 'work/out')
+            ),
+            timeout=JOB_TIMEOUT.seconds + JOB_TIMEOUT.days * 86400, cancelled=None)
+        
+        self.assertEqual(result['message'], 'Something went wrong in openaddr-process-one')
+        self.assertEqual(result['result_code'], 1)
+
     @patch('tempfile.mkdtemp')
     @patch('openaddr.compat.check_output')
     def test_skippy_worker(self, check_output, mkdtemp):
@@ -2360,16 +2994,16 @@ class TestBatch (unittest.TestCase):
         
         with patch('openaddr.ci.objects.read_latest_set') as read_latest_set, patch('openaddr.ci.objects.read_completed_runs_to_date') as read_completed_runs_to_date:
             read_completed_runs_to_date.return_value = [
-                Run(_, 'sources/foo.json', _, b'', _, RunState({'process time': '01:01'}), _, _, _, _, _, _, _, _),
-                Run(_, 'sources/bar.json', _, b'', _, RunState({'process time': '00:01'}), _, _, _, _, _, _, _, _),
-                Run(_, 'sources/baz.json', _, b'', _, RunState({'process time': '00:01'}), _, _, _, _, _, _, _, _),
+                Run(_, 'sources/foo.json', _, b'', _, RunState({'cache time': '0:10:00', 'process time': '0:01:01'}), _, _, _, _, _, _, _, _),
+                Run(_, 'sources/bar.json', _, b'', _, RunState({'process time': '0:00:01'}), _, _, _, _, _, _, _, _),
+                Run(_, 'sources/baz.json', _, b'', _, RunState({'cache time': '0:00:01'}), _, _, _, _, _, _, _, _),
                 ]
 
             run_times = get_batch_run_times(_, 'openaddresses', 'openaddresses')
             
-            self.assertEqual(run_times['sources/foo.json'], '01:01')
-            self.assertEqual(run_times['sources/bar.json'], '00:01')
-            self.assertEqual(run_times['sources/baz.json'], '00:01')
+            self.assertEqual(run_times['sources/foo.json'], 661, 'Should include cache time')
+            self.assertEqual(run_times['sources/bar.json'], 1)
+            self.assertIsNone(run_times['sources/baz.json'], 'Should be unknown without process time')
             self.assertEqual(len(run_times), 3)
     
     def test_is_merged_to_master(self):
@@ -2397,6 +3031,199 @@ class TestBatch (unittest.TestCase):
                 self.assertIs(is_merged_to_master(_, _, _, 'a7266f30', _), True, 'This commit is merged')
                 self.assertIsNone(is_merged_to_master(_, _, _, 'gobbledygook', _), 'This commit is unknown')
     
+    def test_batch_sources_from_archive(self):
+        ''' Show that batch sources can come from one git tree and one tarball.
+        '''
+        commit_sha, prefix = '8dd262c2f30a70b27e371869c54315b1abc32247', 'openaddresses-hooked-on-sources-8dd262c'
+        paths = [u'sources/us-ca-berkeley.json', u'sources/fr/la-réunion.json', u'README.md']
+        
+        tree, tarball = [], BytesIO()
+        
+        with tarfile.open(fileobj=tarball, mode='w:gz') as archive:
+            for path in paths:
+                content = json.dumps(dict(path=path)).encode('utf8')
+                git_header = 'blob {}\0'.format(len(content)).encode('ascii')
+                tree.append(dict(path=path, type='blob', sha=hashlib.sha1(git_header + content).hexdigest()))
+
+                info = tarfile.TarInfo(u'{}/{}'.format(prefix, path))
+                info.size = len(content)
+                archive.addfile(info, BytesIO(content))
+        
+        requested = []
+        
+        def response_content(url, request):
+            requested.append(url.path)
+            
+            if url.path == '/repos/openaddresses/hooked-on-sources/git/trees/55f5da58da7b14f02da8f1214fd72d1bc8f02ba3':
+                data = json.dumps(dict(sha='55f5da58da7b14f02da8f1214fd72d1bc8f02ba3', tree=tree, truncated=False))
+                return response(200, data.encode('utf8'), headers={'Content-Type': 'application/json; charset=utf-8'})
+            
+            if url.path == '/repos/openaddresses/hooked-on-sources/tarball/' + commit_sha:
+                return response(200, tarball.getvalue(), headers={'Content-Type': 'application/x-gzip'})
+            
+            return self.response_content(url, request)
+        
+        with HTTMock(response_content):
+            sources = list(find_batch_sources('openaddresses', 'hooked-on-sources', self.github_auth))
+        
+        self.assertEqual(len(requested), 5, 'Should need just five Github requests')
+        self.assertEqual(sorted(source['path'] for source in sources), sorted(paths[:2]))
+        
+        for source in sources:
+            self.assertEqual(source['commit_sha'], commit_sha)
+            self.assertEqual(json.loads(b64decode(source['content']).decode('utf8')), dict(path=source['path']))
+            self.assertIn(source['blob_sha'], [item['sha'] for item in tree])
+            self.assertIn('/contents/sources/', source['url'])
+        
+        self.assertEqual([source['remain'] for source in sources], [1, 0])
+    
+    def test_batch_scheduling(self):
+        ''' Show that batch queue depth and projected time depend on active workers.
+        '''
+        self.assertEqual(project_batch_time([], 2), 0)
+        self.assertEqual(project_batch_time([30, 20, 10], 0), 60)
+        self.assertEqual(project_batch_time([30, 20, 10], 2), 30)
+        self.assertEqual(project_batch_time([None, 30, 20, 10], 2), 40, 'Unknown should be average')
+        self.assertEqual(project_batch_time([None, None], 2), 0)
+        
+        with db_connect(self.database_url) as conn:
+            beat_Q = db_queue(conn, HEARTBEAT_QUEUE)
+            self.assertEqual(get_batch_queue_depth(beat_Q), 1, 'Should keep one task with no workers')
+            
+            for worker_id in ('a', 'b', 'c'):
+                beat_Q.put({'worker_id': worker_id, 'worker_kind': TEMPORARY_KIND})
+            
+            flush_heartbeat_queue(beat_Q)
+            self.assertEqual(get_batch_queue_depth(beat_Q), 3, 'Should keep one task per worker')
+            
+            # An idle worker finds no tasks, but still puts a heartbeat.
+            task_Q, batch_Q = db_queue(conn, TASK_QUEUE), db_queue(conn, BATCH_TASK_QUEUE)
+            done_Q, due_Q = db_queue(conn, DONE_QUEUE), db_queue(conn, DUE_QUEUE)
+            
+            with patch.dict('openaddr.ci._lane_status', {'next heartbeat': 0}):
+                self.assertFalse(pop_task_from_lanes(None, task_Q, batch_Q, done_Q, due_Q, beat_Q, None, TEMPORARY_KIND))
+                self.assertFalse(pop_task_from_lanes(None, task_Q, batch_Q, done_Q, due_Q, beat_Q, None, TEMPORARY_KIND))
+            
+            self.assertEqual(len(beat_Q), 1, 'Should put one idle heartbeat per interval')
+            flush_heartbeat_queue(beat_Q)
+            self.assertEqual(get_batch_queue_depth(beat_Q), 4, 'Should count idle worker')
+    
+    @patch('openaddr.jobs.JOB_TIMEOUT', new=timedelta(hours=9))
+    @patch('openaddr.ci.SOURCE_TIMEOUT_MIN', new=timedelta(minutes=1))
+    def test_source_timeouts(self):
+        ''' Show that source timeouts follow their recent run times.
+        '''
+        self.assertIsNone(estimate_source_timeout([]))
+        self.assertEqual(estimate_source_timeout([30]), 90)
+        self.assertEqual(estimate_source_timeout([1]), 60, 'Should be no shorter than minimum')
+        self.assertEqual(estimate_source_timeout([86400]), 9 * 3600, 'Should be no longer than maximum')
+        self.assertEqual(estimate_source_timeout([100] + [30] * 9), 90, 'Should ignore one outlier')
+        self.assertEqual(estimate_source_timeout([100] * 2 + [30] * 8), 300)
+        
+        db = mock.Mock()
+        db.fetchone.return_value = None
+        db.fetchall.return_value = [('0:00:10', '0:00:20'), (None, '0:00:25'), ('0:00:10', None)]
+        self.assertEqual(get_source_timeout(db, 'sources/a.json'), 90)
+        
+        db.fetchall.return_value = []
+        self.assertIsNone(get_source_timeout(db, 'sources/a.json'))
+    
+    @patch('openaddr.jobs.JOB_TIMEOUT', new=timedelta(minutes=20))
+    @patch('openaddr.ci.SOURCE_TIMEOUT_MIN', new=timedelta(minutes=1))
+    def test_source_timeouts_after_timeout(self):
+        ''' Show that a source gets more time after timing out, until it succeeds.
+        '''
+        def finish_run(db, status, state):
+            run_id = add_run(db)
+            set_run(db, run_id, 'sources/a.json', 'a', en64(b'{}'), RunState(state),
+                    status, None, None, None, True, None)
+        
+        with db_connect(self.database_url) as conn:
+            with conn.cursor() as db:
+                finish_run(db, True, {'cache time': '0:00:10', 'process time': '0:00:20'})
+                self.assertEqual(get_source_timeout(db, 'sources/a.json'), 90)
+                
+                finish_run(db, False, {'timeout': 90})
+                self.assertEqual(get_source_timeout(db, 'sources/a.json'), 180, 'Should double after a timeout')
+                
+                finish_run(db, False, {'timeout': 720})
+                self.assertEqual(get_source_timeout(db, 'sources/a.json'), 1200, 'Should stop at JOB_TIMEOUT')
+                
+                finish_run(db, False, {'output': 'http://example.com/logfile.txt'})
+                self.assertEqual(get_source_timeout(db, 'sources/a.json'), 90, 'Should ignore other failures')
+                
+                finish_run(db, True, {'cache time': '0:01:00', 'process time': '0:03:00'})
+                self.assertEqual(get_source_timeout(db, 'sources/a.json'), 720,
+                                 'Should follow run times again after a success')
+                
+                finish_run(db, True, {'cache time': None, 'process time': '0:00:05', 'cache run': 1})
+                self.assertEqual(get_source_timeout(db, 'sources/a.json'), 720,
+                                 'Should ignore runs that reused cached data')
+    
+    def test_is_merged_to_master_cached(self):
+        ''' Show that merge status is remembered, and revalidated with ETags.
+        '''
+        _ = mock.Mock()
+        requested, revalidated = [], []
+        
+        def response_content(url, request):
+            requested.append(url.path)
+            got = self.response_content(url, request)
+            etag = '"{}"'.format(hashlib.md5(url.path.encode('utf8')).hexdigest())
+            
+            if request.headers.get('If-None-Match') == etag:
+                revalidated.append(url.path)
+                return response(304, b'', headers={'ETag': etag})
+            
+            got.headers['ETag'] = etag
+            return got
+        
+        for cache in (_merge_status_cache, _github_templates, _github_etag_cache):
+            cache.clear()
+        
+        with patch('openaddr.ci.objects.read_set') as read_set, patch('openaddr.ci.objects.read_job') as read_job:
+            read_set.return_value, read_job.return_value = None, mock.Mock()
+            read_job.return_value.github_owner = 'openaddresses'
+            read_job.return_value.github_repository = 'openaddresses'
+
+            with HTTMock(response_content):
+                self.assertIs(is_merged_to_master(_, _, _, 'e38df23', _), False)
+                self.assertEqual(len(requested), 3, 'Should look up templates and compare')
+
+                self.assertIs(is_merged_to_master(_, _, _, 'e38df23', _), False)
+                self.assertIs(is_merged_to_master(_, _, _, 'a7266f30', _), True)
+                self.assertEqual(len(requested), 4, 'Should reuse templates and merge status')
+                
+                with patch('openaddr.ci.MERGE_STATUS_TTL', new=timedelta(seconds=0)):
+                    self.assertIs(is_merged_to_master(_, _, _, 'e38df23', _), False)
+                    self.assertIs(is_merged_to_master(_, _, _, 'e38df23', _), False)
+
+                self.assertEqual(len(requested), 6, 'Should check expired merge status')
+                self.assertEqual(revalidated, ['/repos/openaddresses/openaddresses/compare/e38df23...master'] * 2)
+    
+    def test_batch_sources_lazily(self):
+        ''' Show that contents API requests for batch sources wait until each is needed.
+        '''
+        requested = []
+        
+        def response_content(url, request):
+            requested.append(url.path)
+            return self.response_content(url, request)
+        
+        def source_requests():
+            return [path for path in requested if '/contents/' in path and path.endswith('.json')]
+        
+        with HTTMock(response_content):
+            source_urls, contents = list_batch_source_urls('openaddresses', 'hooked-on-sources', self.github_auth)
+            self.assertEqual(contents, {}, 'Should fall back to contents API')
+            self.assertEqual(source_requests(), [], 'Should only list sources')
+            
+            sources = iterate_batch_sources(source_urls, contents, self.github_auth)
+            source = next(sources)
+            self.assertEqual(len(source_requests()), 1, 'Should request just one source')
+        
+        self.assertEqual(source['path'], source_urls[0]['path'])
+    
     @patch('openaddr.ci.GITHUB_RETRY_DELAY', new=timedelta(seconds=0))
     def test_batch_runs(self):
         ''' Show that the right tasks are enqueued in a batch context.
@@ -2446,7 +3273,7 @@ class TestBatch (unittest.TestCase):
     def test_single_run(self, do_work):
         ''' Show that the tasks enqueued in a batch context can be run.
         '''
-        def returns_plausible_result(s3, run_id, source_name, content, output_dir):
+        def returns_plausible_result(s3, run_id, source_name, content, output_dir, timeout=None, cache_state=None, cancelled=None):
             return dict(message=MAGIC_OK_MESSAGE, output={"source": "user_input.txt"})
         
         do_work.side_effect = returns_plausible_result
@@ -2507,7 +3334,7 @@ class TestBatch (unittest.TestCase):
     def test_run_with_renders(self, do_work):
         ''' Show that a batch context will result in rendered maps.
         '''
-        def returns_plausible_result(s3, run_id, source_name, content, output_dir):
+        def returns_plausible_result(s3, run_id, source_name, content, output_dir, timeout=None, cache_state=None, cancelled=None):
             return dict(message=MAGIC_OK_MESSAGE, output={"source": "user_input.txt"})
         
         do_work.side_effect = returns_plausible_result
@@ -2554,6 +3381,57 @@ class TestBatch (unittest.TestCase):
             self.assertEqual(get('http://fake-s3.local/render-europe.png').status_code, 200)
             self.assertEqual(get('http://fake-s3.local/render-world.png').status_code, 200)
 
+class TestStatusDispatcher (unittest.TestCase):
+
+    def setUp(self):
+        '''
+        '''
+        self.posted, self.responses = [], []
+    
+    def response_content(self, url, request):
+        '''
+        '''
+        status = json.loads(request.body)
+        self.posted.append((url.geturl(), status['state']))
+        
+        status_code, headers = self.responses.pop(0) if self.responses else (201, {})
+        return response(status_code, json.dumps(status).encode('utf8'), headers=headers)
+    
+    @patch('openaddr.ci.STATUS_DEBOUNCE', new=timedelta(seconds=30))
+    def test_coalesced_statuses(self):
+        ''' Check that only the latest status for each URL is posted.
+        '''
+        dispatcher = StatusDispatcher()
+        
+        with HTTMock(self.response_content):
+            for state in ('pending', 'pending', 'failure'):
+                dispatcher.put('http://github/statuses/a', dict(state=state), None)
+            dispatcher.put('http://github/statuses/b', dict(state='success'), None)
+            
+            sleep(.1)
+            self.assertEqual(self.posted, [], 'Should wait for debounce')
+            self.assertTrue(dispatcher.flush(5))
+        
+        self.assertEqual(self.posted, [('http://github/statuses/a', 'failure'),
+                                       ('http://github/statuses/b', 'success')])
+
+    @patch('openaddr.ci.STATUS_DEBOUNCE', new=timedelta(seconds=0))
+    @patch('openaddr.ci.STATUS_MAX_BACKOFF', new=timedelta(seconds=0))
+    def test_retried_statuses(self):
+        ''' Check that failed posts are retried, and that rate limits are respected.
+        '''
+        dispatcher = StatusDispatcher()
+        reset = int(time.time()) + 2
+        
+        self.responses = [(500, {}), (403, {'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': str(reset)})]
+        
+        with HTTMock(self.response_content):
+            dispatcher.put('http://github/statuses/a', dict(state='success'), None)
+            self.assertTrue(dispatcher.flush(10))
+        
+        self.assertEqual(len(self.posted), 3, 'Should have tried three times')
+        self.assertTrue(time.time() >= reset, 'Should have waited for rate limit reset')
+
 class TestCollect (unittest.TestCase):
 
     def setUp(self):
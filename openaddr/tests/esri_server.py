@@ -0,0 +1,316 @@
+''' Local stand-in for an ArcGIS REST feature layer, for tests and benchmarks.
+
+Serves layer metadata and query responses for returnCountOnly,
+returnIdsOnly, outStatistics, resultOffset paging, OID where clause
+paging, and objectIds requests, with optional latency and errors.
+Answers f=pbf feature queries with protocol buffers, or given a recorded
+f=pbf response, serves it as-is and its features in both formats.
+
+    with FakeEsriServer(feature_count=5000, supports_pagination=True) as server:
+        task = EsriRestDownloadTask('us-xx-fake')
+        task.download([server.url], workdir)
+'''
+from __future__ import absolute_import, division, print_function
+from ..compat import standard_library
+
+import re
+import json
+import time
+import random
+import struct
+
+from threading import Thread, Lock
+from urllib.parse import urlparse, parse_qs
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+from .. import esripbf
+
+LAYER_PATH = '/arcgis/rest/services/Fake/FeatureServer/0'
+
+class _ThreadingHTTPServer (ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class FakeEsriServer:
+    ''' Configurable ArcGIS REST feature layer on a local port.
+
+        max_record_count: Value of maxRecordCount advertised in metadata.
+        record_limit: Number of features actually returned per query,
+            defaults to max_record_count.
+        latency: Seconds to wait before each query response.
+        feature_latency: Additional seconds to wait per returned feature.
+        error_rate: Fraction of feature queries that respond with an error.
+        empty_pages: Number of feature queries that return no features,
+            but say they exceeded the transfer limit.
+        supports_pbf: Advertise and answer f=pbf feature queries.
+        pbf_path: Recorded f=pbf response to serve as-is for f=pbf queries,
+            and to take features and fields from for f=json queries.
+        pbf_errors: Respond to f=pbf queries with a JSON error instead,
+            though PBF is still advertised in metadata.
+    '''
+    def __init__(self, feature_count=1000, max_record_count=1000, record_limit=None,
+                 supports_pagination=False, supports_statistics=False,
+                 latency=0, feature_latency=0, error_rate=0, seed=0,
+                 empty_pages=0, supports_pbf=True, pbf_path=None, pbf_errors=False):
+        self.pbf_content, self.pbf_features, self.pbf_errors = None, None, pbf_errors
+        self.supports_pbf = supports_pbf
+
+        if pbf_path:
+            with open(pbf_path, 'rb') as file:
+                self.pbf_content = file.read()
+            self.pbf_collection = esripbf.decode_feature_collection(self.pbf_content)
+            self.pbf_features, oid_field = {}, self.pbf_collection['objectIdFieldName']
+
+            # Recorded layers can repeat object IDs; keep the first of each.
+            for feature in self.pbf_collection['features']:
+                self.pbf_features.setdefault(feature['attributes'][oid_field], feature)
+            feature_count = len(self.pbf_features)
+
+        self.feature_count = feature_count
+        self.max_record_count = max_record_count
+        self.record_limit = record_limit or max_record_count
+        self.supports_pagination = supports_pagination
+        self.supports_statistics = supports_statistics
+        self.latency, self.feature_latency = latency, feature_latency
+        self.error_rate, self.random = error_rate, random.Random(seed)
+        self.empty_pages = empty_pages
+        self.requests, self.lock = [], Lock()
+
+        if self.pbf_features:
+            self.oids = sorted(self.pbf_features.keys())
+        else:
+            # Start OIDs above 1 so off-by-one errors in paging will show up.
+            self.oids = list(range(101, 101 + feature_count))
+        self.server, self.thread, self.url = None, None, None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+    def start(self):
+        self.server = _ThreadingHTTPServer(('127.0.0.1', 0), _make_handler(self))
+        self.thread = Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+        host, port = self.server.server_address
+        self.url = 'http://{}:{}{}'.format(host, port, LAYER_PATH)
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def feature(self, oid):
+        if self.pbf_features:
+            return self.pbf_features[oid]
+
+        return {
+            'attributes': {'OBJECTID': oid, 'NUMBER': oid % 1000, 'STREET': u'Main St'},
+            'geometry': {'x': -122 + oid * 1e-5, 'y': 37 + oid * 1e-5},
+            }
+
+    def metadata(self):
+        return {
+            'currentVersion': 10.3,
+            'name': 'Fake Addresses',
+            'type': 'Feature Layer',
+            'geometryType': 'esriGeometryPoint',
+            'objectIdField': 'OBJECTID',
+            'maxRecordCount': self.max_record_count,
+            'supportsStatistics': self.supports_statistics,
+            'supportsPagination': self.supports_pagination,
+            'advancedQueryCapabilities': {
+                'supportsPagination': self.supports_pagination,
+                'supportsStatistics': self.supports_statistics,
+                },
+            'supportedQueryFormats': 'JSON, PBF' if self.supports_pbf else 'JSON',
+            'fields': self.fields(),
+            }
+
+    def fields(self):
+        if self.pbf_features:
+            return [dict(field, alias=field['name']) for field in self.pbf_collection['fields']]
+
+        return [
+            {'name': 'OBJECTID', 'type': 'esriFieldTypeOID', 'alias': 'OBJECTID'},
+            {'name': 'NUMBER', 'type': 'esriFieldTypeInteger', 'alias': 'NUMBER'},
+            {'name': 'STREET', 'type': 'esriFieldTypeString', 'alias': 'STREET'},
+            ]
+
+    def query(self, args):
+        ''' Return a response dictionary, or protocol buffer bytes, for query arguments.
+        '''
+        if args.get('returnCountOnly') == 'true':
+            return {'count': self.feature_count}
+
+        if args.get('returnIdsOnly') == 'true':
+            return {'objectIdFieldName': 'OBJECTID', 'objectIds': self.oids}
+
+        if 'outStatistics' in args:
+            if not self.supports_statistics:
+                return _error(400, 'Statistics are not supported')
+            return {'features': [{'attributes': {'THE_MIN': self.oids[0], 'THE_MAX': self.oids[-1]}}]}
+
+        if self.error_rate and self.random.random() < self.error_rate:
+            return _error(500, 'Injected error')
+
+        if args.get('f') == 'pbf':
+            if self.pbf_errors or not self.supports_pbf:
+                return _error(400, 'Invalid or missing input parameters.')
+            if self.pbf_content is not None and not self.empty_pages:
+                return self.pbf_content
+
+        if self.empty_pages:
+            self.empty_pages -= 1
+            oids, limit = self.oids, 0
+
+        elif 'objectIds' in args:
+            requested = set(int(oid) for oid in args['objectIds'].split(',') if oid)
+            oids = [oid for oid in self.oids if oid in requested]
+            limit = self.record_limit
+        else:
+            oids = self.oids
+            match = re.match(r'^(\w+) > (-?\d+) AND \1 <= (-?\d+)$', args.get('where', '1=1'))
+            if match:
+                low, high = int(match.group(2)), int(match.group(3))
+                oids = [oid for oid in oids if low < oid <= high]
+
+            offset = int(args.get('resultOffset', 0))
+            count = int(args.get('resultRecordCount', self.record_limit))
+            limit = min(count, self.record_limit)
+
+            if 'resultOffset' in args and not self.supports_pagination:
+                return _error(400, 'Pagination is not supported')
+            oids = oids[offset:]
+
+        response = {
+            'objectIdFieldName': 'OBJECTID',
+            'geometryType': 'esriGeometryPoint',
+            'spatialReference': {'wkid': 4326},
+            'fields': self.fields(),
+            'features': [self.feature(oid) for oid in oids[:limit]],
+            }
+
+        if len(oids) > limit:
+            response['exceededTransferLimit'] = True
+
+        if args.get('f') == 'pbf':
+            return _encode_feature_collection(response)
+
+        return response
+
+def _error(code, message):
+    return {'error': {'code': code, 'message': message, 'details': []}}
+
+def _varint(value):
+    out = bytearray()
+    while value > 0x7f:
+        out.append(0x80 | (value & 0x7f))
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+def _zigzag(value):
+    return value * 2 if value >= 0 else -value * 2 - 1
+
+def _message_field(number, data):
+    return _varint(number << 3 | esripbf.DELIMITED) + _varint(len(data)) + data
+
+def _varint_field(number, value):
+    return _varint(number << 3 | esripbf.VARINT) + _varint(value)
+
+def _double_field(number, value):
+    return _varint(number << 3 | esripbf.FIXED64) + struct.pack('<d', value)
+
+def _encode_value(value):
+    if value is None:
+        return b''
+    elif isinstance(value, bool):
+        return _varint_field(9, int(value))
+    elif isinstance(value, int):
+        return _varint_field(8, _zigzag(value))
+    elif isinstance(value, float):
+        return _double_field(3, value)
+    return _message_field(1, str(value).encode('utf8'))
+
+def _encode_feature_collection(response):
+    ''' Encode a point feature query response as a FeatureCollectionPBuffer.
+
+        The inverse of esripbf.decode_feature_collection(), quantizing
+        coordinates to a billionth of a degree from a lower-left origin.
+    '''
+    scale, field_types = 1e-9, {v: k for (k, v) in esripbf.FIELD_TYPES.items()}
+    names = [field['name'] for field in response['fields']]
+
+    result = _message_field(1, response['objectIdFieldName'].encode('utf8'))
+    result += _varint_field(7, 0)
+    result += _varint_field(9, int(bool(response.get('exceededTransferLimit'))))
+    result += _message_field(12, _varint_field(1, esripbf.LOWER_LEFT)
+                             + _message_field(2, _double_field(1, scale) + _double_field(2, scale))
+                             + _message_field(3, _double_field(1, 0.) + _double_field(2, 0.)))
+
+    for field in response['fields']:
+        result += _message_field(13, _message_field(1, field['name'].encode('utf8'))
+                                 + _varint_field(2, field_types[field['type']]))
+
+    for feature in response['features']:
+        encoded = b''.join([_message_field(1, _encode_value(feature['attributes'].get(name)))
+                            for name in names])
+        if feature.get('geometry'):
+            coords = [int(round(feature['geometry'][axis] / scale)) for axis in ('x', 'y')]
+            encoded += _message_field(2, _message_field(3, b''.join([_varint(_zigzag(c)) for c in coords])))
+        result += _message_field(15, encoded)
+
+    return _message_field(2, _message_field(1, result))
+
+def _make_handler(server):
+    ''' Return a request handler class for a FakeEsriServer.
+    '''
+    class Handler (BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            self.respond(parse_qs(urlparse(self.path).query))
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            args = parse_qs(urlparse(self.path).query)
+            args.update(parse_qs(self.rfile.read(length).decode('utf8')))
+            self.respond(args)
+
+        def respond(self, args):
+            args = {key: values[-1] for (key, values) in args.items()}
+            path = urlparse(self.path).path
+
+            with server.lock:
+                server.requests.append((path, args))
+
+            if path == LAYER_PATH:
+                body = server.metadata()
+            elif path == LAYER_PATH + '/query':
+                with server.lock:
+                    body = server.query(args)
+                count = server.feature_count if isinstance(body, bytes) else len(body.get('features', []))
+                time.sleep(server.latency + server.feature_latency * count)
+            else:
+                self.send_error(404)
+                return
+
+            if isinstance(body, bytes):
+                content, content_type = body, 'application/x-protobuf'
+            else:
+                content, content_type = json.dumps(body).encode('utf8'), 'application/json'
+
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
@@ -0,0 +1,125 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import mock
+import sys
+import threading
+import time
+
+from os.path import join
+
+from .. import __version__
+from ..compat import csvopen, csvDictReader
+from ..jobs import (
+    find_source_files, order_source_files, read_process_times, write_state_txt,
+    parse_process_time, ProcessOnePool, check_output_or_cancel, JobCancelled
+    )
+
+class TestJobs (unittest.TestCase):
+
+    def setUp(self):
+        self.sources = tempfile.mkdtemp(prefix='TestJobs-')
+        self.destination = tempfile.mkdtemp(prefix='TestJobs-')
+
+        for path in ('us/ca/carson.json', 'us/ca/berkeley.json', 'fr/lyon.json', 'dk.json'):
+            if not os.path.exists(join(self.sources, os.path.dirname(path))):
+                os.makedirs(join(self.sources, os.path.dirname(path)))
+            with open(join(self.sources, path), 'w') as file:
+                file.write('{ }')
+
+    def tearDown(self):
+        shutil.rmtree(self.sources)
+        shutil.rmtree(self.destination)
+
+    def test_order_source_files(self):
+        '''
+        '''
+        paths = find_source_files(self.sources)
+        self.assertEqual(len(paths), 4)
+
+        times = {'us/ca/carson.json': '0:00:12.3', 'fr/lyon.json': '1:02:03', 'dk.json': '0:05:00'}
+        ordered = [os.path.relpath(path, self.sources)
+                   for path in order_source_files(paths, self.sources, times)]
+
+        self.assertEqual(ordered, ['us/ca/berkeley.json', 'fr/lyon.json', 'dk.json', 'us/ca/carson.json'],
+                         'Unknown sources should come first, then longest to shortest')
+
+    def test_parse_process_time(self):
+        '''
+        '''
+        self.assertEqual(parse_process_time('0:00:12.3'), 12.3)
+        self.assertEqual(parse_process_time('10:02:03'), 36123)
+        self.assertEqual(parse_process_time('1 day, 0:00:01'), 86401)
+        self.assertEqual(parse_process_time('2 days, 1:00:00.5'), 176400.5)
+        self.assertIsNone(parse_process_time(None))
+        self.assertIsNone(parse_process_time('9999'))
+
+        times = {'us/ca/carson.json': '10:00:00', 'dk.json': '9:00:00'}
+        ordered = [os.path.relpath(path, self.sources) for path
+                   in order_source_files(find_source_files(self.sources), self.sources, times)]
+
+        self.assertEqual(ordered[2:], ['us/ca/carson.json', 'dk.json'],
+                         'Ten hours should come before nine hours')
+
+    @mock.patch('multiprocessing.get_context')
+    def test_process_one_pool_preload(self, get_context):
+        '''
+        '''
+        ProcessOnePool()
+        (preload, ), _ = get_context.return_value.set_forkserver_preload.call_args
+
+        for module_name in ('openaddr.jobs', 'osgeo.ogr', 'requests'):
+            self.assertIn(module_name, preload, 'Lazy imports should not leave the fork server cold')
+
+    def test_check_output_or_cancel(self):
+        '''
+        '''
+        cancelled = threading.Event()
+        output = check_output_or_cancel((sys.executable, '-c', 'print("hi")'), 10, cancelled)
+        self.assertEqual(output.strip(), b'hi')
+
+        sleeper, started = (sys.executable, '-c', 'import time; time.sleep(30)'), time.time()
+        threading.Timer(.2, cancelled.set).start()
+
+        with self.assertRaises(JobCancelled):
+            check_output_or_cancel(sleeper, 60, cancelled)
+
+        self.assertTrue(time.time() - started < 10, 'Should stop the job soon after it is cancelled')
+
+    def test_write_state_txt(self):
+        '''
+        '''
+        statedir = join(self.destination, 'us/ca/carson')
+        os.makedirs(statedir)
+
+        with open(join(statedir, 'index.json'), 'w') as file:
+            json.dump([['source', 'cache', 'processed', 'process time', 'output', 'address count'],
+                       ['carson.json', 'http://example.com/cache.zip', 'out.csv', '0:00:12.3', 'output.txt', 5]], file)
+
+        state_paths = {
+            join(self.sources, 'us/ca/carson.json'): join(statedir, 'index.json'),
+            join(self.sources, 'dk.json'): None
+            }
+
+        state_txt = write_state_txt(state_paths, self.sources, self.destination)
+        self.assertEqual(state_txt, join(self.destination, 'state.txt'))
+
+        with csvopen(state_txt, 'r', encoding='utf8') as file:
+            rows = list(csvDictReader(file, dialect='excel-tab', encoding='utf8'))
+
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[0]['source'], 'dk.json')
+        self.assertEqual(rows[0]['processed'], '')
+        self.assertEqual(rows[0]['code version'], __version__)
+
+        self.assertEqual(rows[1]['source'], 'us/ca/carson.json')
+        self.assertEqual(rows[1]['cache'], 'http://example.com/cache.zip')
+        self.assertEqual(rows[1]['processed'], 'us/ca/carson/out.csv')
+        self.assertEqual(rows[1]['output'], 'us/ca/carson/output.txt')
+        self.assertEqual(rows[1]['address count'], '5')
+
+        self.assertEqual(read_process_times(state_txt), {'us/ca/carson.json': '0:00:12.3'})
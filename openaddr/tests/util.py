@@ -11,6 +11,7 @@ from mock import Mock
 
 from .. import util, __version__
 from ..util.esri2geojson import esri2geojson
+from osgeo import ogr
 
 class TestUtilities (unittest.TestCase):
 
@@ -163,3 +164,21 @@ class TestEsri2GeoJSON (unittest.TestCase):
         self.assertEqual(data['features'][0]['type'], 'Feature')
         self.assertEqual(data['features'][0]['geometry']['type'], 'Point')
         self.assertEqual(data['features'][0]['properties']['ADDRESS'], '555 E CARSON ST 122')
+
+    def test_conversion_shapefile(self):
+
+        esri_url = 'http://www.carsonproperty.info/ArcGIS/rest/services/basemap/MapServer/1'
+        shapefile_path = join(self.testdir, 'out.shp')
+
+        with HTTMock(self.response_content):
+            esri2geojson(esri_url, shapefile_path)
+
+        datasource = ogr.Open(shapefile_path)
+        layer = datasource.GetLayer(0)
+
+        self.assertEqual(layer.GetFeatureCount(), 5)
+        self.assertEqual(layer.GetGeomType(), ogr.wkbPoint25D)
+
+        feature = layer.GetNextFeature()
+        self.assertEqual(feature.GetField('ADDRESS'), '555 E CARSON ST 122')
+        self.assertAlmostEqual(feature.GetGeometryRef().GetX(), -118.266125844, places=7)
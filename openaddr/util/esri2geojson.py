@@ -4,61 +4,100 @@ from __future__ import absolute_import, division, print_function
 import logging; _L = logging.getLogger('openaddr.util.esri2geojson')
 
 from argparse import ArgumentParser
-from os.path import dirname, join, basename, splitext, exists
-from tempfile import mkdtemp
-from csv import DictReader
-from shutil import rmtree
-from os import remove
+from os.path import basename, splitext, exists
 import email.parser
 import urllib.parse
+import time
 
 from ..cache import EsriRestDownloadTask
-from ..conform import GEOM_FIELDNAME
-from ..compat import check_output
-
-from osgeo import ogr
+from ..conform import GEOM_FIELDNAME, ogr, osr
+
+# ESRI geometry types to OGR type names. Downloaded WKT geometries have
+# zero Z values, so these are all 2.5D like the WKT they describe.
+_ogr_geometry_type_names = {
+    'esriGeometryPoint': 'wkbPoint25D',
+    'esriGeometryMultipoint': 'wkbMultiPoint25D',
+    'esriGeometryPolyline': 'wkbMultiLineString25D',
+    'esriGeometryPolygon': 'wkbPolygon25D',
+    }
+
+def ogr_geometry_type(esri_geometry_type):
+    ''' Return an OGR geometry type for an ESRI geometry type.
+    '''
+    return getattr(ogr, _ogr_geometry_type_names.get(esri_geometry_type, 'wkbUnknown'))
 
-# index of numeric geometry types to names
-geometry_types = dict([(getattr(ogr, attr), attr) for attr in dir(ogr)
-                       if attr.startswith('wkb')])
+class OGRFeatureSink:
+    ''' Write downloaded ESRI feature rows to a new OGR data source.
 
-def guess_geom_type(csv_path, geom_name):
-    ''' Look at the first row of the given CSV to determine its geometry type.
+        Used as a feature sink with EsriRestDownloadTask.download_source().
+        Rows are held until their page is complete, in case it's retried.
     '''
-    with open(csv_path) as file:
-        for row in DictReader(file):
-            geom = ogr.CreateGeometryFromWkt(row.get(geom_name))
-            return geometry_types.get(geom.GetGeometryType(), False)
-    
-    return False
+    report_interval = 10
 
-def write_vrt_file(csv_path):
-    ''' Generate a VRT file to help OGR read CSV file.
-    
-        http://www.gdal.org/drv_vrt.html
-    '''
-    vrt_template = '''<OGRVRTDataSource>
-            <OGRVRTLayer name="{csv_base}">
-                <SrcDataSource>{csv_path}</SrcDataSource>
-                <SrcLayer>{csv_base}</SrcLayer>
-                <GeometryType>{geom_type}</GeometryType>
-                <LayerSRS>EPSG:4326</LayerSRS>
-                <GeometryField encoding="WKT" name="vrt_geom" field="{geom_name}" reportSrcColumn="FALSE"></GeometryField>
-            </OGRVRTLayer>
-        </OGRVRTDataSource>'''
-    
-    geom_name = GEOM_FIELDNAME
-    geom_type = guess_geom_type(csv_path, geom_name)
-    csv_dir = dirname(csv_path)
-    csv_base, _ = splitext(basename(csv_path))
-    vrt_path = join(csv_dir, csv_base + '.vrt')
+    def __init__(self, output_path, format_name, metadata, field_names):
+        self.output_path, self.format_name = output_path, format_name
+        self.geom_type = ogr_geometry_type(metadata.get('geometryType'))
+        self.field_names = [name for name in field_names if name != GEOM_FIELDNAME]
+        self.rows, self.count = [], 0
 
-    with open(vrt_path, 'w') as file:
-        file.write(vrt_template.format(**locals()))
+    def __enter__(self):
+        driver = ogr.GetDriverByName(self.format_name)
 
-    _L.debug('Wrote {vrt_path}'.format(**locals()))
-    
-    return vrt_path
+        if exists(self.output_path):
+            driver.DeleteDataSource(self.output_path)
+
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(4326)
+
+        layer_name, _ = splitext(basename(self.output_path))
+        self.datasource = driver.CreateDataSource(self.output_path)
+        self.layer = self.datasource.CreateLayer(layer_name, srs, self.geom_type)
+
+        for name in self.field_names:
+            self.layer.CreateField(ogr.FieldDefn(name, ogr.OFTString))
+
+        self.start_time = self.report_time = time.time()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        # Dereferencing the data source is how OGR flushes and closes it.
+        self.layer, self.datasource = None, None
+        self.report()
+
+    def begin_page(self):
+        self.rows = []
+
+    def write(self, row):
+        self.rows.append(row)
+
+    def abort_page(self):
+        self.rows = []
+
+    def end_page(self):
+        layer_defn = self.layer.GetLayerDefn()
+
+        for row in self.rows:
+            feature = ogr.Feature(layer_defn)
+
+            # Field names may have been laundered by the driver, so go by index.
+            for (index, name) in enumerate(self.field_names):
+                if row.get(name) is not None:
+                    feature.SetField(index, u'{}'.format(row[name]))
+
+            feature.SetGeometry(ogr.CreateGeometryFromWkt(row[GEOM_FIELDNAME]))
+            self.layer.CreateFeature(feature)
+            self.count += 1
+
+        self.rows = []
+
+        if time.time() - self.report_time > self.report_interval:
+            self.report()
+
+    def report(self):
+        self.report_time = time.time()
+        elapsed = self.report_time - self.start_time
+        _L.info('Wrote {} features to {} in {:.1f} seconds, {:.1f} features/second'.format(
+                self.count, self.output_path, elapsed, self.count / max(elapsed, .001)))
 
 def _collect_headers(strings):
     headers, parser = {}, email.parser.Parser()
@@ -78,34 +117,27 @@ def _collect_params(strings):
 
 def esri2ogrfile(esri_url, output_path, headers={}, params={}):
     ''' Convert single ESRI feature service URL to OGR file.
+
+        Features are written straight from the ESRI query responses,
+        in a single pass with no intermediate CSV file.
     '''
-    workdir = mkdtemp(prefix='esri2geojson-')
     ogr.UseExceptions()
 
-    try:
-        task = EsriRestDownloadTask('esri', params=params, headers=headers)
-        (csv_path, ) = task.download([esri_url], workdir)
+    format_name = {
+        '.shp': 'ESRI Shapefile',
+        '.geojson': 'GeoJSON'
+        }.get(splitext(output_path)[1])
 
-        _L.info('Saved {esri_url} to {csv_path}'.format(**locals()))
-    
-        vrt_path = write_vrt_file(csv_path)
-        
-        format_name = {
-            '.shp': 'ESRI Shapefile',
-            '.geojson': 'GeoJSON'
-            }.get(splitext(output_path)[1])
-        
-        if exists(output_path):
-            remove(output_path)
-        
-        print(check_output(('ogr2ogr', '-f', format_name, output_path, vrt_path)))
-
-        _L.info('Converted {csv_path} to {output_path}'.format(**locals()))
-    
-    finally:
-        rmtree(workdir)
+    if format_name is None:
+        raise ValueError('Unknown output file type: {}'.format(output_path))
+
+    def open_sink(metadata, field_names):
+        return OGRFeatureSink(output_path, format_name, metadata, field_names)
+
+    task = EsriRestDownloadTask('esri', params=params, headers=headers)
+    count = task.download_source(esri_url, None, open_sink)
 
-        _L.info('Removed {workdir}'.format(**locals()))
+    _L.info('Converted {count} features from {esri_url} to {output_path}'.format(**locals()))
 
 # Provided for compatibility
 esri2geojson = esri2ogrfile
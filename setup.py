@@ -44,6 +44,7 @@ setup(
         console_scripts = [
             'openaddr-render-us = openaddr.render:main',
             'openaddr-process-one = openaddr.process_one:main',
+            'openaddr-process-all = openaddr.jobs:main',
             'openaddr-esri2geojson = openaddr.util.esri2geojson:main',
             'openaddr-ci-recreate-db = openaddr.ci.recreate_db:main',
             'openaddr-ci-run-dequeue = openaddr.ci.run_dequeue:main',
@@ -56,7 +57,7 @@ setup(
     package_data = {
         'openaddr': [
             'geodata/*.shp', 'geodata/*.shx', 'geodata/*.prj', 'geodata/*.dbf',
-            'geodata/*.cpg', 'templates/*.*', 'VERSION',
+            'geodata/*.cpg', 'templates/*.*', 'VERSION', 'esripbf.proto',
         ],
         'openaddr.ci': [
             'schema.pgsql', 'templates/*.*', 'static/*.*'
@@ -17,14 +17,15 @@ from openaddr import jobs
 
 from openaddr.tests import TestOA, TestState, TestPackage
 from openaddr.tests.sample import TestSample
-from openaddr.tests.cache import TestCacheExtensionGuessing, TestCacheEsriDownload
+from openaddr.tests.jobs import TestJobs
+from openaddr.tests.cache import TestCacheExtensionGuessing, TestCacheLinkOrCopy, TestCacheEsriDownload, TestCacheEsriProtobuf, TestCacheEsriPaging, TestCacheEsriServer
 from openaddr.tests.conform import TestConformCli, TestConformTransforms, TestConformMisc, TestConformCsv, TestConformLicense
 from openaddr.tests.expand import TestExpand
 from openaddr.tests.render import TestRender
 from openaddr.tests.dotmap import TestDotmap
 from openaddr.tests.util import TestEsri2GeoJSON, TestUtilities
 from openaddr.tests.summarize import TestSummarizeFunctions
-from openaddr.tests.ci import TestHook, TestRuns, TestWorker, TestBatch, TestObjects, TestCollect, TestAPI
+from openaddr.tests.ci import TestHook, TestRuns, TestWorker, TestBatch, TestObjects, TestCollect, TestAPI, TestStatusDispatcher
 from openaddr.tests.parcels import TestParcelsUtils, TestParcelsParse
 
 if __name__ == '__main__':